@@ -0,0 +1,383 @@
+import time
+import pickle
+from collections import OrderedDict
+import numpy as np
+from replay import ReplayMemory, REPLAY_SAMPLED, REPLAY_SAMPLE_SECONDS
+
+# Replay that keeps no frames. The emulator is deterministic with
+# repeat_action_probability=0 (Environment._init_ale), so the frame of a
+# transition is a function of the ALE state before its step and its action.
+# ActionLogReplayMemory stores an ALE state every checkpoint_every transitions,
+# and at every episode or stream start, plus the actions it already kept. A
+# sampled frame is rebuilt by restoring the last state before it and replaying
+# the actions up to it - in a pool of decode processes, each with its own ALE.
+#
+# A transition costs ~10 bytes plus 1/checkpoint_every of an ALE state (a few
+# KB), so tens of millions fit in a few GB. Sampling pays up to
+# checkpoint_every emulator steps per frame missing from the decoded frame
+# cache - this is for archival and offline training, not the online learner.
+
+class FrameCache:
+    """
+    Stands in for ReplayMemory.frames: slot -> frame for the most recently
+    added or decoded frames, oldest evicted first
+    """
+    def __init__(self, size, frame_height, frame_width, capacity):
+        self.shape = (size, frame_height, frame_width)
+        self.dtype = np.dtype(np.uint8)
+        self.frame_bytes = frame_height * frame_width
+        self.capacity = capacity
+        self.frames = OrderedDict()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {'cached_frames': 0, 'decoded_frames': 0, 'decode_runs': 0, 'emulator_steps': 0}
+
+    def __setitem__(self, key, value):
+        # add_experience writes frames[current, ...]
+        slot = key[0] if isinstance(key, tuple) else key
+        self.put(int(slot), value)
+
+    def put(self, slot, frame):
+        if self.capacity <= 0:
+            return
+        self.frames.pop(slot, None)
+        self.frames[slot] = np.array(frame, dtype=np.uint8)
+        while len(self.frames) > self.capacity:
+            self.frames.popitem(last=False)
+
+    def get(self, slot):
+        frame = self.frames.get(slot)
+        if frame is not None:
+            self.frames.move_to_end(slot)
+        return frame
+
+    @property
+    def nbytes(self):
+        return len(self.frames) * self.frame_bytes
+
+    def clear(self):
+        self.frames.clear()
+
+# the ALE of a decode process, set by init_decoder
+_decoder = None
+
+def init_decoder(rom_file, frame_skip, frame_size):
+    global _decoder
+    from env import Environment
+    ale = Environment._init_ale(0, rom_file)
+    _decoder = (ale, ale.getMinimalActionSet(), frame_skip, frame_size)
+
+def decode_run(task):
+    """
+    Args:
+        task: (pickled ALE state, action indices from the state on, offsets of
+            the wanted frames into them)
+    Returns:
+        (len(offsets), frame_size, frame_size) frames, as Environment.step makes them
+    """
+    from env import cv_preprocess_frame
+    ale, minimal_actions, frame_skip, frame_size = _decoder
+    state, actions, offsets = task
+    ale.restoreState(pickle.loads(state))
+    wanted = set(offsets.tolist())
+    frames = {}
+    for t in range(int(offsets.max()) + 1):
+        for i in range(frame_skip):
+            if i == frame_skip - 1:
+                prev_screen = ale.getScreenRGB()
+            ale.act(minimal_actions[actions[t]])
+        if t in wanted:
+            frames[t] = cv_preprocess_frame(np.maximum(prev_screen, ale.getScreenRGB()), frame_size)
+    return np.array([frames[t] for t in offsets.tolist()])
+
+class ActionLogReplayMemory(ReplayMemory):
+    """ReplayMemory that stores ALE states and actions, and re-simulates frames when they are sampled"""
+    def __init__(self, rom_file, frame_skip=4, checkpoint_every=100, n_workers=4, cache_frames=100000, **kwargs):
+        """
+        Args:
+            rom_file: String, the rom the transitions are played on
+            frame_skip: Integer, the Environment's frame_skip
+            checkpoint_every: Integer, most transitions between two stored ALE states
+            n_workers: Integer, decode processes, 0 to decode in this one
+            cache_frames: Integer, frames kept in the decoded frame cache
+            kwargs: passed to ReplayMemory
+        """
+        self.log_config = {'rom_file': rom_file, 'frame_skip': frame_skip, 'checkpoint_every': checkpoint_every,
+                           'n_workers': n_workers, 'cache_frames': cache_frames}
+        super(ActionLogReplayMemory, self).__init__(**kwargs)
+        # transition id of the ALE state each slot is decoded from
+        self.anchors = np.full(self.size, -1, dtype=np.int64)
+        # transition id -> pickled ALE state from before that transition's step
+        self.checkpoints = {}
+        self.last_anchor = -1
+        self.pending_state = None
+        self.pool = None
+        self.sample_time = 0.
+        self.sampled = 0
+
+    def _allocate_frames(self):
+        return FrameCache(self.size, self.frame_height, self.frame_width, self.log_config['cache_frames'])
+
+    def _decode(self, tasks):
+        if self.log_config['n_workers'] <= 0:
+            if _decoder is None:
+                init_decoder(self.log_config['rom_file'], self.log_config['frame_skip'], self.frame_height)
+            return [decode_run(task) for task in tasks]
+        if self.pool is None:
+            from multiprocessing import get_context
+            self.pool = get_context('spawn').Pool(self.log_config['n_workers'], initializer=init_decoder,
+                                                  initargs=(self.log_config['rom_file'], self.log_config['frame_skip'], self.frame_height))
+        return self.pool.map(decode_run, tasks, chunksize=max(1, len(tasks) // (4 * self.log_config['n_workers'])))
+
+    def wants_checkpoint(self):
+        """does the next transition need the ALE state from before its step"""
+        if self.count == 0 or self.last_anchor < 0:
+            return True
+        last = (self.current - 1) % self.size
+        # a reset may follow a terminal flag, and another stream may follow a break
+        return (self.terminal_flags[last] or self.history_breaks[last] or
+                self.total_added - self.last_anchor >= self.log_config['checkpoint_every'])
+
+    def before_step(self, env):
+        """call with the env about to step, before each add_experience"""
+        self.pending_state = pickle.dumps(env.ale.cloneState()) if self.wants_checkpoint() else None
+
+    def add_experience(self, action, frame, reward, terminal):
+        tid = self.total_added
+        # the state stored for the transition this slot held goes with it
+        self.checkpoints.pop(tid - self.size, None)
+        if self.pending_state is not None:
+            self.checkpoints[tid] = self.pending_state
+            self.last_anchor = tid
+            self.pending_state = None
+        elif self.wants_checkpoint():
+            raise ValueError('transition %d needs an ALE state, call before_step(env) before env.step' % tid)
+        self.anchors[self.current] = self.last_anchor
+        super(ActionLogReplayMemory, self).add_experience(action, frame, reward, terminal)
+
+    def add_experiences(self, actions, frames, rewards, terminals, new_stream=False):
+        # a block of frames carries no ALE states to re-simulate them from
+        raise ValueError('an action log replay needs the ALE state of each step, call before_step(env) and add_experience per step')
+
+    def _get_valid_indices(self, batch_size):
+        if batch_size != self.indices.shape[0]:
+             self.indices = np.empty(batch_size, dtype=np.int32)
+        # the oldest transitions may have lost the state they are decoded from
+        oldest_anchor = self.total_added - self.size
+        for i in range(batch_size):
+            while True:
+                index = self.random_state.randint(self.agent_history_length, self.count - 1)
+                if index >= self.current and index - self.agent_history_length <= self.current:
+                    continue
+                if self.terminal_flags[index - self.agent_history_length:index].any():
+                    continue
+                if self.history_breaks[index - self.agent_history_length:index].any():
+                    continue
+                if (self.anchors[index - self.agent_history_length:index + 1] < oldest_anchor).any():
+                    continue
+                if self.holdout is not None and self.holdout[0] <= index < self.holdout[1]:
+                    continue
+                break
+            self.indices[i] = index
+
+    def take(self, slots):
+        """frames of slots, from the cache or re-simulated with one run per ALE state"""
+        out = np.empty((len(slots), self.frame_height, self.frame_width), dtype=np.uint8)
+        runs = {}
+        for j, slot in enumerate(slots):
+            frame = self.frames.get(slot)
+            if frame is not None:
+                out[j] = frame
+                self.frames.stats['cached_frames'] += 1
+            else:
+                runs.setdefault(int(self.anchors[slot]), {}).setdefault(int(slot), []).append(j)
+        if not runs:
+            return out
+        tasks, task_slots = [], []
+        for anchor, wanted in runs.items():
+            # in the order the run reaches them
+            wanted_slots = sorted(wanted, key=lambda slot: (slot - anchor) % self.size)
+            offsets = (np.array(wanted_slots) - anchor) % self.size
+            actions = self.actions[(anchor + np.arange(offsets[-1] + 1)) % self.size]
+            tasks.append((self.checkpoints[anchor], actions, offsets))
+            task_slots.append((wanted, wanted_slots))
+            self.frames.stats['emulator_steps'] += int(offsets[-1]) + 1
+            self.frames.stats['decoded_frames'] += len(wanted_slots)
+        for (wanted, wanted_slots), decoded in zip(task_slots, self._decode(tasks)):
+            for slot, frame in zip(wanted_slots, decoded):
+                out[wanted[slot]] = frame
+                self.frames.put(slot, frame)
+        self.frames.stats['decode_runs'] += len(tasks)
+        return out
+
+    def get_minibatch(self, batch_size):
+        """
+        Returns a minibatch of batch_size, decoding the frames of every state
+        in it together
+        """
+        st = time.time()
+        if self.count < self.agent_history_length:
+            raise ValueError('Not enough memories to get a minibatch')
+        self._get_valid_indices(batch_size)
+        history = self.agent_history_length
+        frame_indices = self.indices[:, None] + np.arange(-history, 1)[None, :]
+        frames = self.take(frame_indices.ravel()).reshape(batch_size, history + 1, self.frame_height, self.frame_width)
+        self.states = frames[:, :history]
+        self.new_states = frames[:, 1:]
+        self.sample_time += time.time() - st
+        self.sampled += batch_size
+        REPLAY_SAMPLED.inc(batch_size)
+        REPLAY_SAMPLE_SECONDS.observe(time.time() - st)
+        return self.states, self.actions[self.indices], self.rewards[self.indices], self.new_states, self.terminal_flags[self.indices], self.get_masks(self.indices)
+
+    def decode_report(self):
+        """sampling throughput and how its frames were found since the last report"""
+        stats = dict(self.frames.stats)
+        stats['transitions_per_sec'] = self.sampled / self.sample_time if self.sample_time else 0.
+        self.frames.reset_stats()
+        self.sample_time = 0.
+        self.sampled = 0
+        return stats
+
+    def checkpoint_bytes(self):
+        return sum(len(state) for state in self.checkpoints.values())
+
+    def save_buffer(self, filepath):
+        st = time.time()
+        print("starting save of action log buffer to %s"%filepath, st)
+        ids = np.array(sorted(self.checkpoints), dtype=np.int64)
+        blobs = [self.checkpoints[i] for i in ids.tolist()]
+        np.savez_compressed(filepath,
+                 actions=self.actions, rewards=self.rewards, terminal_flags=self.terminal_flags,
+                 masks=self.masks if self.masks is not None else np.zeros((0, self.num_heads), dtype=bool),
+                 hashed_masks=self.masks is None, mask_seed=self.mask_seed, total_added=self.total_added,
+                 history_breaks=self.history_breaks, anchors=self.anchors, last_anchor=self.last_anchor,
+                 checkpoint_ids=ids, checkpoint_lengths=np.array([len(b) for b in blobs], dtype=np.int64),
+                 checkpoint_data=np.frombuffer(b''.join(blobs), dtype=np.uint8),
+                 rom_file=self.log_config['rom_file'], frame_skip=self.log_config['frame_skip'],
+                 checkpoint_every=self.log_config['checkpoint_every'],
+                 count=self.count, current=self.current,
+                 agent_history_length=self.agent_history_length,
+                 frame_height=self.frame_height, frame_width=self.frame_width,
+                 num_heads=self.num_heads, bernoulli_probability=self.bernoulli_probability,
+                 )
+        print("finished saving buffer", time.time()-st)
+
+    def load_buffer(self, filepath, mmap=False):
+        st = time.time()
+        print("starting load of action log buffer from %s"%filepath, st)
+        npfile = np.load(filepath)
+        for name in ['actions', 'rewards', 'terminal_flags', 'history_breaks', 'anchors']:
+            setattr(self, name, npfile[name])
+        self.masks = None if npfile['hashed_masks'] else npfile['masks']
+        self.mask_seed = int(npfile['mask_seed'])
+        self.total_added = int(npfile['total_added'])
+        self.last_anchor = int(npfile['last_anchor'])
+        data = npfile['checkpoint_data'].tobytes()
+        ends = np.cumsum(npfile['checkpoint_lengths'])
+        self.checkpoints = {int(i): data[end - n:end] for i, n, end in
+                            zip(npfile['checkpoint_ids'], npfile['checkpoint_lengths'], ends)}
+        self.log_config.update({'rom_file': str(npfile['rom_file']), 'frame_skip': int(npfile['frame_skip']),
+                                'checkpoint_every': int(npfile['checkpoint_every'])})
+        self.count = int(npfile['count'])
+        self.current = int(npfile['current'])
+        self.agent_history_length = int(npfile['agent_history_length'])
+        self.frame_height = int(npfile['frame_height'])
+        self.frame_width = int(npfile['frame_width'])
+        self.num_heads = int(npfile['num_heads'])
+        self.bernoulli_probability = float(npfile['bernoulli_probability'])
+        self.size = self.actions.shape[0]
+        self.frames = self._allocate_frames()
+        print("finished loading buffer", time.time()-st)
+        print("loaded buffer current is", self.current)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+def is_action_log_buffer(filepath):
+    with np.load(filepath) as npfile:
+        return 'checkpoint_ids' in npfile.files
+
+def load_replay_buffer(filepath, num_heads=1, bernoulli_probability=1.0, mmap=False, n_workers=0, cache_frames=100000):
+    """
+    Load any saved buffer for sampling - an ActionLogReplayMemory when it was
+    saved by one, a ReplayMemory otherwise
+    Args:
+        mmap: bool, memory map a frame buffer, see ReplayMemory.load_buffer
+        n_workers: Integer, decode processes of an action log buffer. Leave at 0
+            in DataLoader workers, which are daemonic and cannot start a pool
+    """
+    if is_action_log_buffer(filepath):
+        # rom and frame skip come from the file
+        memory = ActionLogReplayMemory('', n_workers=n_workers, cache_frames=cache_frames, size=1,
+                                       num_heads=num_heads, bernoulli_probability=bernoulli_probability)
+    else:
+        memory = ReplayMemory(size=1, num_heads=num_heads, bernoulli_probability=bernoulli_probability)
+    memory.load_buffer(filepath, mmap=mmap)
+    return memory
+
+def fill_random(memory, env, n_transitions, seed=0):
+    """play uniformly random actions into memory - what a run's warm up adds"""
+    random_state = np.random.RandomState(seed)
+    frames = np.empty((n_transitions, memory.frame_height, memory.frame_width), dtype=np.uint8)
+    env.reset()
+    for i in range(n_transitions):
+        action = random_state.randint(0, env.num_actions)
+        memory.before_step(env)
+        state, reward, life_lost, terminal = env.step(action)
+        memory.add_experience(action, state[-1], np.sign(reward), life_lost)
+        frames[i] = state[-1]
+        if terminal:
+            env.reset()
+    return frames
+
+def benchmark_decode(rom_file, n_transitions=20000, checkpoint_everys=(25, 100, 400), worker_counts=(0, 4),
+                     batch_size=32, n_batches=50):
+    """bytes per transition and decode throughput of each checkpoint interval and worker count"""
+    import os
+    import tempfile
+    from env import Environment
+    for checkpoint_every in checkpoint_everys:
+        env = Environment(rom_file, keep_plot_frames=False)
+        memory = ActionLogReplayMemory(rom_file, env.frame_skip, checkpoint_every, n_workers=0, cache_frames=0,
+                                       size=n_transitions, batch_size=batch_size)
+        frames = fill_random(memory, env, n_transitions)
+        # a decoded frame must be the frame the env gave when it was played
+        check = np.random.RandomState(1).randint(memory.agent_history_length, n_transitions, 200)
+        assert (memory.take(check) == frames[check]).all(), 'decoded frames differ from the played ones'
+        # and the same once saved and loaded the way the offline readers load it
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filepath = os.path.join(tmpdir, 'action_log_buffer.npz')
+            memory.save_buffer(filepath)
+            loaded = load_replay_buffer(filepath, cache_frames=0)
+            assert (loaded.take(check) == frames[check]).all(), 'decoded frames differ after save and load'
+            print("saved buffer %.2f MB for %d transitions" % (os.path.getsize(filepath) / 2.**20, n_transitions))
+        per_transition = (memory.checkpoint_bytes() + n_transitions * (4 + 4 + 1 + 1 + 8)) / float(n_transitions)
+        print("checkpoint every %d: %.1f bytes/transition (%.0fx smaller than frames), %d ALE states of %.0f bytes" % (
+              checkpoint_every, per_transition, memory.frames.frame_bytes / per_transition,
+              len(memory.checkpoints), memory.checkpoint_bytes() / float(len(memory.checkpoints))))
+        for n_workers in worker_counts:
+            memory.log_config['n_workers'] = n_workers
+            memory.get_minibatch(batch_size)
+            memory.decode_report()
+            for _ in range(n_batches):
+                memory.get_minibatch(batch_size)
+            report = memory.decode_report()
+            print("    %d workers: %.0f transitions/sec, %.0f frames/sec decoded, %.1f emulator steps per frame" % (
+                  n_workers, report['transitions_per_sec'],
+                  report['transitions_per_sec'] * report['decoded_frames'] / float(n_batches * batch_size),
+                  report['emulator_steps'] / float(max(1, report['decoded_frames']))))
+            memory.close()
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('--rom', default='roms/pong.bin')
+    parser.add_argument('--n_transitions', default=20000, type=int)
+    parser.add_argument('--workers', default=4, type=int, help='decode processes to compare against decoding in process')
+    parser.add_argument('--n_batches', default=50, type=int)
+    args = parser.parse_args()
+    benchmark_decode(args.rom, args.n_transitions, worker_counts=(0, args.workers), n_batches=args.n_batches)
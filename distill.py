@@ -0,0 +1,185 @@
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+from dqn_utils import save_checkpoint, load_checkpoint, build_policy_net, n_actions_from_state_dict, evaluate_policy
+from export_policy import VotingPolicy, voting_policy_from_checkpoint
+from action_replay import load_replay_buffer
+
+# Distills a trained ensemble into one head. Acting with the teacher pays its
+# CoreNet and every head, twice over with a prior - the student is a plain
+# single head EnsembleNet, optionally with a narrower hidden layer, so its
+# checkpoint loads anywhere a trained one does (load_policy_net,
+# voting_policy_from_checkpoint, run_offline.evaluate_checkpoint).
+#
+# Targets are computed by the teacher on replay states as they are sampled:
+#   vote: cross entropy to the fraction of heads voting for each action
+#   q:    mean squared error to the heads' mean q values, prior included
+
+def student_info(info, hidden_size, teacher_path):
+    """info of the student checkpoint - the teacher's with a single, prior-less head"""
+    info = dict(info)
+    info.update({'N_ENSEMBLE': 1, 'VOTING_HEADS': 1, 'PRIOR': False,
+                 'HEAD_HIDDEN_SIZE': hidden_size, 'DISTILLED_FROM': teacher_path})
+    return info
+
+def build_student(teacher_net, info, n_actions, hidden_size, teacher_path, copy_core=True):
+    s_info = student_info(info, hidden_size, teacher_path)
+    student = build_policy_net(s_info, n_actions)
+    if copy_core:
+        # the teacher's learned features are a far better start than random convs
+        student.core_net.load_state_dict(teacher_net.core_net.state_dict())
+    return student, s_info
+
+def distill_loss(student_q, teacher_q, teacher_counts, target='vote', temperature=.1):
+    """
+    Args:
+        student_q: (batch, n_actions)
+        teacher_q: (n_ensemble, batch, n_actions)
+        teacher_counts: (batch, n_actions) heads voting for each action
+    """
+    if target == 'vote':
+        vote_dist = teacher_counts.float() / teacher_counts.sum(dim=1, keepdim=True)
+        return -(vote_dist * F.log_softmax(student_q / temperature, dim=1)).sum(dim=1).mean()
+    return F.mse_loss(student_q, teacher_q.mean(dim=0))
+
+def distill(teacher, student, replay_memory, n_updates, batch_size=32, lr=1e-4, target='vote',
+            temperature=.1, print_every=1000, eval_states=None):
+    """
+    Args:
+        teacher: VotingPolicy of the trained ensemble
+        student: single head EnsembleNet, trained in place
+        eval_states: uint8 states held out to report the student's agreement with the teacher vote on
+    """
+    student_policy = VotingPolicy(student, 1, teacher.n_actions, teacher.norm_by)
+    opt = torch.optim.Adam(student.parameters(), lr=lr)
+    losses = []
+    st = time.time()
+    for update in range(1, n_updates + 1):
+        states = torch.from_numpy(replay_memory.get_minibatch(batch_size)[0].copy())
+        with torch.no_grad():
+            teacher_q = teacher.q_values(states)
+            _, teacher_counts = teacher.vote(teacher_q)
+        student_q = student_policy.q_values(states)[0]
+        loss = distill_loss(student_q, teacher_q, teacher_counts, target, temperature)
+        opt.zero_grad()
+        loss.backward()
+        opt.step()
+        losses.append(loss.item())
+        if not update % print_every or update == n_updates:
+            msg = "update %d loss %.5f  %.1f updates/sec" % (update, np.mean(losses), len(losses) / (time.time() - st))
+            if eval_states is not None and len(eval_states):
+                msg += "  vote agreement %.4f" % agreement(teacher, student_policy, eval_states)
+            print(msg)
+            losses = []
+            st = time.time()
+    return student
+
+def holdout_states(replay_memory, n):
+    """
+    States of the n most recent transitions of replay_memory, which its
+    sampling then skips along with every transition sharing a frame with them
+    """
+    history = replay_memory.agent_history_length
+    current, count = int(replay_memory.current), int(replay_memory.count)
+    # the slots just behind the write head, or the end of the ring just after it wrapped
+    stop = current if current >= n + history else count
+    start = max(history, stop - n)
+    indices = [i for i in range(start, stop)
+               if not replay_memory.terminal_flags[i - history + 1:i].any()
+               and not replay_memory.history_breaks[i - history + 1:i].any()]
+    if not indices:
+        # nothing to hold out, eg --eval_size 0, so training samples the whole buffer
+        return np.empty((0, history, replay_memory.frame_height, replay_memory.frame_width), dtype=np.uint8)
+    slots = (np.array(indices)[:, None] + np.arange(-history + 1, 1)[None, :]).ravel()
+    if hasattr(replay_memory, 'take'):
+        # an action log replay decodes them
+        frames = replay_memory.take(slots)
+    else:
+        frames = np.asarray(replay_memory.frames[slots])
+    # a sampled transition uses frames index-history .. index
+    replay_memory.holdout = (start - history + 1, stop + history)
+    return frames.reshape(len(indices), history, replay_memory.frame_height, replay_memory.frame_width)
+
+def agreement(teacher, student_policy, states, batch_size=256):
+    same = 0
+    with torch.no_grad():
+        for i in range(0, len(states), batch_size):
+            frames = torch.from_numpy(np.ascontiguousarray(states[i:i+batch_size]))
+            same += (teacher(frames) == student_policy(frames)).sum().item()
+    return same / float(len(states))
+
+def act_latency(policy, state, n_timing=200):
+    """ms per single state action, which is what acting pays every env step"""
+    frames = torch.from_numpy(np.ascontiguousarray(state[None]))
+    with torch.no_grad():
+        policy(frames)
+        st = time.perf_counter()
+        for _ in range(n_timing):
+            policy(frames)
+    return 1000 * (time.perf_counter() - st) / n_timing
+
+def evaluate_return(policy, info, num_episodes):
+    from env import Environment
+    env = Environment(rom_file=info['GAME'], frame_skip=info['FRAME_SKIP'],
+                      num_frames=info['HISTORY_SIZE'], no_op_start=info['MAX_NO_OP_FRAMES'], rand_seed=info['SEED'],
+                      dead_as_end=info['DEAD_AS_END'], max_episode_steps=info['MAX_EPISODE_STEPS'],
+                      keep_plot_frames=False)
+    def get_action(state):
+        with torch.no_grad():
+            return policy(torch.from_numpy(state[None])).item()
+    return np.mean(evaluate_policy(env, get_action, num_episodes, info['EPS_EVAL'], np.random.RandomState(info['SEED'])))
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('-l', '--model_loadpath', required=True, help='.pkl teacher checkpoint full path')
+    parser.add_argument('-b', '--buffer_loadpath', default='', help='.npz replay buffer to distill on, defaults to the checkpoint buffer')
+    parser.add_argument('-o', '--output', default='', help='student .pkl path, defaults to the teacher path with _student')
+    parser.add_argument('-t', '--target', default='vote', choices=['vote', 'q'], help='match the vote distribution or the mean q values')
+    parser.add_argument('--hidden_size', default=512, type=int, help='hidden units of the student head, 512 as the teacher')
+    parser.add_argument('--temperature', default=.1, type=float, help='softmax temperature of the student q values for the vote target')
+    parser.add_argument('--random_core', action='store_true', default=False, help='start the student convs from scratch instead of the teacher\'s')
+    parser.add_argument('--n_updates', default=100000, type=int)
+    parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--lr', default=1e-4, type=float)
+    parser.add_argument('--eval_size', default=2048, type=int, help='held out states to measure vote agreement on, 0 to skip')
+    parser.add_argument('--num_eval_episodes', default=5, type=int, help='episodes to compare the returns of teacher and student on, 0 to skip')
+    parser.add_argument('--threads', default=2, type=int, help='torch cpu threads, run_bootstrap uses 2')
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+
+    model_dict = load_checkpoint(args.model_loadpath, map_location='cpu')
+    info = model_dict['info']
+    n_actions = n_actions_from_state_dict(model_dict['policy_net_state_dict'])
+    teacher = voting_policy_from_checkpoint(model_dict)
+    for param in teacher.parameters():
+        param.requires_grad = False
+    # an action log buffer decodes its frames in a pool while the student trains
+    replay_memory = load_replay_buffer(args.buffer_loadpath or args.model_loadpath.replace('.pkl', '_train_buffer.npz'),
+                                       info['N_ENSEMBLE'], info['BERNOULLI_PROBABILITY'], mmap=True, n_workers=4)
+    eval_states = holdout_states(replay_memory, args.eval_size)
+
+    student, s_info = build_student(teacher.policy_net, info, n_actions, args.hidden_size, args.model_loadpath,
+                                    copy_core=not args.random_core)
+    distill(teacher, student, replay_memory, args.n_updates, args.batch_size, args.lr, args.target,
+            args.temperature, eval_states=eval_states)
+    output = args.output or args.model_loadpath.replace('.pkl', '_student.pkl')
+    s_info['DISTILL_TARGET'] = args.target
+    save_checkpoint({'info': s_info,
+                     'cnt': model_dict['cnt'],
+                     'policy_net_state_dict': student.state_dict()}, output)
+    print("wrote student to %s" % output)
+
+    # reload the way evaluation does, so the report is of the checkpoint on disk
+    student_policy = voting_policy_from_checkpoint(load_checkpoint(output, map_location='cpu'))
+    if len(eval_states):
+        print("vote agreement on %d held out states %.4f" % (len(eval_states), agreement(teacher, student_policy, eval_states)))
+    for name, policy, p_info in [('teacher', teacher, info), ('student', student_policy, s_info)]:
+        n_params = sum(p.numel() for p in policy.parameters())
+        msg = "%-8s %10d params" % (name, n_params)
+        if len(eval_states):
+            msg += "  %.3f ms/step" % act_latency(policy, eval_states[0])
+        if args.num_eval_episodes:
+            msg += "  eval return %.2f" % evaluate_return(policy, p_info, args.num_eval_episodes)
+        print(msg)
@@ -0,0 +1,324 @@
+from __future__ import print_function
+import os
+import re
+import copy
+import time
+import datetime
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.optim as optim
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from dqn_model import NetWithPrior
+from dqn_utils import seed_everything, write_info_file, save_checkpoint, load_checkpoint, build_policy_net
+
+# Head sharded learner on cpu with the gloo backend. Every rank holds the
+# CoreNet and its own slice of the heads (with their prior and target heads)
+# and computes only those heads' losses on a minibatch that every rank draws
+# identically. The core gradients, which each rank only has its heads' part
+# of, are all-reduced, so the core steps the same way everywhere.
+
+# matches the head index in the state_dict keys of EnsembleNet and NetWithPrior
+HEAD_KEY = re.compile(r'(^|\.)net_list\.(\d+)\.')
+
+def head_shard(n_ensemble, rank, world_size):
+    """the heads rank trains - contiguous and as even as possible"""
+    return [int(k) for k in np.array_split(np.arange(n_ensemble), world_size)[rank]]
+
+def shard_net(net, heads):
+    """keep only heads in net_list, and in the prior's, in place"""
+    ensembles = [net.net, net.prior] if isinstance(net, NetWithPrior) and net.prior_scale > 0 else [getattr(net, 'net', net)]
+    for ensemble in ensembles:
+        ensemble.net_list = nn.ModuleList([ensemble.net_list[k] for k in heads])
+    return net
+
+def full_state_dict(net, heads, world_size):
+    """
+    The state_dict the unsharded net would have - head keys are renumbered to
+    their index in the full ensemble and gathered from every rank
+    """
+    core, local = {}, {}
+    for key, val in net.state_dict().items():
+        if HEAD_KEY.search(key):
+            key = HEAD_KEY.sub(lambda m: '%snet_list.%d.' % (m.group(1), heads[int(m.group(2))]), key, count=1)
+            local[key] = val
+        else:
+            core[key] = val
+    shards = [None for _ in range(world_size)]
+    dist.all_gather_object(shards, local)
+    for shard in shards:
+        core.update(shard)
+    return core
+
+def build_sharded_nets(info, n_actions, heads, model_dict=None):
+    """policy and target nets holding only heads, from the full nets every rank agrees on"""
+    seed_everything(info['SEED'])
+    policy_net = build_policy_net(info, n_actions, 'cpu')
+    if model_dict is not None:
+        policy_net.load_state_dict(model_dict['policy_net_state_dict'])
+    # ranks seed alike, but make sure they start from rank 0's weights
+    for tensor in policy_net.state_dict().values():
+        dist.broadcast(tensor, 0)
+    target_net = copy.deepcopy(policy_net)
+    if model_dict is not None:
+        target_net.load_state_dict(model_dict['target_net_state_dict'])
+    shard_net(policy_net, heads)
+    shard_net(target_net, heads)
+    if info['PRIOR']:
+        # policy and target share one prior, as in run_bootstrap
+        target_net.prior = policy_net.prior
+    return policy_net, target_net
+
+def sharded_learn(policy_net, target_net, opt, info, heads, states, actions, rewards, next_states, terminal_flags, masks):
+    """
+    The ptlearn update for this rank's heads. Returns the mean loss of the
+    heads used in the batch over all ranks
+    """
+    states = torch.as_tensor(states).float() / info['NORM_BY']
+    next_states = torch.as_tensor(next_states).float() / info['NORM_BY']
+    rewards = torch.as_tensor(rewards).float()
+    actions = torch.as_tensor(actions).long()
+    terminal_flags = torch.as_tensor(terminal_flags).float()
+    masks = torch.as_tensor(masks).float()[:, heads]
+    n_local = len(heads)
+
+    opt.zero_grad()
+    q_policy_vals = torch.stack(policy_net(states, None))
+    with torch.no_grad():
+        next_q_target_vals = torch.stack(target_net(next_states, None))
+        if info['DOUBLE_DQN']:
+            next_actions = torch.stack(policy_net(next_states, None)).max(2, True)[1]
+            next_qs = next_q_target_vals.gather(2, next_actions).squeeze(2)
+        else:
+            next_qs = next_q_target_vals.max(2)[0]
+    preds = q_policy_vals.gather(2, actions[None, :, None].expand(n_local, -1, 1)).squeeze(2)
+    targets = rewards[None] + info['GAMMA'] * next_qs * (1 - terminal_flags[None])
+    head_losses = F.smooth_l1_loss(preds, targets, reduction='none').mean(1)
+    used = (masks.sum(0) > 0).float()
+    # divided by the whole ensemble so the sum over ranks is ptlearn's loss
+    loss = (head_losses * used).sum() / info['N_ENSEMBLE']
+    loss.backward()
+
+    core_params = [p for p in policy_net.core_net.parameters() if p.grad is not None]
+    core_ids = set(id(p) for p in policy_net.core_net.parameters())
+    head_params = [p for p in policy_net.parameters() if p.grad is not None and id(p) not in core_ids]
+    # one all-reduce for the whole core gradient
+    core_grad = torch.cat([p.grad.view(-1) for p in core_params])
+    dist.all_reduce(core_grad)
+    # Divide grads in core, as ptlearn does
+    core_grad *= 1.0 / float(info['N_ENSEMBLE'])
+    offset = 0
+    for p in core_params:
+        p.grad.copy_(core_grad[offset:offset + p.numel()].view_as(p))
+        offset += p.numel()
+    # clip_grad_norm_ over the full net needs the head norms of every rank,
+    # they travel with the loss stats
+    stats = torch.stack([sum(p.grad.pow(2).sum() for p in head_params) if head_params else torch.zeros(()),
+                         (head_losses * used).sum().detach(), used.sum()])
+    dist.all_reduce(stats)
+    total_norm = (core_grad.pow(2).sum() + stats[0]).sqrt().item()
+    clip_coef = info['CLIP_GRAD'] / (total_norm + 1e-6)
+    if clip_coef < 1:
+        for p in core_params + head_params:
+            p.grad.mul_(clip_coef)
+    opt.step()
+    return stats[1].item() / max(1., stats[2].item())
+
+def train_worker(rank, world_size, info, port):
+    from torch.utils.data import DataLoader
+    from run_offline import BufferSampler, evaluate_checkpoint
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:%d' % port, rank=rank, world_size=world_size)
+    torch.set_num_threads(info['THREADS_PER_RANK'])
+    heads = head_shard(info['N_ENSEMBLE'], rank, world_size)
+    print("rank %d training heads %s" % (rank, heads))
+    model_dict = load_checkpoint(info['loaded_from'], map_location='cpu') if 'loaded_from' in info else None
+    policy_net, target_net = build_sharded_nets(info, info['N_ACTIONS'], heads, model_dict)
+    opt = optim.Adam(policy_net.parameters(), lr=info['ADAM_LEARNING_RATE'])
+    if model_dict is not None and len(model_dict.get('optimizer_shards', [])) == world_size:
+        opt.load_state_dict(model_dict['optimizer_shards'][rank])
+
+    # the same seed on every rank gives every rank the same minibatches
+    worker_kwargs = {'prefetch_factor': 4, 'persistent_workers': True} if info['NUM_WORKERS'] else {}
+    loader = DataLoader(BufferSampler(info['BUFFER_PATHS'], info['BATCH_SIZE'], info['N_ENSEMBLE'], info['SEED']),
+                        batch_size=None, num_workers=info['NUM_WORKERS'], **worker_kwargs)
+    model_base_filepath = os.path.join(info['MODEL_BASE_FILEDIR'], info['NAME'])
+    eval_process = None
+    losses = []
+    st = time.time()
+    for update, batch in enumerate(loader, start=1):
+        loss = sharded_learn(policy_net, target_net, opt, info, heads, *batch)
+        if not rank:
+            # only rank 0 reports, so only it keeps the losses
+            losses.append(loss)
+        if not update % info['TARGET_UPDATE']:
+            target_net.load_state_dict(policy_net.state_dict())
+        if not update % info['PRINT_EVERY'] and not rank:
+            et = time.time()
+            print("update %d loss %.5f  %.1f updates/sec on %d ranks" % (update, np.mean(losses), info['PRINT_EVERY'] / (et - st), world_size))
+            with open(os.path.join(info['MODEL_BASE_FILEDIR'], 'train_losses.txt'), 'a') as f:
+                print(update, np.mean(losses), file=f)
+            losses = []
+            st = et
+        if not update % info['EVAL_EVERY'] or update == info['MAX_UPDATES']:
+            # every rank takes part in the gathers, rank 0 writes the full nets
+            policy_state = full_state_dict(policy_net, heads, world_size)
+            target_state = full_state_dict(target_net, heads, world_size)
+            opt_shards = [None for _ in range(world_size)]
+            dist.all_gather_object(opt_shards, opt.state_dict())
+            if not rank:
+                filename = os.path.abspath(model_base_filepath + "_%010dq.pkl" % update)
+                save_checkpoint({'info': info,
+                                 'optimizer_shards': opt_shards,
+                                 'cnt': update,
+                                 'policy_net_state_dict': policy_state,
+                                 'target_net_state_dict': target_state}, filename)
+                if eval_process is not None and eval_process.is_alive():
+                    print("previous evaluation still running, skipping evaluation of %s" % filename)
+                else:
+                    eval_process = mp.get_context('spawn').Process(
+                        target=evaluate_checkpoint,
+                        args=(filename, os.path.join(info['MODEL_BASE_FILEDIR'], 'eval_rewards.txt'), info['NUM_EVAL_EPISODES']))
+                    eval_process.start()
+        if update >= info['MAX_UPDATES']:
+            break
+    if eval_process is not None:
+        eval_process.join()
+    dist.destroy_process_group()
+
+def benchmark_worker(rank, world_size, info, port, n_updates, results):
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:%d' % port, rank=rank, world_size=world_size)
+    torch.set_num_threads(info['THREADS_PER_RANK'])
+    heads = head_shard(info['N_ENSEMBLE'], rank, world_size)
+    policy_net, target_net = build_sharded_nets(info, info['N_ACTIONS'], heads)
+    opt = optim.Adam(policy_net.parameters(), lr=info['ADAM_LEARNING_RATE'])
+    random_state = np.random.RandomState(info['SEED'])
+    batch_size, size = info['BATCH_SIZE'], info['NETWORK_INPUT_SIZE'][0]
+    batch = (random_state.randint(0, 256, (batch_size, info['HISTORY_SIZE'], size, size)).astype(np.uint8),
+             random_state.randint(0, info['N_ACTIONS'], batch_size),
+             random_state.choice([-1., 0., 1.], batch_size).astype(np.float32),
+             random_state.randint(0, 256, (batch_size, info['HISTORY_SIZE'], size, size)).astype(np.uint8),
+             random_state.rand(batch_size) < 0.01,
+             random_state.rand(batch_size, info['N_ENSEMBLE']) < info['BERNOULLI_PROBABILITY'])
+    for _ in range(5):
+        sharded_learn(policy_net, target_net, opt, info, heads, *batch)
+    dist.barrier()
+    st = time.time()
+    for _ in range(n_updates):
+        sharded_learn(policy_net, target_net, opt, info, heads, *batch)
+    dist.barrier()
+    if not rank:
+        results.put(n_updates / (time.time() - st))
+    dist.destroy_process_group()
+
+def benchmark(info, world_sizes, n_updates, total_threads, port):
+    """learner updates/sec on synthetic batches for each number of ranks, given the same cpu threads"""
+    ctx = mp.get_context('spawn')
+    results = ctx.SimpleQueue()
+    rates = {}
+    for world_size in world_sizes:
+        info['THREADS_PER_RANK'] = max(1, total_threads // world_size)
+        mp.spawn(benchmark_worker, args=(world_size, info, port, n_updates, results), nprocs=world_size)
+        rates[world_size] = results.get()
+        print("%d ranks (%d threads each): %.2f updates/sec, %.2fx" % (
+              world_size, info['THREADS_PER_RANK'], rates[world_size], rates[world_size] / rates[world_sizes[0]]))
+    return rates
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('buffers', nargs='*', help='_train_buffer.npz files to learn from')
+    parser.add_argument('-w', '--world_size', default=2, type=int, help='learner processes, heads are split between them')
+    parser.add_argument('-l', '--model_loadpath', default='', help='.pkl checkpoint to start from and take settings from')
+    parser.add_argument('-n', '--name', default='distributed', help='start files with name')
+    parser.add_argument('--game', default='roms/pong.bin', help='rom the buffers were collected on')
+    parser.add_argument('--port', default=29500, type=int, help='local tcp port for the gloo rendezvous')
+    parser.add_argument('--workers', default=2, type=int, help='sampling processes per rank')
+    parser.add_argument('--threads', default=os.cpu_count(), type=int, help='torch threads split between the ranks')
+    parser.add_argument('--max_updates', default=int(1e6), type=int)
+    parser.add_argument('--eval_every', default=50000, type=int, help='updates between side process evaluations')
+    parser.add_argument('--lr', default=6.25e-5, type=float)
+    parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--gamma', default=.99, type=float)
+    parser.add_argument('--target_update', default=2500, type=int, help='updates between target net syncs, 10000 env steps online')
+    parser.add_argument('--prior_scale', default=10., type=float, help='0 for no prior')
+    parser.add_argument('--seed', default=101, type=int)
+    parser.add_argument('--benchmark', action='store_true', default=False, help='time updates on synthetic batches for 1, 2 and 4 ranks instead of training')
+    parser.add_argument('--n_ensemble', default=10, type=int, help='heads for --benchmark, training takes it from the buffers')
+    parser.add_argument('--n_actions', default=6, type=int, help='actions for --benchmark')
+    parser.add_argument('--benchmark_updates', default=50, type=int)
+    args = parser.parse_args()
+
+    info = {
+        "GAME": args.game,
+        "DEVICE": 'cpu',
+        "NAME": args.name,
+        "DUELING": True,
+        "DOUBLE_DQN": True,
+        "PRIOR": args.prior_scale > 0,
+        "PRIOR_SCALE": args.prior_scale,
+        "N_ENSEMBLE": args.n_ensemble,
+        "BERNOULLI_PROBABILITY": 0.9,
+        "TARGET_UPDATE": args.target_update,
+        "NORM_BY": 255.,
+        "EPS_EVAL": 0.0,
+        "NUM_EVAL_EPISODES": 1,
+        "EVAL_EVERY": args.eval_every,
+        "PRINT_EVERY": 1000,
+        "ADAM_LEARNING_RATE": args.lr,
+        "HISTORY_SIZE": 4,
+        "BATCH_SIZE": args.batch_size,
+        "GAMMA": args.gamma,
+        "CLIP_GRAD": 5,
+        "SEED": args.seed,
+        "NETWORK_INPUT_SIZE": (84, 84),
+        "MAX_UPDATES": args.max_updates,
+        "MAX_EPISODE_STEPS": 27000,
+        "FRAME_SKIP": 4,
+        "MAX_NO_OP_FRAMES": 30,
+        "DEAD_AS_END": True,
+        "NUM_WORKERS": args.workers,
+        "N_ACTIONS": args.n_actions,
+        "WORLD_SIZE": args.world_size,
+        "THREADS_PER_RANK": max(1, args.threads // args.world_size),
+    }
+
+    if args.benchmark:
+        benchmark(info, [1, 2, 4], args.benchmark_updates, args.threads, args.port)
+    else:
+        from env import Environment
+        import config
+        assert len(args.buffers), 'give at least one buffer to train from'
+        # header of the first buffer, the rest must match it
+        first = np.load(args.buffers[0])
+        info['N_ENSEMBLE'] = int(first['num_heads'])
+        info['BERNOULLI_PROBABILITY'] = float(first['bernoulli_probability'])
+        info['HISTORY_SIZE'] = int(first['agent_history_length'])
+        info['NETWORK_INPUT_SIZE'] = (int(first['frame_height']), int(first['frame_width']))
+        if args.model_loadpath:
+            model_dict = load_checkpoint(args.model_loadpath, map_location='cpu')
+            # the net shape and game come from the checkpoint, the learner settings from args
+            for key in ['GAME', 'DUELING', 'DOUBLE_DQN', 'PRIOR', 'PRIOR_SCALE', 'N_ENSEMBLE', 'NORM_BY',
+                        'HISTORY_SIZE', 'NETWORK_INPUT_SIZE', 'MAX_EPISODE_STEPS', 'FRAME_SKIP',
+                        'MAX_NO_OP_FRAMES', 'DEAD_AS_END', 'EPS_EVAL']:
+                info[key] = model_dict['info'][key]
+            info['loaded_from'] = os.path.abspath(args.model_loadpath)
+            del model_dict
+        assert info['N_ENSEMBLE'] >= args.world_size, 'every rank needs at least one head'
+        # the env is only needed for its action set here - it is not stepped
+        info['N_ACTIONS'] = Environment(rom_file=info['GAME']).num_actions
+        info['BUFFER_PATHS'] = [os.path.abspath(b) for b in args.buffers]
+        info['args'] = args
+        info['load_time'] = datetime.date.today().ctime()
+
+        run_num = 0
+        model_base_filedir = os.path.join(config.model_savedir, info['NAME'] + '%02d' % run_num)
+        while os.path.exists(model_base_filedir):
+            run_num += 1
+            model_base_filedir = os.path.join(config.model_savedir, info['NAME'] + '%02d' % run_num)
+        os.makedirs(model_base_filedir)
+        print(f"starting NEW distributed project: {model_base_filedir} on {args.world_size} ranks")
+        info['MODEL_BASE_FILEDIR'] = model_base_filedir
+        write_info_file(info, os.path.join(model_base_filedir, info['NAME']), 0)
+        mp.spawn(train_worker, args=(args.world_size, info, args.port), nprocs=args.world_size)
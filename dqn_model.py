@@ -5,7 +5,6 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
-from IPython import embed
 
 # from the DQN paper
 #The first convolution layer convolves the input with 32 filters of size 8 (stride 4),
@@ -52,10 +51,10 @@ class CoreNet(nn.Module):
         return x
 
 class DuelingHeadNet(nn.Module):
-    def __init__(self, n_actions=4):
+    def __init__(self, n_actions=4, hidden_size=512):
         super(DuelingHeadNet, self).__init__()
         mult = 64*7*7
-        self.split_size = 512
+        self.split_size = hidden_size
         self.fc1 = nn.Linear(mult, self.split_size*2)
         self.value = nn.Linear(self.split_size, 1)
         self.advantage = nn.Linear(self.split_size, n_actions)
@@ -73,11 +72,11 @@ class DuelingHeadNet(nn.Module):
         return q
 
 class HeadNet(nn.Module):
-    def __init__(self, n_actions=4):
+    def __init__(self, n_actions=4, hidden_size=512):
         super(HeadNet, self).__init__()
         mult = 64*7*7
-        self.fc1 = nn.Linear(mult, 512)
-        self.fc2 = nn.Linear(512, n_actions)
+        self.fc1 = nn.Linear(mult, hidden_size)
+        self.fc2 = nn.Linear(hidden_size, n_actions)
         self.fc1.apply(weights_init)
         self.fc2.apply(weights_init)
 
@@ -87,15 +86,15 @@ class HeadNet(nn.Module):
         return x
 
 class EnsembleNet(nn.Module):
-    def __init__(self, n_ensemble, n_actions, network_output_size, num_channels, dueling=False):
+    def __init__(self, n_ensemble, n_actions, network_output_size, num_channels, dueling=False, hidden_size=512):
         super(EnsembleNet, self).__init__()
         self.core_net = CoreNet(network_output_size=network_output_size, num_channels=num_channels)
         self.dueling = dueling
         if self.dueling:
             print("using dueling dqn")
-            self.net_list = nn.ModuleList([DuelingHeadNet(n_actions=n_actions) for k in range(n_ensemble)])
+            self.net_list = nn.ModuleList([DuelingHeadNet(n_actions=n_actions, hidden_size=hidden_size) for k in range(n_ensemble)])
         else:
-            self.net_list = nn.ModuleList([HeadNet(n_actions=n_actions) for k in range(n_ensemble)])
+            self.net_list = nn.ModuleList([HeadNet(n_actions=n_actions, hidden_size=hidden_size) for k in range(n_ensemble)])
 
     def _core(self, x):
         return self.core_net(x)
@@ -2,15 +2,53 @@ import numpy as np
 import torch
 import os
 import sys
-from imageio import mimsave
+from dqn_model import EnsembleNet, NetWithPrior
+from replay import bootstrap_masks
 #from skimage.transform import resize
-import cv2
 
 def save_checkpoint(state, filename='model.pkl'):
     print("starting save of model %s" %filename)
     torch.save(state, filename)
     print("finished save of model %s" %filename)
 
+def load_checkpoint(filename, map_location=None):
+    print("starting load of model %s" %filename)
+    try:
+        # checkpoints hold the info dict and argparse args, not just tensors
+        state = torch.load(filename, map_location=map_location, weights_only=False)
+    except TypeError:
+        # torch < 1.13 has no weights_only
+        state = torch.load(filename, map_location=map_location)
+    print("finished load of model %s" %filename)
+    return state
+
+def n_actions_from_state_dict(state_dict):
+    """number of actions the last layer of the first head was built with"""
+    for key in state_dict.keys():
+        if key.endswith('net_list.0.fc2.weight') or key.endswith('net_list.0.advantage.weight'):
+            return state_dict[key].shape[0]
+    raise ValueError("state_dict has no ensemble head")
+
+def build_policy_net(info, n_actions, device='cpu'):
+    """EnsembleNet, wrapped in NetWithPrior when info['PRIOR'] is set, as run_bootstrap builds it"""
+    def make_net():
+        return EnsembleNet(n_ensemble=info['N_ENSEMBLE'],
+                           n_actions=n_actions,
+                           network_output_size=info['NETWORK_INPUT_SIZE'][0],
+                           num_channels=info['HISTORY_SIZE'], dueling=info['DUELING'],
+                           hidden_size=info.get('HEAD_HIDDEN_SIZE', 512)).to(device)
+    net = make_net()
+    if info['PRIOR']:
+        net = NetWithPrior(net, make_net(), info['PRIOR_SCALE'])
+    return net
+
+def load_policy_net(model_dict, device='cpu'):
+    """rebuild the policy net of a checkpoint dict and load its weights"""
+    state_dict = model_dict['policy_net_state_dict']
+    policy_net = build_policy_net(model_dict['info'], n_actions_from_state_dict(state_dict), device)
+    policy_net.load_state_dict(state_dict)
+    return policy_net
+
 def seed_everything(seed=1234):
     #random.seed(seed)
     torch.manual_seed(seed)
@@ -19,9 +57,13 @@ def seed_everything(seed=1234):
     os.environ['PYTHONHASHSEED'] = str(seed)
     #torch.backends.cudnn.deterministic = True
 
-def handle_step(random_state, cnt, S_hist, S_prime, action, reward, finished, k_used, acts, episodic_reward, replay_buffer, checkpoint='', n_ensemble=1, bernoulli_p=1.0):
+def handle_step(random_state, cnt, S_hist, S_prime, action, reward, finished, k_used, acts, episodic_reward, replay_buffer, checkpoint='', n_ensemble=1, bernoulli_p=1.0, mask_seed=None):
     # mask to determine which head can use this experience
-    exp_mask = random_state.binomial(1, bernoulli_p, n_ensemble).astype(np.uint8)
+    if mask_seed is None:
+        exp_mask = random_state.binomial(1, bernoulli_p, n_ensemble).astype(np.uint8)
+    else:
+        # the same hashed mask ReplayMemory gives step cnt with hashed_masks
+        exp_mask = bootstrap_masks(mask_seed, [cnt], n_ensemble, bernoulli_p)[0].astype(np.uint8)
     # at this observed state
     experience =  [S_prime, action, reward, finished, exp_mask, k_used, acts, cnt]
     batch = replay_buffer.send((checkpoint, experience))
@@ -32,6 +74,36 @@ def handle_step(random_state, cnt, S_hist, S_prime, action, reward, finished, k_
     cnt+=1
     return cnt, S_hist, batch, episodic_reward
 
+def evaluate_policy(env, get_action, num_episodes=1, eps=0.0, random_state=None):
+    """
+    Play num_episodes on env the way run_bootstrap's evaluate does - fire
+    after a lost life, random action with probability eps, else get_action
+    Args:
+        env: Environment
+        get_action: function of a (4, 84, 84) uint8 state returning an action index
+    Returns:
+        list of episode rewards
+    """
+    if random_state is None:
+        random_state = np.random.RandomState(0)
+    eval_rewards = []
+    for i in range(num_episodes):
+        state = env.reset()
+        episode_reward_sum = 0
+        terminal = False
+        life_lost = True
+        while not terminal:
+            if life_lost:
+                action = 1
+            elif random_state.rand() < eps:
+                action = random_state.randint(0, env.num_actions)
+            else:
+                action = get_action(state)
+            state, reward, life_lost, terminal = env.step(action)
+            episode_reward_sum += reward
+        eval_rewards.append(episode_reward_sum)
+    return eval_rewards
+
 def linearly_decaying_epsilon(decay_period, step, warmup_steps, epsilon):
     """ from dopamine - Returns the current epsilon for the agent's epsilon-greedy policy.
     This follows the Nature DQN schedule of a linearly decaying epsilon (Mnih et
@@ -68,6 +140,9 @@ def generate_gif(base_dir, step_number, frames_for_gif, reward, name='', results
             reward: Integer, Total reward of the episode that es ouputted as a gif
             path: String, path where gif is saved
     """
+    # imported here so startup does not pay for them before the first eval
+    from imageio import mimsave
+    import cv2
     for idx, frame_idx in enumerate(frames_for_gif):
         frames_for_gif[idx] = cv2.resize(frame_idx, (320, 220)).astype(np.uint8)
 
@@ -3,6 +3,10 @@ from collections import deque
 import numpy as np
 from ale_py import ALEInterface
 import cv2
+import live_metrics
+
+ENV_STEPS = live_metrics.counter('env_steps', 'emulator steps taken, frame skip included once')
+ENV_EPISODES = live_metrics.counter('env_episodes', 'episodes started')
 
 def cv_preprocess_frame(observ, output_size):
     gray = cv2.cvtColor(observ, cv2.COLOR_RGB2GRAY)
@@ -18,8 +22,11 @@ class Environment(object):
                  no_op_start=30,
                  rand_seed=393,
                  dead_as_end=True,
-                 max_episode_steps=18000):
+                 max_episode_steps=18000,
+                 keep_plot_frames=True):
         self.max_episode_steps = max_episode_steps
+        # every screen of the episode - up to ~130KB a step
+        self.keep_plot_frames = keep_plot_frames
         self.random_state = np.random.RandomState(rand_seed+15)
         self.ale = self._init_ale(rand_seed, rom_file)
         self.actions = self.ale.getMinimalActionSet()
@@ -60,6 +67,7 @@ class Environment(object):
         return frame
 
     def reset(self):
+        ENV_EPISODES.inc()
         self.steps = 0
         self.end = False
         self.plot_frames = []
@@ -79,10 +87,11 @@ class Environment(object):
             self.ale.act(0)
 
         self.frame_queue.append(self._get_current_frame())
-        self.plot_frames.append(self.prev_screen)
-        a = np.array(self.frame_queue)
-        out = np.concatenate((a[0], a[1], a[2], a[3]), axis=0).T
-        self.gray_plot_frames.append(out)
+        if self.keep_plot_frames:
+            self.plot_frames.append(self.prev_screen)
+            a = np.array(self.frame_queue)
+            out = np.concatenate((a[0], a[1], a[2], a[3]), axis=0).T
+            self.gray_plot_frames.append(out)
         if self.ale.game_over():
             print("Unexpected game over in reset", self.reset())
         return np.array(self.frame_queue)
@@ -112,15 +121,17 @@ class Environment(object):
             self.end = True
             lives_dead = True
         self.steps += 1
+        ENV_STEPS.inc()
         if self.steps >= self.max_episode_steps:
             self.end = True
             lives_dead = True
         self.frame_queue.append(self._get_current_frame())
         self.total_reward += reward
-        a = np.array(self.frame_queue)
         self.prev_screen = self.ale.getScreenRGB()
-        self.gray_plot_frames.append(np.concatenate((a[0], a[1], a[2], a[3]), axis=0))
-        self.plot_frames.append(self.prev_screen)
+        if self.keep_plot_frames:
+            a = np.array(self.frame_queue)
+            self.gray_plot_frames.append(np.concatenate((a[0], a[1], a[2], a[3]), axis=0))
+            self.plot_frames.append(self.prev_screen)
         return np.array(self.frame_queue), reward, lives_dead, self.end
 
 
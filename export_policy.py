@@ -0,0 +1,135 @@
+import os
+import time
+import numpy as np
+from collections import Counter
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from dqn_utils import load_checkpoint, load_policy_net, n_actions_from_state_dict
+
+class VotingPolicy(nn.Module):
+    """Self contained acting policy: uint8 frames in, voted action out.
+
+    Does what ActionGetter.pt_get_action does with eps=0 and every head voting,
+    but batched and without python in the loop: scale by NORM_BY, run the net
+    (prior included), take each head's argmax and vote. Ties go to the action
+    whose first vote came from the lowest head, as with Counter.most_common.
+    """
+    def __init__(self, policy_net, n_ensemble, n_actions, norm_by=255.):
+        super(VotingPolicy, self).__init__()
+        self.policy_net = policy_net
+        self.n_ensemble = n_ensemble
+        self.n_actions = n_actions
+        self.norm_by = norm_by
+        self.register_buffer('head_index', torch.arange(n_ensemble)[:, None, None])
+
+    def q_values(self, x):
+        """(n_ensemble, batch, n_actions) q values of uint8 frames x"""
+        # divide in float64 like pt_get_action so the argmaxes match it exactly
+        x = (x.to(torch.float64) / self.norm_by).to(torch.float32)
+        return torch.stack(self.policy_net(x, None), dim=0)
+
+    def vote(self, q):
+        """voted action of each state in q and how many heads voted for each action"""
+        # (n_ensemble, batch, n_actions) vote per head
+        votes = F.one_hot(q.argmax(dim=2), self.n_actions)
+        counts = votes.sum(dim=0)
+        first_vote = torch.where(votes > 0, self.head_index, self.n_ensemble).min(dim=0)[0]
+        score = counts * (self.n_ensemble + 1) + (self.n_ensemble - first_vote)
+        return score.argmax(dim=1), counts
+
+    def forward(self, x):
+        return self.vote(self.q_values(x))[0]
+
+def voting_policy_from_checkpoint(model_dict):
+    info = model_dict['info']
+    policy_net = load_policy_net(model_dict, 'cpu')
+    n_actions = n_actions_from_state_dict(model_dict['policy_net_state_dict'])
+    return VotingPolicy(policy_net, info['N_ENSEMBLE'], n_actions, float(info['NORM_BY'])).eval()
+
+def export_torchscript(policy, filename, history_size=4, frame_size=84):
+    example = torch.zeros((1, history_size, frame_size, frame_size), dtype=torch.uint8)
+    with torch.no_grad():
+        traced = torch.jit.trace(policy, example)
+        # freezing inlines the weights - the prior is constant and gets folded
+        # into the graph with the rest of the parameters
+        traced = torch.jit.freeze(traced)
+    traced.save(filename)
+    print("wrote torchscript policy to %s" % filename)
+    return traced
+
+def export_onnx(policy, filename, history_size=4, frame_size=84):
+    example = torch.zeros((1, history_size, frame_size, frame_size), dtype=torch.uint8)
+    with torch.no_grad():
+        torch.onnx.export(policy, example, filename, input_names=['frames'], output_names=['action'],
+                          dynamic_axes={'frames': {0: 'batch'}, 'action': {0: 'batch'}})
+    print("wrote onnx policy to %s" % filename)
+
+def eager_actions(policy_net, states, n_ensemble, norm_by):
+    """the pt_get_action path - one state at a time with a python vote"""
+    actions = []
+    for state in states:
+        state = torch.Tensor(state.astype(float) / norm_by)[None, :]
+        vals = policy_net(state, None)
+        acts = [torch.argmax(vals[h], dim=1).item() for h in range(n_ensemble)]
+        actions.append(Counter(acts).most_common(1)[0][0])
+    return np.array(actions)
+
+def eager_batch_actions(policy_net, states, n_ensemble, norm_by):
+    """batched forward with the python vote, the best the eager model can do"""
+    state = torch.Tensor(states.astype(float) / norm_by)
+    vals = torch.stack(policy_net(state, None), dim=0).argmax(dim=2).numpy()
+    return np.array([Counter(vals[:, b]).most_common(1)[0][0] for b in range(vals.shape[1])])
+
+def benchmark(policy, exported, states, n_runs=200, batch_size=32):
+    policy_net = policy.policy_net
+    n_ensemble, norm_by = policy.n_ensemble, policy.norm_by
+    with torch.no_grad():
+        expected = eager_actions(policy_net, states, n_ensemble, norm_by)
+        got = exported(torch.from_numpy(states)).numpy()
+        print("exported actions agree with eager on %d/%d states" % ((expected == got).sum(), len(states)))
+
+        def timeit(name, fn, n, batch):
+            fn()
+            st = time.time()
+            for _ in range(n):
+                fn()
+            et = time.time() - st
+            print("%-28s latency %7.3f ms/call  throughput %8.1f states/sec" % (name, 1000*et/n, n*batch/et))
+
+        one = states[:1]
+        batch = states[:batch_size]
+        timeit("eager batch=1", lambda: eager_actions(policy_net, one, n_ensemble, norm_by), n_runs, 1)
+        timeit("exported batch=1", lambda: exported(torch.from_numpy(one)), n_runs, 1)
+        timeit("eager batch=%d" % len(batch), lambda: eager_batch_actions(policy_net, batch, n_ensemble, norm_by), n_runs//4, len(batch))
+        timeit("exported batch=%d" % len(batch), lambda: exported(torch.from_numpy(batch)), n_runs//4, len(batch))
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('-l', '--model_loadpath', required=True, help='.pkl model file full path')
+    parser.add_argument('-o', '--output', default='', help='torchscript file to write, defaults to the checkpoint name with _policy.pt')
+    parser.add_argument('--onnx', action='store_true', default=False, help='also write an onnx model next to the torchscript one')
+    parser.add_argument('--bench', action='store_true', default=False, help='compare latency and throughput with the eager model on cpu')
+    parser.add_argument('-b', '--buffer_loadpath', default='', help='.npz replay buffer to take benchmark states from, random frames otherwise')
+    parser.add_argument('--threads', default=2, type=int, help='torch cpu threads, run_bootstrap uses 2')
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+
+    model_dict = load_checkpoint(args.model_loadpath, map_location='cpu')
+    info = model_dict['info']
+    policy = voting_policy_from_checkpoint(model_dict)
+    output = args.output or args.model_loadpath.replace('.pkl', '_policy.pt')
+    exported = export_torchscript(policy, output, info['HISTORY_SIZE'], info['NETWORK_INPUT_SIZE'][0])
+    if args.onnx:
+        export_onnx(policy, os.path.splitext(output)[0] + '.onnx', info['HISTORY_SIZE'], info['NETWORK_INPUT_SIZE'][0])
+
+    if args.bench:
+        if args.buffer_loadpath:
+            from action_replay import load_replay_buffer
+            replay_memory = load_replay_buffer(args.buffer_loadpath, info['N_ENSEMBLE'], info['BERNOULLI_PROBABILITY'])
+            states = replay_memory.get_minibatch(256)[0].copy()
+        else:
+            random_state = np.random.RandomState(info['SEED'])
+            states = random_state.randint(0, 256, (256, info['HISTORY_SIZE'], 84, 84)).astype(np.uint8)
+        benchmark(policy, torch.jit.load(output), states)
@@ -0,0 +1,202 @@
+import time
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# In-process counters, gauges and histograms, served in the Prometheus text
+# format by a background http thread. Updates are plain attribute writes
+# with no lock - each metric is only written from one thread, and a scrape
+# reading a value mid-update only ever sees the old or the new one.
+
+PREFIX = 'bootstrap_dqn_'
+
+class Counter:
+    kind = 'counter'
+    def __init__(self, name, help):
+        self.name, self.help = name, help
+        # HELP and TYPE go under the sample name, as prometheus_client writes them
+        self.family = name + '_total'
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self):
+        return [(self.name + '_total', self.value)]
+
+class Gauge:
+    kind = 'gauge'
+    def __init__(self, name, help, function=None):
+        """function: called at scrape time for the value instead of set()"""
+        self.name = self.family = name
+        self.help = help
+        self.value = 0.
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self):
+        return [(self.name, self.function() if self.function is not None else self.value)]
+
+class Histogram:
+    kind = 'histogram'
+    def __init__(self, name, help, buckets=(.001, .005, .01, .05, .1, .5, 1., 5., 30., 120.)):
+        self.name = self.family = name
+        self.help = help
+        self.buckets = list(buckets)
+        # the last count is the +Inf bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def time(self):
+        """context that observes how long its block took"""
+        return _Timer(self)
+
+    def samples(self):
+        samples, total = [], 0
+        for bound, count in zip(self.buckets + ['+Inf'], self.counts):
+            total += count
+            samples.append(('%s_bucket{le="%s"}' % (self.name, bound), total))
+        samples.append((self.name + '_sum', self.sum))
+        samples.append((self.name + '_count', total))
+        return samples
+
+class _Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.st = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.st)
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, help, **kwargs):
+        # the same name gives the same metric, so modules can declare theirs at import
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(PREFIX + name, help, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, help=''):
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help='', function=None):
+        gauge = self._get(Gauge, name, help)
+        if function is not None:
+            gauge.set_function(function)
+        return gauge
+
+    def histogram(self, name, help='', **kwargs):
+        return self._get(Histogram, name, help, **kwargs)
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append('# HELP %s %s' % (metric.family, metric.help))
+            lines.append('# TYPE %s %s' % (metric.family, metric.kind))
+            for name, value in metric.samples():
+                lines.append('%s %s' % (name, float(value)))
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        # scrapes every few seconds would flood the training output
+        pass
+
+def serve(port, registry=REGISTRY, host='127.0.0.1'):
+    """serve registry at http://host:port/metrics from a daemon thread"""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    print("serving live metrics on http://%s:%d/metrics" % (host, port))
+    return server
+
+class _NoMetric:
+    """stands in for a hook's metric to time the code without it"""
+    def inc(self, n=1):
+        pass
+
+    def observe(self, value):
+        pass
+
+def _time_steps(env, memory, n_steps, batch_size=32, learn_every=4):
+    """seconds per step of the training loop's env step, replay add and, every learn_every steps, sample"""
+    env.reset()
+    st = time.perf_counter()
+    for i in range(n_steps):
+        state, reward, life_lost, end = env.step(i % env.num_actions)
+        memory.add_experience(i % env.num_actions, state[-1], reward, life_lost)
+        if not i % learn_every and memory.count > batch_size + memory.agent_history_length:
+            memory.get_minibatch(batch_size)
+        if end:
+            env.reset()
+    return (time.perf_counter() - st) / n_steps
+
+def benchmark(rom_file, n_steps=5000, n_rounds=5):
+    """step time of the real env and replay with their hooks, against the same code with the hooks stubbed out"""
+    import env as env_module
+    import replay as replay_module
+    from env import Environment
+    from replay import ReplayMemory
+    hooks = [(env_module, 'ENV_STEPS'), (env_module, 'ENV_EPISODES'), (replay_module, 'REPLAY_ADDED'),
+             (replay_module, 'REPLAY_SAMPLED'), (replay_module, 'REPLAY_SAMPLE_SECONDS')]
+    metrics = [getattr(module, name) for module, name in hooks]
+    env = Environment(rom_file, keep_plot_frames=False)
+    memory = ReplayMemory(size=n_steps * n_rounds * 2)
+    _time_steps(env, memory, n_steps)
+    with_hooks, without_hooks = [], []
+    # interleaved rounds so drift in the machine's speed hits both alike
+    for _ in range(n_rounds):
+        with_hooks.append(_time_steps(env, memory, n_steps))
+        for module, name in hooks:
+            setattr(module, name, _NoMetric())
+        try:
+            without_hooks.append(_time_steps(env, memory, n_steps))
+        finally:
+            for (module, name), metric in zip(hooks, metrics):
+                setattr(module, name, metric)
+    step_time, base_time = min(with_hooks), min(without_hooks)
+    print("step %.1f us with hooks, %.1f us without, hooks are %.3f%% of a step" % (
+          1e6 * step_time, 1e6 * base_time, 100 * (step_time - base_time) / base_time))
+    st = time.perf_counter()
+    for _ in range(100):
+        REGISTRY.render()
+    print("a scrape %.3f ms" % (1e3 * (time.perf_counter() - st) / 100))
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('--rom', default='roms/pong.bin', help='rom to time env steps on')
+    parser.add_argument('--n_steps', default=5000, type=int, help='steps per timed round')
+    args = parser.parse_args()
+    benchmark(args.rom, args.n_steps)
@@ -0,0 +1,178 @@
+import os
+import numpy as np
+
+# Projected and measured memory of a training run. plan_memory works from
+# info alone, before anything is allocated - the replay arrays come from
+# calloc and are only paid for as the ring is written, so an oversized buffer
+# otherwise only OOMs hours into a run. measure_memory reports what each
+# component holds at runtime next to the process RSS.
+
+GB = float(1 << 30)
+# layer sizes of dqn_model - CoreNet ends in 64*7*7 features
+CORE_OUT = 64*7*7
+# pickled ALE cloneState() of an action log replay - an upper estimate, the
+# action_replay.py benchmark prints the real size for a rom
+ALE_STATE_BYTES = 4096
+# an action log stores a state after every lost life as well - random play
+# loses a life every few dozen steps in the shortest games
+MIN_LIFE_STEPS = 50
+
+def replay_bytes_per_transition(info):
+    """frame, action, reward, terminal flag, mask and history break of one transition"""
+    height, width = info['NETWORK_INPUT_SIZE']
+    mask_bytes = 0 if info.get('HASHED_MASKS', False) else info['N_ENSEMBLE']
+    return height*width + 4 + 4 + 1 + mask_bytes + 1
+
+def ensemble_params(info, n_actions):
+    """parameters of one EnsembleNet as dqn_model builds it"""
+    history, hidden = info['HISTORY_SIZE'], info.get('HEAD_HIDDEN_SIZE', 512)
+    core = (history*32*8*8 + 32) + (32*64*4*4 + 64) + (64*64*3*3 + 64)
+    if info['DUELING']:
+        head = (CORE_OUT*2*hidden + 2*hidden) + (hidden + 1) + (hidden*n_actions + n_actions)
+    else:
+        head = (CORE_OUT*hidden + hidden) + (hidden*n_actions + n_actions)
+    return core, head
+
+def plan_memory(info, n_actions, frames_in_ram=None, transitions_in_ram=None):
+    """
+    Projected peak bytes of each component of a run_bootstrap run
+    Args:
+        info: the run's info dict
+        n_actions: Integer, actions of the game
+        frames_in_ram: Integer, replay frames held in RAM - BUFFER_SIZE by
+            default, fewer for a tiered buffer and 0 with a replay server
+        transitions_in_ram: Integer, transitions whose actions, rewards, flags
+            and masks are held in RAM - BUFFER_SIZE by default, as a tiered
+            buffer only moves frames to disk, and 0 with a replay server
+    """
+    if frames_in_ram is None:
+        frames_in_ram = info['BUFFER_SIZE']
+    if transitions_in_ram is None:
+        transitions_in_ram = info['BUFFER_SIZE']
+    height, width = info['NETWORK_INPUT_SIZE']
+    batch, history, n_ensemble = info['BATCH_SIZE'], info['HISTORY_SIZE'], info['N_ENSEMBLE']
+    core, head = ensemble_params(info, n_actions)
+    net_params = core + n_ensemble*head
+    # policy and target, plus the prior they share
+    n_nets = 3 if info['PRIOR'] else 2
+    state_bytes = batch*history*height*width
+    # forward activations kept per sample: the three convs and each head's hidden layer
+    hidden = info.get('HEAD_HIDDEN_SIZE', 512)
+    head_acts = 2*hidden + 1 + n_actions if info['DUELING'] else hidden + n_actions
+    acts_per_sample = 32*20*20 + 64*9*9 + CORE_OUT + n_ensemble*head_acts
+    # ptlearn runs policy and target on next_states and policy on states, each
+    # with the prior as well when there is one, and backprops through the last
+    n_forwards = 3 * (2 if info['PRIOR'] else 1) + 1
+    # Environment keeps an RGB screen and a gray strip for every step of an episode
+    env_frames = info['MAX_EPISODE_STEPS']*(210*160*3 + history*height*width) if info.get('KEEP_PLOT_FRAMES', True) else 0
+    side_bytes = replay_bytes_per_transition(info) - height*width
+    if info.get('ACTION_LOG', False):
+        # no frame ring: the decoded frame cache, an anchor per transition and the ALE states
+        n_states = transitions_in_ram * (1. / info['ACTION_LOG_CHECKPOINT_EVERY'] + 1. / MIN_LIFE_STEPS)
+        replay = frames_in_ram*height*width + transitions_in_ram*(side_bytes + 8) + int(n_states * ALE_STATE_BYTES)
+    else:
+        replay = frames_in_ram*height*width + transitions_in_ram*side_bytes
+    return {
+        'replay': replay,
+        'batch_buffers': 2*state_bytes,
+        'nets': 4*n_nets*net_params,
+        # the grads and Adam's two moments of policy_net - the prior gets no grads
+        'optimizer': 4*3*net_params,
+        # astype(float) float64 copies and the float32 tensors of states and next_states
+        'ptlearn_inputs': 2*state_bytes*(8 + 4),
+        'activations': 4*batch*acts_per_sample*n_forwards,
+        'env_frames': env_frames,
+        # eval keeps every RGB screen of its first episode for the gif
+        'eval_gif_frames': info['MAX_EPISODE_STEPS']*210*160*3,
+    }
+
+def available_memory():
+    """MemAvailable from /proc/meminfo, or None where there is none"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        return None
+    return None
+
+def format_plan(plan):
+    lines = ['%16s %8.2f GB' % (name, nbytes / GB) for name, nbytes in plan.items()]
+    lines.append('%16s %8.2f GB' % ('total', sum(plan.values()) / GB))
+    return '\n'.join(lines)
+
+def fit_to_budget(info, n_actions, budget, auto_size=False, frames_in_ram=None, transitions_in_ram=None):
+    """
+    Checks the planned peak of the run against budget bytes. When it is over,
+    raises MemoryError, or with auto_size shrinks info['BUFFER_SIZE'] until it
+    fits - only when the whole buffer is in RAM
+    Returns:
+        the plan the run will use
+    """
+    plan = plan_memory(info, n_actions, frames_in_ram, transitions_in_ram)
+    total = sum(plan.values())
+    if total <= budget:
+        return plan
+    excess = total - budget
+    in_ram = (None, info['BUFFER_SIZE'])
+    if not auto_size or frames_in_ram not in in_ram or transitions_in_ram not in in_ram:
+        raise MemoryError('run needs %.2f GB but the budget is %.2f GB:\n%s' % (total / GB, budget / GB, format_plan(plan)))
+    per_transition = replay_bytes_per_transition(info)
+    buffer_size = info['BUFFER_SIZE'] - int(np.ceil(excess / float(per_transition)))
+    if buffer_size < info['MIN_HISTORY_TO_LEARN']:
+        raise MemoryError('even a %d transition buffer would not fit in %.2f GB:\n%s' % (
+                          info['MIN_HISTORY_TO_LEARN'], budget / GB, format_plan(plan)))
+    print("memory budget %.2f GB: BUFFER_SIZE reduced from %d to %d" % (budget / GB, info['BUFFER_SIZE'], buffer_size))
+    info['BUFFER_SIZE'] = buffer_size
+    # the whole, now smaller, buffer is in RAM
+    return plan_memory(info, n_actions)
+
+def process_rss():
+    """resident set size of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, ValueError):
+        import resource
+        # peak rather than current where there is no /proc
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def replay_resident_bytes(replay_memory):
+    """bytes of replay written so far - the untouched rest of the ring is not resident"""
+    if not hasattr(replay_memory, 'frames'):
+        # a ReplayClient, the server holds the buffer
+        return 0
+    per_transition = replay_bytes_per_transition({'NETWORK_INPUT_SIZE': (replay_memory.frame_height, replay_memory.frame_width),
+                                                  'N_ENSEMBLE': replay_memory.num_heads,
+                                                  'HASHED_MASKS': replay_memory.masks is None})
+    frames = replay_memory.frames
+    if hasattr(replay_memory, 'checkpoints'):
+        # action log - ALE states and the decoded frame cache instead of a frame ring
+        return (int(replay_memory.count) * (per_transition - frames.frame_bytes + 8) +
+                replay_memory.checkpoint_bytes() + frames.nbytes)
+    if hasattr(frames, 'ram'):
+        # tiered - only the RAM and cached segments are resident
+        frame_bytes = sum(a.nbytes for a in list(frames.ram.values()) + list(frames.cache.values()))
+        return frame_bytes + int(replay_memory.count) * (per_transition - frames.frame_bytes)
+    return int(replay_memory.count) * per_transition
+
+def tensor_bytes(tensors):
+    seen = {}
+    for t in tensors:
+        seen[t.data_ptr()] = t.numel() * t.element_size()
+    return sum(seen.values())
+
+def measure_memory(replay_memory=None, nets=(), opt=None, env=None):
+    """bytes held by each component now, what is left of RSS is 'other'"""
+    usage = {'replay': replay_resident_bytes(replay_memory) if replay_memory is not None else 0,
+             'nets': tensor_bytes([t for net in nets for t in net.state_dict().values()]),
+             'optimizer': 0, 'env_frames': 0}
+    if opt is not None:
+        usage['optimizer'] = tensor_bytes([v for state in opt.state.values() for v in state.values() if hasattr(v, 'numel')] +
+                                          [p.grad for group in opt.param_groups for p in group['params'] if p.grad is not None])
+    if env is not None:
+        usage['env_frames'] = sum(f.nbytes for f in getattr(env, 'plot_frames', []) + getattr(env, 'gray_plot_frames', []))
+    usage['rss'] = process_rss()
+    usage['other'] = max(0, usage['rss'] - sum(v for k, v in usage.items() if k != 'rss'))
+    return usage
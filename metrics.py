@@ -0,0 +1,233 @@
+import os
+from collections import deque
+import numpy as np
+
+# Training metrics as typed columns appended to raw binary files on disk - one
+# <table>.<column>.bin per column, written a chunk at a time. Checkpoints only
+# record how many rows each table had, so their size no longer grows with the
+# run, and a resumed run truncates the log back to that point.
+
+EPISODE_COLUMNS = [('steps', np.int64),
+                   ('episode_step', np.int64),
+                   ('episode_head', np.int16),  # one column per voting head
+                   ('eps_list', np.float32),
+                   ('episode_loss', np.float32),
+                   ('episode_reward', np.float64),
+                   ('episode_times', np.float32),
+                   ('episode_relative_times', np.float64),
+                   ('avg_rewards', np.float64)]
+EVAL_COLUMNS = [('eval_steps', np.int64),
+                ('eval_rewards', np.float64)]
+# bytes, from memory_budget.measure_memory
+MEMORY_COLUMNS = [('memory_steps', np.int64),
+                  ('rss', np.int64),
+                  ('replay', np.int64),
+                  ('nets', np.int64),
+                  ('optimizer', np.int64),
+                  ('env_frames', np.int64),
+                  ('other', np.int64)]
+
+class MetricsTable:
+    """Append only table of fixed width numpy columns backed by files in dirpath"""
+    def __init__(self, dirpath, name, columns, widths=None, chunk_size=256):
+        """
+        Args:
+            dirpath: String, directory holding the column files
+            name: String, prefix of this table's files
+            columns: list of (column name, numpy dtype)
+            widths: dict of column name to number of values per row, default 1
+            chunk_size: Integer, rows kept in memory before they are appended to disk
+        """
+        widths = widths or {}
+        self.name = name
+        self.chunk_size = chunk_size
+        self.dtypes = {col: np.dtype(dtype) for col, dtype in columns}
+        self.widths = {col: widths.get(col, 1) for col, _ in columns}
+        self.paths = {col: os.path.join(dirpath, '%s.%s.bin' % (name, col)) for col, _ in columns}
+        self.chunk = {col: np.zeros((chunk_size, self.widths[col]), dtype=self.dtypes[col]) for col, _ in columns}
+        self.chunk_rows = 0
+        rows = [self._rows_on_disk(col) for col, _ in columns]
+        # a crash between column writes can leave the files uneven
+        self.disk_rows = min(rows)
+        if max(rows) != self.disk_rows:
+            self.truncate(self.disk_rows)
+
+    def _rows_on_disk(self, col):
+        if not os.path.exists(self.paths[col]):
+            return 0
+        return os.path.getsize(self.paths[col]) // (self.dtypes[col].itemsize * self.widths[col])
+
+    def __len__(self):
+        return self.disk_rows + self.chunk_rows
+
+    def append(self, **row):
+        for col, val in row.items():
+            self.chunk[col][self.chunk_rows] = val
+        self.chunk_rows += 1
+        if self.chunk_rows == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.chunk_rows:
+            for col, chunk in self.chunk.items():
+                with open(self.paths[col], 'ab') as f:
+                    chunk[:self.chunk_rows].tofile(f)
+            self.disk_rows += self.chunk_rows
+            self.chunk_rows = 0
+
+    def truncate(self, n_rows):
+        """drop everything after the first n_rows rows"""
+        self.flush()
+        for col in self.paths:
+            if os.path.exists(self.paths[col]):
+                with open(self.paths[col], 'r+b') as f:
+                    f.truncate(n_rows * self.dtypes[col].itemsize * self.widths[col])
+        self.disk_rows = min(self.disk_rows, n_rows)
+
+    def tail(self, col, n):
+        """last n values of col, reading only those rows from disk"""
+        n = min(n, len(self))
+        from_chunk = min(n, self.chunk_rows)
+        from_disk = n - from_chunk
+        parts = []
+        if from_disk:
+            row_bytes = self.dtypes[col].itemsize * self.widths[col]
+            with open(self.paths[col], 'rb') as f:
+                f.seek((self.disk_rows - from_disk) * row_bytes)
+                parts.append(np.fromfile(f, dtype=self.dtypes[col], count=from_disk*self.widths[col]).reshape(from_disk, self.widths[col]))
+        parts.append(self.chunk[col][self.chunk_rows-from_chunk:self.chunk_rows])
+        out = np.concatenate(parts)
+        return out if self.widths[col] > 1 else out[:, 0]
+
+    def column(self, col):
+        return self.tail(col, len(self))
+
+    def last(self, col):
+        return self.tail(col, 1)[0]
+
+class RollingMean:
+    """O(1) mean over the last window values"""
+    def __init__(self, window=100, values=()):
+        self.values = deque(maxlen=window)
+        self.total = 0.
+        for val in values:
+            self.add(val)
+
+    def add(self, val):
+        if len(self.values) == self.values.maxlen:
+            self.total -= self.values[0]
+        self.values.append(val)
+        self.total += val
+        return self.total / len(self.values)
+
+class MetricsStore:
+    """The episode and evaluation metrics of one run - stands in for the old perf dict"""
+    def __init__(self, dirpath, voting_heads=None, offsets=None, avg_window=100):
+        """
+        Args:
+            dirpath: String, directory the log is written to
+            voting_heads: Integer, number of heads recorded in episode_head,
+                only needed when the log is created
+            offsets: dict from offsets() saved in a checkpoint - rows after it are dropped
+            avg_window: Integer, number of episodes avg_rewards is taken over
+        """
+        if not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+        self.dirpath = dirpath
+        # the row size of episode_head is needed to read the log back
+        heads_path = os.path.join(dirpath, 'voting_heads.txt')
+        if os.path.exists(heads_path):
+            with open(heads_path) as f:
+                logged_heads = int(f.read())
+            if voting_heads is not None and voting_heads != logged_heads:
+                raise ValueError('metrics log %s was written with %s voting heads, not %s' % (dirpath, logged_heads, voting_heads))
+            voting_heads = logged_heads
+        else:
+            with open(heads_path, 'w') as f:
+                f.write('%d' % voting_heads)
+        self.episodes = MetricsTable(dirpath, 'episodes', EPISODE_COLUMNS, widths={'episode_head': voting_heads})
+        self.evals = MetricsTable(dirpath, 'evals', EVAL_COLUMNS)
+        self.memory = MetricsTable(dirpath, 'memory', MEMORY_COLUMNS)
+        if offsets is not None:
+            self.episodes.truncate(offsets['episodes'])
+            self.evals.truncate(offsets['evals'])
+            # checkpoints from before the memory table have no offset for it
+            if 'memory' in offsets:
+                self.memory.truncate(offsets['memory'])
+        self.avg_window = avg_window
+        self.rolling_reward = RollingMean(avg_window, self.episodes.tail('episode_reward', avg_window))
+
+    def add_episode(self, steps, episode_step, episode_head, eps, loss, reward, episode_time, relative_time):
+        avg_reward = self.rolling_reward.add(reward)
+        self.episodes.append(steps=steps, episode_step=episode_step, episode_head=episode_head,
+                             eps_list=eps, episode_loss=loss, episode_reward=reward,
+                             episode_times=episode_time, episode_relative_times=relative_time,
+                             avg_rewards=avg_reward)
+        return avg_reward
+
+    def add_eval(self, step, reward):
+        self.evals.append(eval_steps=step, eval_rewards=reward)
+
+    def add_memory(self, step, usage):
+        self.memory.append(memory_steps=step, **{col: usage[col] for col, _ in MEMORY_COLUMNS[1:]})
+
+    def flush(self):
+        self.episodes.flush()
+        self.evals.flush()
+        self.memory.flush()
+
+    def offsets(self):
+        """flushes and returns the row counts to keep in a checkpoint"""
+        self.flush()
+        return {'episodes': len(self.episodes), 'evals': len(self.evals), 'memory': len(self.memory)}
+
+    def load_perf(self, perf):
+        """import the perf dict of a checkpoint written before the store existed"""
+        for i in range(len(perf['steps'])):
+            self.add_episode(perf['steps'][i], perf['episode_step'][i], perf['episode_head'][i],
+                             perf['eps_list'][i], perf['episode_loss'][i], perf['episode_reward'][i],
+                             perf['episode_times'][i], perf['episode_relative_times'][i])
+        for step, reward in zip(perf['eval_steps'], perf['eval_rewards']):
+            self.add_eval(step, reward)
+        self.flush()
+
+def plot_metrics(dirpath, output_dir):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    metrics = MetricsStore(dirpath)
+    steps = metrics.episodes.column('steps')
+    plots = [('avg_training_reward_steps', steps, metrics.episodes.column('avg_rewards')),
+             ('training_reward_steps', steps, metrics.episodes.column('episode_reward')),
+             ('loss_steps', steps, metrics.episodes.column('episode_loss')),
+             ('eps_steps', steps, metrics.episodes.column('eps_list')),
+             ('eval_rewards_steps', metrics.evals.column('eval_steps'), metrics.evals.column('eval_rewards'))]
+    for name, x, y in plots:
+        plt.figure()
+        plt.plot(x, y)
+        plt.xlabel('steps')
+        plt.title(name)
+        fname = os.path.join(output_dir, name + '.png')
+        plt.savefig(fname)
+        plt.close()
+        print("wrote", fname)
+    if len(metrics.memory):
+        plt.figure()
+        memory_steps = metrics.memory.column('memory_steps')
+        for col, _ in MEMORY_COLUMNS[1:]:
+            plt.plot(memory_steps, metrics.memory.column(col) / float(1 << 30), label=col)
+        plt.xlabel('steps')
+        plt.ylabel('GB')
+        plt.legend()
+        plt.title('memory_steps')
+        fname = os.path.join(output_dir, 'memory_steps.png')
+        plt.savefig(fname)
+        plt.close()
+        print("wrote", fname)
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('model_dir', help='run directory containing the metrics log')
+    args = parser.parse_args()
+    plot_metrics(os.path.join(args.model_dir, 'metrics'), args.model_dir)
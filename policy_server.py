@@ -0,0 +1,312 @@
+import os
+import json
+import time
+import queue
+import socket
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import torch
+from replay_server import parse_address, recv_into, recv_header, send_message
+from replay_server import ThreadingUnixReplayServer, ThreadingTCPReplayServer, STATUS_OK, STATUS_ERROR
+
+# Serves the voted action of a trained ensemble. Requests from every
+# connection go to one Batcher, which runs them through the net together once
+# max_batch states are waiting or the oldest has waited max_delay_ms. The
+# socket protocol is replay_server's header framing:
+#   act request:  op, n, payload = n uint8 frame stacks
+#   act reply:    status, n, payload = n int64 actions, then with OP_ACT_Q
+#                 n float32 vote shares and (n, n_ensemble, n_actions) float32 q values
+OP_ACT = 1
+OP_ACT_Q = 2
+OP_INFO = 3
+
+class Batcher(threading.Thread):
+    """Collects act requests and answers them in micro batches"""
+    def __init__(self, policy, max_batch=64, max_delay_ms=2.):
+        """
+        Args:
+            policy: export_policy.VotingPolicy
+            max_batch: Integer, most states in one forward
+            max_delay_ms: Float, longest the first request of a batch waits for others
+        """
+        super(Batcher, self).__init__(daemon=True)
+        self.policy = policy
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000.
+        self.requests = queue.Queue()
+        self.batch_sizes = []
+
+    def submit(self, states, with_q=False):
+        """
+        Returns:
+            actions and, with with_q, each state's vote share - the fraction of
+            heads that voted for its action - and the q values of every head
+        """
+        done = queue.Queue(maxsize=1)
+        self.requests.put((states, with_q, done))
+        result = done.get()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            n = len(batch[0][0])
+            deadline = time.perf_counter() + self.max_delay
+            while n < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                n += len(batch[-1][0])
+            self.answer(batch)
+
+    def answer(self, batch):
+        try:
+            states = torch.from_numpy(np.concatenate([states for states, _, _ in batch]))
+            with torch.no_grad():
+                q = self.policy.q_values(states)
+                actions, counts = self.policy.vote(q)
+            vote_share = (counts.gather(1, actions[:, None])[:, 0].float() / self.policy.n_ensemble).numpy()
+            actions = actions.numpy()
+            # (batch, n_ensemble, n_actions) so each request gets a contiguous slice
+            q = q.permute(1, 0, 2).numpy()
+        except Exception as e:
+            for _, _, done in batch:
+                done.put(e)
+            return
+        self.batch_sizes.append(len(states))
+        start = 0
+        for states, with_q, done in batch:
+            stop = start + len(states)
+            if with_q:
+                done.put((actions[start:stop], vote_share[start:stop], q[start:stop]))
+            else:
+                done.put((actions[start:stop],))
+            start = stop
+
+    def info(self):
+        return {'history': int(self.policy.history), 'frame_size': int(self.policy.frame_size),
+                'n_ensemble': int(self.policy.n_ensemble), 'n_actions': int(self.policy.n_actions),
+                'mean_batch': float(np.mean(self.batch_sizes[-1000:])) if self.batch_sizes else 0.}
+
+
+class PolicyRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        sock = self.request
+        if sock.family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        batcher = self.server.batcher
+        shape = (batcher.policy.history, batcher.policy.frame_size, batcher.policy.frame_size)
+        while True:
+            try:
+                op, n, payload_len = recv_header(sock)
+                if op in (OP_ACT, OP_ACT_Q):
+                    states = recv_into(sock, np.empty((n,) + shape, dtype=np.uint8))
+                    try:
+                        result = batcher.submit(states, with_q=op == OP_ACT_Q)
+                    except Exception as e:
+                        send_message(sock, STATUS_ERROR, 0, [np.frombuffer(str(e).encode(), np.uint8)])
+                        continue
+                    send_message(sock, STATUS_OK, n, [result[0].astype(np.int64)] + list(result[1:]))
+                elif op == OP_INFO:
+                    recv_into(sock, bytearray(payload_len))
+                    send_message(sock, STATUS_OK, 0, [np.frombuffer(json.dumps(batcher.info()).encode(), np.uint8)])
+                else:
+                    print("policy server got unknown op %s, closing connection" % op)
+                    return
+            except (ConnectionError, OSError):
+                return
+
+
+class PolicyHTTPHandler(BaseHTTPRequestHandler):
+    """POST /act?q=1 with the raw uint8 frame stacks as the body, JSON back"""
+    def do_POST(self):
+        batcher = self.server.batcher
+        url = urlparse(self.path)
+        if url.path != '/act':
+            self.send_error(404)
+            return
+        shape = (batcher.policy.history, batcher.policy.frame_size, batcher.policy.frame_size)
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        with_q = parse_qs(url.query).get('q', ['0'])[0] == '1'
+        try:
+            states = np.frombuffer(body, dtype=np.uint8).reshape((-1,) + shape)
+            result = batcher.submit(states, with_q)
+        except Exception as e:
+            self.send_error(400, str(e))
+            return
+        reply = {'actions': result[0].tolist()}
+        if with_q:
+            reply['vote_share'] = result[1].tolist()
+            reply['q'] = result[2].tolist()
+        self.reply(reply)
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/info':
+            self.send_error(404)
+            return
+        self.reply(self.server.batcher.info())
+
+    def reply(self, obj):
+        out = json.dumps(obj).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def log_message(self, *args):
+        pass
+
+
+def make_server(address, batcher):
+    """Serve batcher on 'unix:/path', 'host:port' or 'http://host:port'. Call serve_forever() on the result."""
+    if address.startswith('http://'):
+        host, port = address[len('http://'):].rsplit(':', 1)
+        server = ThreadingHTTPServer((host, int(port)), PolicyHTTPHandler)
+        server.daemon_threads = True
+    else:
+        family, sockaddr = parse_address(address)
+        if family == socket.AF_UNIX:
+            if os.path.exists(sockaddr):
+                os.remove(sockaddr)
+            server = ThreadingUnixReplayServer(sockaddr, PolicyRequestHandler)
+        else:
+            server = ThreadingTCPReplayServer(sockaddr, PolicyRequestHandler)
+    server.batcher = batcher
+    return server
+
+def policy_from_checkpoint(model_loadpath):
+    from dqn_utils import load_checkpoint
+    from export_policy import voting_policy_from_checkpoint
+    model_dict = load_checkpoint(model_loadpath, map_location='cpu')
+    info = model_dict['info']
+    policy = voting_policy_from_checkpoint(model_dict)
+    policy.history = info['HISTORY_SIZE']
+    policy.frame_size = info['NETWORK_INPUT_SIZE'][0]
+    return policy
+
+def serve(address, model_loadpath, max_batch=64, max_delay_ms=2., threads=2):
+    torch.set_num_threads(threads)
+    batcher = Batcher(policy_from_checkpoint(model_loadpath), max_batch, max_delay_ms)
+    batcher.start()
+    server = make_server(address, batcher)
+    print("serving %s on %s, batches of up to %d within %.1f ms" % (model_loadpath, address, max_batch, max_delay_ms))
+    server.serve_forever()
+
+
+class PolicyClient:
+    """Asks a policy server for actions over its socket protocol"""
+    def __init__(self, address, connect_timeout=60):
+        family, sockaddr = parse_address(address)
+        st = time.time()
+        while True:
+            try:
+                self.sock = socket.socket(family, socket.SOCK_STREAM)
+                self.sock.connect(sockaddr)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                self.sock.close()
+                if time.time() - st > connect_timeout:
+                    raise
+                time.sleep(.1)
+        if family == socket.AF_INET:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        info = self.info()
+        self.n_ensemble = info['n_ensemble']
+        self.n_actions = info['n_actions']
+
+    def _reply(self):
+        status, n, payload_len = recv_header(self.sock)
+        if status != STATUS_OK:
+            raise ValueError(bytes(recv_into(self.sock, bytearray(payload_len))).decode())
+        return n, payload_len
+
+    def info(self):
+        send_message(self.sock, OP_INFO, 0)
+        _, payload_len = self._reply()
+        return json.loads(bytes(recv_into(self.sock, bytearray(payload_len))).decode())
+
+    def act(self, states, with_q=False):
+        """
+        Args:
+            states: (n, history, 84, 84) uint8
+        Returns:
+            (n,) actions, or with with_q, actions, vote shares and (n, n_ensemble, n_actions) q values
+        """
+        states = np.asarray(states, dtype=np.uint8)
+        send_message(self.sock, OP_ACT_Q if with_q else OP_ACT, len(states), [states])
+        n, _ = self._reply()
+        actions = recv_into(self.sock, np.empty(n, dtype=np.int64))
+        if not with_q:
+            return actions
+        vote_share = recv_into(self.sock, np.empty(n, dtype=np.float32))
+        q = recv_into(self.sock, np.empty((n, self.n_ensemble, self.n_actions), dtype=np.float32))
+        return actions, vote_share, q
+
+    def close(self):
+        self.sock.close()
+
+
+def benchmark(address, model_loadpath, concurrencies=(1, 8, 32), n_requests=500, max_batch=64, max_delay_ms=2.):
+    """Requests/sec and p50/p99 latency of single state requests from concurrent clients"""
+    from multiprocessing import Process
+    server = Process(target=serve, args=(address, model_loadpath, max_batch, max_delay_ms), daemon=True)
+    server.start()
+    try:
+        probe = PolicyClient(address)
+        info = probe.info()
+        probe.close()
+        random_state = np.random.RandomState(0)
+        states = random_state.randint(0, 256, (64, info['history'], info['frame_size'], info['frame_size'])).astype(np.uint8)
+        for concurrency in concurrencies:
+            latencies = [[] for _ in range(concurrency)]
+            def load(i):
+                client = PolicyClient(address)
+                for r in range(n_requests):
+                    st = time.perf_counter()
+                    client.act(states[(i + r) % len(states)][None])
+                    latencies[i].append(time.perf_counter() - st)
+                client.close()
+            threads = [threading.Thread(target=load, args=(i,)) for i in range(concurrency)]
+            st = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            et = time.perf_counter() - st
+            all_latencies = 1000 * np.concatenate(latencies)
+            probe = PolicyClient(address)
+            mean_batch = probe.info()['mean_batch']
+            probe.close()
+            print("%3d clients: %8.1f requests/sec  p50 %6.2f ms  p99 %6.2f ms  mean batch %.1f" % (
+                  concurrency, len(all_latencies) / et, np.percentile(all_latencies, 50),
+                  np.percentile(all_latencies, 99), mean_batch))
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('-l', '--model_loadpath', required=True, help='.pkl model file full path')
+    parser.add_argument('-a', '--address', default='unix:/tmp/bootstrap_policy.sock', help='unix:/path, host:port or http://host:port')
+    parser.add_argument('--max_batch', default=64, type=int, help='most states answered by one forward')
+    parser.add_argument('--max_delay_ms', default=2., type=float, help='longest a request waits for others to batch with')
+    parser.add_argument('--threads', default=2, type=int, help='torch cpu threads')
+    parser.add_argument('--bench', action='store_true', default=False, help='run the load generator against a local server')
+    parser.add_argument('--bench_requests', default=500, type=int, help='requests per client')
+    args = parser.parse_args()
+    if args.bench:
+        benchmark(args.address, args.model_loadpath, n_requests=args.bench_requests,
+                  max_batch=args.max_batch, max_delay_ms=args.max_delay_ms)
+    else:
+        serve(args.address, args.model_loadpath, args.max_batch, args.max_delay_ms, args.threads)
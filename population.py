@@ -0,0 +1,330 @@
+from __future__ import print_function
+import os
+import copy
+import time
+import datetime
+import numpy as np
+from collections import Counter
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+import torch.multiprocessing as mp
+from torch.func import stack_module_state, functional_call, vmap
+from dqn_utils import seed_everything, write_info_file, save_checkpoint, build_policy_net, linearly_decaying_epsilon
+from env import Environment
+from replay import ReplayMemory
+from metrics import MetricsStore
+import config
+
+# Trains P independent agents in one process. Their nets share an
+# architecture, so their weights are stacked along a leading agent dim and
+# acting, learning and target updates are one vmapped call for all of them.
+# Each agent keeps its own env, replay, seed, voting heads and epsilon
+# schedule, which is what run.py otherwise starts a process per variant for.
+
+class Population:
+    def __init__(self, info, agent_configs, model_base_filedir=None):
+        """
+        Args:
+            info: dict of the settings the agents share, as in run_bootstrap
+            agent_configs: list of dicts with each agent's VOTING_HEADS,
+                EPS_FINAL, EPS_ANNEALING_FRAMES and SEED
+            model_base_filedir: String, run directory, nothing is written when None
+        """
+        self.info = info
+        self.configs = agent_configs
+        self.n_agents = len(agent_configs)
+        self.model_base_filedir = model_base_filedir
+        self.device = info['DEVICE']
+        self.envs, self.replays, self.random_states, self.metrics = [], [], [], []
+        nets = []
+        for i, cfg in enumerate(agent_configs):
+            self.envs.append(Environment(rom_file=info['GAME'], frame_skip=info['FRAME_SKIP'],
+                                         num_frames=info['HISTORY_SIZE'], no_op_start=info['MAX_NO_OP_FRAMES'], rand_seed=cfg['SEED'],
+                                         dead_as_end=info['DEAD_AS_END'], max_episode_steps=info['MAX_EPISODE_STEPS'],
+                                         keep_plot_frames=False))
+            self.replays.append(ReplayMemory(size=info['BUFFER_SIZE'],
+                                             frame_height=info['NETWORK_INPUT_SIZE'][0],
+                                             frame_width=info['NETWORK_INPUT_SIZE'][1],
+                                             agent_history_length=info['HISTORY_SIZE'],
+                                             batch_size=info['BATCH_SIZE'],
+                                             num_heads=info['N_ENSEMBLE'],
+                                             bernoulli_probability=info['BERNOULLI_PROBABILITY']))
+            self.replays[-1].random_state = np.random.RandomState(cfg['SEED'])
+            self.random_states.append(np.random.RandomState(cfg['SEED']))
+            seed_everything(cfg['SEED'])
+            nets.append(build_policy_net(info, self.envs[0].num_actions, self.device))
+            if model_base_filedir is not None:
+                self.metrics.append(MetricsStore(os.path.join(model_base_filedir, 'agent%02d' % i, 'metrics'),
+                                                 min(cfg['VOTING_HEADS'], info['N_ENSEMBLE'])))
+        self.n_actions = self.envs[0].num_actions
+        # one module per agent to rebuild state_dicts from for checkpoints
+        self.nets = nets
+        self.base = copy.deepcopy(nets[0]).to('meta')
+        self.params, self.buffers = stack_module_state(nets)
+        # the target starts as a copy and shares the prior's weights, as in run_bootstrap
+        self.target_params = {k: v.detach().clone() for k, v in self.params.items()}
+        self.core_keys = [k for k in self.params if k.startswith('core_net.') or k.startswith('net.core_net.')]
+        self.opt = optim.Adam(self.params.values(), lr=info['ADAM_LEARNING_RATE'])
+
+    def _q(self, params, buffers, x):
+        """(n_ensemble, batch, n_actions) q values of one agent"""
+        return torch.stack(functional_call(self.base, (params, buffers), (x, None)))
+
+    def head_actions(self, states):
+        """
+        Args:
+            states: (P, 4, 84, 84) uint8, the current state of every agent
+        Returns:
+            (P, n_ensemble) greedy action of every head of every agent
+        """
+        x = torch.Tensor(states.astype(float) / self.info['NORM_BY'])[:, None].to(self.device)
+        with torch.no_grad():
+            q = vmap(self._q)(self.params, self.buffers, x)
+        return q[:, :, 0].argmax(2).cpu().numpy()
+
+    def _agent_loss(self, params, buffers, target_params, states, actions, rewards, next_states, terminal_flags, masks):
+        """ptlearn's loss for one agent - vmapped over the population"""
+        q_policy_vals = self._q(params, buffers, states)
+        next_q_target_vals = self._q(target_params, buffers, next_states).detach()
+        if self.info['DOUBLE_DQN']:
+            next_actions = self._q(params, buffers, next_states).detach().argmax(2, keepdim=True)
+            next_qs = next_q_target_vals.gather(2, next_actions).squeeze(2)
+        else:
+            next_qs = next_q_target_vals.max(2)[0]
+        n_ensemble = q_policy_vals.shape[0]
+        preds = q_policy_vals.gather(2, actions[None, :, None].expand(n_ensemble, -1, 1)).squeeze(2)
+        targets = rewards[None] + self.info['GAMMA'] * next_qs * (1 - terminal_flags[None])
+        head_losses = F.smooth_l1_loss(preds, targets, reduction='none').mean(1)
+        # unused heads count as 0 in the mean over all of them, as in ptlearn
+        used = (masks.sum(0) > 0).float()
+        return (head_losses * used).sum() / n_ensemble
+
+    def learn(self):
+        """One ptlearn step for every agent, on a minibatch from its own replay. Returns the loss of each agent"""
+        batches = [replay.get_minibatch(self.info['BATCH_SIZE']) for replay in self.replays]
+        states, actions, rewards, next_states, terminal_flags, masks = [np.stack(b) for b in zip(*batches)]
+        states = torch.Tensor(states.astype(float) / self.info['NORM_BY']).to(self.device)
+        next_states = torch.Tensor(next_states.astype(float) / self.info['NORM_BY']).to(self.device)
+        rewards = torch.Tensor(rewards).to(self.device)
+        actions = torch.LongTensor(actions).to(self.device)
+        terminal_flags = torch.Tensor(terminal_flags.astype(int)).to(self.device)
+        masks = torch.FloatTensor(masks.astype(int)).to(self.device)
+
+        self.opt.zero_grad()
+        losses = vmap(self._agent_loss)(self.params, self.buffers, self.target_params,
+                                          states, actions, rewards, next_states, terminal_flags, masks)
+        # the agents share no weights, so the sum gives each its own gradient
+        losses.sum().backward()
+        with torch.no_grad():
+            for k in self.core_keys:
+                if self.params[k].grad is not None:
+                    # Divide grads in core
+                    self.params[k].grad *= 1.0 / float(self.info['N_ENSEMBLE'])
+            # clip_grad_norm_ for each agent on its own slice
+            grads = [p.grad for p in self.params.values() if p.grad is not None]
+            norms = torch.sqrt(sum(g.pow(2).flatten(1).sum(1) for g in grads))
+            clip_coef = (self.info['CLIP_GRAD'] / (norms + 1e-6)).clamp(max=1.)
+            for g in grads:
+                g.mul_(clip_coef.view((-1,) + (1,) * (g.dim() - 1)))
+        # Adam is elementwise - stepping the stacked weights is P separate Adams
+        self.opt.step()
+        return losses.detach().cpu().numpy()
+
+    def update_targets(self):
+        with torch.no_grad():
+            for k, v in self.params.items():
+                self.target_params[k].copy_(v)
+
+    def agent_state_dicts(self, i):
+        """policy and target state_dicts of agent i, as run_bootstrap saves them"""
+        net = self.nets[i]
+        dicts = []
+        with torch.no_grad():
+            for stacked in [self.params, self.target_params]:
+                for name, p in net.named_parameters():
+                    p.copy_(stacked[name][i])
+                dicts.append({k: v.clone() for k, v in net.state_dict().items()})
+        return dicts
+
+    def agent_optimizer_state(self, i):
+        """agent i's slice of the stacked Adam, as the state_dict of run_bootstrap's Adam over its policy_net"""
+        full = self.opt.state_dict()
+        # the stacked params are in named_parameters order, as policy_net.parameters() is
+        state = {k: {name: v[i].clone() if torch.is_tensor(v) and v.dim() else v for name, v in s.items()}
+                 for k, s in full['state'].items()}
+        return {'state': state, 'param_groups': copy.deepcopy(full['param_groups'])}
+
+    def checkpoint(self, step_number):
+        for i, cfg in enumerate(self.configs):
+            agent_info = dict(self.info, **cfg)
+            policy_state, target_state = self.agent_state_dicts(i)
+            filename = os.path.abspath(os.path.join(self.model_base_filedir, 'agent%02d' % i,
+                                                    self.info['NAME'] + "_%010dq.pkl" % step_number))
+            save_checkpoint({'info': agent_info,
+                             'optimizer': self.agent_optimizer_state(i),
+                             'cnt': step_number,
+                             'policy_net_state_dict': policy_state,
+                             'target_net_state_dict': target_state,
+                             'perf_offsets': self.metrics[i].offsets()}, filename)
+
+    def epsilon(self, i, step_number):
+        cfg = self.configs[i]
+        return linearly_decaying_epsilon(cfg['EPS_ANNEALING_FRAMES'], step_number, self.info['MIN_HISTORY_TO_LEARN'], cfg['EPS_FINAL'])
+
+def train_population(pop, max_steps):
+    """
+    Steps every agent's env once per iteration, acting for all of them with one
+    batched forward. Returns agent-steps/sec
+    """
+    info = pop.info
+    heads = [list(range(info['N_ENSEMBLE'])) for _ in range(pop.n_agents)]
+    states = np.stack([env.reset() for env in pop.envs])
+    life_lost = np.ones(pop.n_agents, dtype=bool)
+    episode = [{'start': 0, 'st': time.time(), 'reward': 0., 'eps': [], 'losses': []} for _ in range(pop.n_agents)]
+    active_heads = []
+    for i in range(pop.n_agents):
+        pop.random_states[i].shuffle(heads[i])
+        active_heads.append(heads[i][:pop.configs[i]['VOTING_HEADS']])
+    st = time.time()
+    for step_number in range(1, max_steps + 1):
+        head_acts = pop.head_actions(states)
+        for i, env in enumerate(pop.envs):
+            eps = 0 if life_lost[i] else pop.epsilon(i, step_number)
+            if life_lost[i]:
+                action = 1
+            elif pop.random_states[i].rand() < eps:
+                action = pop.random_states[i].randint(0, pop.n_actions)
+            else:
+                action = Counter(head_acts[i, active_heads[i]].tolist()).most_common(1)[0][0]
+            next_state, reward, life_lost[i], terminal = env.step(action)
+            pop.replays[i].add_experience(action=action, frame=next_state[-1], reward=np.sign(reward), terminal=life_lost[i])
+            episode[i]['reward'] += reward
+            episode[i]['eps'].append(eps)
+            states[i] = next_state
+            if terminal:
+                ep = episode[i]
+                if pop.metrics:
+                    avg_reward = pop.metrics[i].add_episode(steps=step_number,
+                                                            episode_step=step_number - ep['start'],
+                                                            episode_head=active_heads[i],
+                                                            eps=np.mean(ep['eps']),
+                                                            loss=np.mean(ep['losses']) if len(ep['losses']) else np.nan,
+                                                            reward=ep['reward'],
+                                                            episode_time=time.time() - ep['st'],
+                                                            relative_time=time.time() - info['START_TIME'])
+                    if not len(pop.metrics[i].episodes) % info['PLOT_EVERY_EPISODES']:
+                        print('agent %d step %d avg reward %.2f' % (i, step_number, avg_reward))
+                episode[i] = {'start': step_number, 'st': time.time(), 'reward': 0., 'eps': [], 'losses': []}
+                states[i] = env.reset()
+                life_lost[i] = True
+                pop.random_states[i].shuffle(heads[i])
+                active_heads[i] = heads[i][:pop.configs[i]['VOTING_HEADS']]
+        if step_number % info['LEARN_EVERY_STEPS'] == 0 and step_number > info['MIN_HISTORY_TO_LEARN']:
+            for i, loss in enumerate(pop.learn()):
+                episode[i]['losses'].append(loss)
+        if step_number % info['TARGET_UPDATE'] == 0 and step_number > info['MIN_HISTORY_TO_LEARN']:
+            pop.update_targets()
+        if pop.model_base_filedir is not None and step_number % info['CHECKPOINT_EVERY_STEPS'] == 0:
+            pop.checkpoint(step_number)
+        if not step_number % 10000:
+            print('step %d: %.1f agent-steps/sec over %d agents' % (step_number, pop.n_agents * step_number / (time.time() - st), pop.n_agents))
+    for metrics in pop.metrics:
+        metrics.flush()
+    return pop.n_agents * max_steps / (time.time() - st)
+
+def benchmark_single(info, agent_config, steps, threads, results):
+    torch.set_num_threads(threads)
+    results.put(train_population(Population(info, [agent_config]), steps))
+
+def benchmark(info, agent_configs, steps, threads):
+    """agent-steps/sec of the population against one process per agent, given the same threads"""
+    torch.set_num_threads(threads)
+    population_rate = train_population(Population(info, agent_configs), steps)
+    ctx = mp.get_context('spawn')
+    results = ctx.SimpleQueue()
+    procs = [ctx.Process(target=benchmark_single, args=(info, cfg, steps, max(1, threads // len(agent_configs)), results))
+             for cfg in agent_configs]
+    for p in procs:
+        p.start()
+    separate_rate = sum(results.get() for _ in procs)
+    for p in procs:
+        p.join()
+    print("population of %d: %.1f agent-steps/sec, %d processes: %.1f agent-steps/sec (%.2fx)" % (
+          len(agent_configs), population_rate, len(agent_configs), separate_rate, population_rate / separate_rate))
+    return population_rate, separate_rate
+
+def parse_list(value, n, cast):
+    """comma separated per agent values, a single value is used for every agent"""
+    values = [cast(v) for v in value.split(',')]
+    return values * n if len(values) == 1 else values
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('-c', '--cuda', default='', help='cuda device number, cpu when not given')
+    parser.add_argument('-v', '--voting_nrs', default='1,3,5,10', help='voting heads of each agent, one agent per value')
+    parser.add_argument('--eps_finals', default='0.01', help='final epsilon of each agent, or one for all')
+    parser.add_argument('--eps_annealing_frames', default=str(int(1e6)), help='epsilon annealing steps of each agent, or one for all')
+    parser.add_argument('-n', '--name', default='population_pong', help='start files with name')
+    parser.add_argument('--buffer_size', default=int(1e6), type=int, help='replay size of each agent')
+    parser.add_argument('--threads', default=os.cpu_count(), type=int, help='torch threads, split between processes with --benchmark')
+    parser.add_argument('--benchmark', default=0, type=int, help='steps to time the population against one process per agent instead of training')
+    args = parser.parse_args()
+
+    voting_nrs = [int(v) for v in args.voting_nrs.split(',')]
+    n_agents = len(voting_nrs)
+    info = {
+        "GAME": 'roms/pong.bin',
+        "DEVICE": f'cuda:{args.cuda}' if args.cuda != '' else 'cpu',
+        "NAME": args.name,
+        "DUELING": True,
+        "DOUBLE_DQN": True,
+        "PRIOR": True,
+        "PRIOR_SCALE": 10,
+        "N_ENSEMBLE": max(10, max(voting_nrs)),
+        "LEARN_EVERY_STEPS": 4,
+        "BERNOULLI_PROBABILITY": 0.9,
+        "TARGET_UPDATE": 10000,
+        "MIN_HISTORY_TO_LEARN": 50000,
+        "NORM_BY": 255.,
+        "BUFFER_SIZE": args.buffer_size,
+        "CHECKPOINT_EVERY_STEPS": 500000,
+        "ADAM_LEARNING_RATE": 6.25e-5,
+        "HISTORY_SIZE": 4,
+        "BATCH_SIZE": 32,
+        "GAMMA": .99,
+        "PLOT_EVERY_EPISODES": 50,
+        "CLIP_GRAD": 5,
+        "SEED": 101,
+        "NETWORK_INPUT_SIZE": (84, 84),
+        "START_TIME": time.time(),
+        "MAX_STEPS": int(50e6),
+        "MAX_EPISODE_STEPS": 27000,
+        "FRAME_SKIP": 4,
+        "MAX_NO_OP_FRAMES": 30,
+        "DEAD_AS_END": True,
+    }
+    agent_configs = [{'VOTING_HEADS': voting_nrs[i],
+                      'EPS_FINAL': parse_list(args.eps_finals, n_agents, float)[i],
+                      'EPS_ANNEALING_FRAMES': parse_list(args.eps_annealing_frames, n_agents, int)[i],
+                      'SEED': info['SEED'] + i} for i in range(n_agents)]
+
+    if args.benchmark:
+        # learn from early on so the timing covers acting and learning
+        info['MIN_HISTORY_TO_LEARN'] = min(info['MIN_HISTORY_TO_LEARN'], args.benchmark // 4)
+        benchmark(info, agent_configs, args.benchmark, args.threads)
+    else:
+        torch.set_num_threads(args.threads)
+        info['load_time'] = datetime.date.today().ctime()
+        info['AGENTS'] = agent_configs
+        run_num = 0
+        model_base_filedir = os.path.join(config.model_savedir, info['NAME'] + '%02d' % run_num)
+        while os.path.exists(model_base_filedir):
+            run_num += 1
+            model_base_filedir = os.path.join(config.model_savedir, info['NAME'] + '%02d' % run_num)
+        os.makedirs(model_base_filedir)
+        print(f"starting NEW population project: {model_base_filedir} with {n_agents} agents")
+        write_info_file(info, os.path.join(model_base_filedir, info['NAME']), 0)
+        population = Population(info, agent_configs, model_base_filedir)
+        train_population(population, info['MAX_STEPS'])
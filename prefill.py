@@ -0,0 +1,125 @@
+import os
+import time
+import hashlib
+import numpy as np
+from env import Environment
+
+# Fills the replay with the uniformly random warm up of a run in parallel.
+# The first MIN_HISTORY_TO_LEARN steps of run_bootstrap act at eps_initial=1
+# (fire after a lost life, else a random action) and learn nothing, so they
+# need no net - each worker plays its share on its own seeded Environment and
+# the streams are added one after another, with a history break between them
+# so no state is stitched from two workers' frames.
+#
+# The transitions only depend on the rom, seed, count and env settings, so
+# they can be cached on disk and a later run of the same game skips warm up.
+
+def env_kwargs_from_info(info):
+    return {'frame_skip': info['FRAME_SKIP'], 'num_frames': info['HISTORY_SIZE'],
+            'frame_size': info['NETWORK_INPUT_SIZE'][0], 'no_op_start': info['MAX_NO_OP_FRAMES'],
+            'dead_as_end': info['DEAD_AS_END'], 'max_episode_steps': info['MAX_EPISODE_STEPS']}
+
+def play_random(job):
+    """
+    Args:
+        job: (rom_file, seed, n_steps, env_kwargs)
+    Returns:
+        actions, frames, rewards and terminal flags of n_steps random steps,
+        as the training loop would add them
+    """
+    rom_file, seed, n_steps, env_kwargs = job
+    env = Environment(rom_file, rand_seed=seed, keep_plot_frames=False, **env_kwargs)
+    random_state = np.random.RandomState(seed)
+    actions = np.empty(n_steps, dtype=np.int32)
+    frames = np.empty((n_steps, env.frame_size, env.frame_size), dtype=np.uint8)
+    rewards = np.empty(n_steps, dtype=np.float32)
+    terminals = np.empty(n_steps, dtype=bool)
+    env.reset()
+    life_lost = True
+    for i in range(n_steps):
+        action = 1 if life_lost else random_state.randint(0, env.num_actions)
+        state, reward, life_lost, terminal = env.step(action)
+        actions[i] = action
+        frames[i] = state[-1]
+        rewards[i] = np.sign(reward)
+        terminals[i] = life_lost
+        if terminal:
+            env.reset()
+            life_lost = True
+    return actions, frames, rewards, terminals
+
+def generate_prefill(rom_file, n_steps, seed, n_workers, env_kwargs):
+    """one stream of random transitions per worker, n_steps between them"""
+    counts = [n_steps // n_workers + (w < n_steps % n_workers) for w in range(n_workers)]
+    # seeds apart from the run's own env, which is seeded with seed
+    jobs = [(rom_file, seed + 1 + w, count, env_kwargs) for w, count in enumerate(counts) if count]
+    if n_workers == 1:
+        return [play_random(job) for job in jobs]
+    from multiprocessing import get_context
+    with get_context('spawn').Pool(n_workers) as pool:
+        return pool.map(play_random, jobs, chunksize=1)
+
+def prefill_cache_path(cache_dir, rom_file, n_steps, seed, n_workers, env_kwargs):
+    # the streams change with the worker count and the env settings as well
+    settings = hashlib.md5(repr((n_workers, sorted(env_kwargs.items()))).encode()).hexdigest()[:8]
+    rom = os.path.splitext(os.path.basename(rom_file))[0]
+    return os.path.join(cache_dir, '%s_seed%d_n%d_%s_prefill.npz' % (rom, seed, n_steps, settings))
+
+def save_streams(filepath, streams):
+    np.savez(filepath, stream_lengths=np.array([len(s[0]) for s in streams]),
+             actions=np.concatenate([s[0] for s in streams]), frames=np.concatenate([s[1] for s in streams]),
+             rewards=np.concatenate([s[2] for s in streams]), terminals=np.concatenate([s[3] for s in streams]))
+
+def load_streams(filepath):
+    npfile = np.load(filepath)
+    bounds = np.cumsum(npfile['stream_lengths'])[:-1]
+    return list(zip(*[np.split(npfile[name], bounds) for name in ['actions', 'frames', 'rewards', 'terminals']]))
+
+def prefill_replay(replay_memory, rom_file, n_steps, seed, n_workers=4, env_kwargs={}, cache_dir=''):
+    """
+    Add n_steps of random warm up to replay_memory, from the cache when it has them
+    Returns:
+        the number of transitions added - the env steps the run can start from
+    """
+    st = time.time()
+    filepath = prefill_cache_path(cache_dir, rom_file, n_steps, seed, n_workers, env_kwargs) if cache_dir else ''
+    if filepath and os.path.exists(filepath):
+        streams = load_streams(filepath)
+        source = 'cache %s' % filepath
+    else:
+        streams = generate_prefill(rom_file, n_steps, seed, n_workers, env_kwargs)
+        source = '%d workers' % n_workers
+        if filepath:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            # write then rename, so a killed run never leaves a partial cache behind
+            save_streams(filepath + '.tmp.npz', streams)
+            os.rename(filepath + '.tmp.npz', filepath)
+    for actions, frames, rewards, terminals in streams:
+        replay_memory.add_experiences(actions, frames, rewards, terminals, new_stream=True)
+    n_added = sum(len(s[0]) for s in streams)
+    if n_added:
+        # the run's own env is one more stream
+        replay_memory.history_breaks[(replay_memory.current - 1) % replay_memory.size] = True
+    print("prefilled replay with %d random transitions from %s in %.1fs" % (n_added, source, time.time() - st))
+    return n_added
+
+def benchmark(rom_file, n_steps, worker_counts):
+    """warm up steps/sec of the serial loop's env stepping against the worker pool"""
+    env_kwargs = {}
+    for n_workers in worker_counts:
+        st = time.time()
+        streams = generate_prefill(rom_file, n_steps, 0, n_workers, env_kwargs)
+        et = time.time() - st
+        lives_lost = sum(int(s[3].sum()) for s in streams)
+        print("%2d workers: %.0f steps/sec, %.1fs for %d steps (%d lives lost)" % (
+              n_workers, n_steps / et, et, n_steps, lives_lost))
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('--rom', default='roms/pong.bin')
+    parser.add_argument('--n_steps', default=50000, type=int, help='MIN_HISTORY_TO_LEARN in run_bootstrap')
+    parser.add_argument('--workers', default='1,2,4,8', help='comma separated worker counts')
+    args = parser.parse_args()
+    benchmark(args.rom, args.n_steps, [int(w) for w in args.workers.split(',')])
@@ -0,0 +1,118 @@
+import copy
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.ao.quantization import QuantStub, DeQuantStub, fuse_modules, get_default_qconfig, prepare, convert, quantize_dynamic
+from export_policy import VotingPolicy
+
+# Int8 copies of a policy net for acting and evaluation on cpu. The learner
+# keeps training the fp32 net - these copies are rebuilt from it periodically.
+
+class QuantCoreNet(nn.Module):
+    """CoreNet with its convs statically quantized - built from a trained CoreNet"""
+    def __init__(self, core_net):
+        super(QuantCoreNet, self).__init__()
+        self.quant = QuantStub()
+        self.conv1 = copy.deepcopy(core_net.conv1)
+        self.relu1 = nn.ReLU()
+        self.conv2 = copy.deepcopy(core_net.conv2)
+        self.relu2 = nn.ReLU()
+        self.conv3 = copy.deepcopy(core_net.conv3)
+        self.relu3 = nn.ReLU()
+        self.dequant = DeQuantStub()
+
+    def forward(self, x):
+        x = self.quant(x)
+        x = self.relu1(self.conv1(x))
+        x = self.relu2(self.conv2(x))
+        x = self.relu3(self.conv3(x))
+        x = self.dequant(x)
+        # size after conv3
+        reshape = 64*7*7
+        return x.reshape(-1, reshape)
+
+def _ensembles(net):
+    if hasattr(net, 'net'):
+        # NetWithPrior - the prior ensemble is quantized the same way
+        return [net.net] + ([net.prior] if net.prior_scale > 0. else [])
+    return [net]
+
+def quantize_policy_net(policy_net, calibration_states, norm_by=255., static_core=True):
+    """
+    Args:
+        policy_net: EnsembleNet or NetWithPrior to copy, left untouched
+        calibration_states: (N, 4, 84, 84) uint8 states, eg from replay_memory.get_minibatch
+        norm_by: float the states are divided by before the net
+        static_core: bool, statically quantize the CoreNet convs, else only the heads are int8
+    Returns:
+        An int8 cpu copy of policy_net with the same forward(x, k)
+    """
+    engine = torch.backends.quantized.engine
+    net = copy.deepcopy(policy_net).cpu().eval()
+    x = torch.Tensor(calibration_states.astype(float) / norm_by)
+    for ensemble in _ensembles(net):
+        if static_core:
+            core = QuantCoreNet(ensemble.core_net).eval()
+            core = fuse_modules(core, [['conv1', 'relu1'], ['conv2', 'relu2'], ['conv3', 'relu3']])
+            core.qconfig = get_default_qconfig(engine)
+            prepare(core, inplace=True)
+            with torch.no_grad():
+                core(x)
+            ensemble.core_net = convert(core)
+        ensemble.net_list = quantize_dynamic(ensemble.net_list, {nn.Linear}, dtype=torch.qint8)
+    if hasattr(net, 'net'):
+        net.core_net = net.net.core_net
+    return net
+
+def compare_policies(fp32_net, int8_net, states, n_ensemble, n_actions, norm_by=255., n_timing=50):
+    """
+    Returns:
+        rate the voted actions of the two nets agree on states and each net's
+        ms per single state forward, which is what acting pays every env step
+    """
+    fp32_net = copy.deepcopy(fp32_net).cpu().eval()
+    fp32_policy = VotingPolicy(fp32_net, n_ensemble, n_actions, norm_by)
+    int8_policy = VotingPolicy(int8_net, n_ensemble, n_actions, norm_by)
+    with torch.no_grad():
+        frames = torch.from_numpy(np.ascontiguousarray(states))
+        agreement = (fp32_policy(frames) == int8_policy(frames)).float().mean().item()
+        latencies = []
+        for net in [fp32_net, int8_net]:
+            state = torch.Tensor(states[:1].astype(float) / norm_by)
+            net(state, None)
+            st = time.time()
+            for _ in range(n_timing):
+                net(state, None)
+            latencies.append(1000*(time.time() - st)/n_timing)
+    return agreement, latencies[0], latencies[1]
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    from action_replay import load_replay_buffer
+    from dqn_utils import load_checkpoint, load_policy_net, n_actions_from_state_dict
+    parser = ArgumentParser()
+    parser.add_argument('-l', '--model_loadpath', required=True, help='.pkl model file full path')
+    parser.add_argument('-b', '--buffer_loadpath', default='', help='.npz replay buffer to calibrate on, defaults to the checkpoint buffer')
+    parser.add_argument('--calibration_size', default=256, type=int)
+    parser.add_argument('--eval_size', default=1024, type=int, help='held out states to measure action agreement on')
+    parser.add_argument('--threads', default=2, type=int, help='torch cpu threads, run_bootstrap uses 2')
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+
+    model_dict = load_checkpoint(args.model_loadpath, map_location='cpu')
+    info = model_dict['info']
+    policy_net = load_policy_net(model_dict)
+    n_actions = n_actions_from_state_dict(model_dict['policy_net_state_dict'])
+    replay_memory = load_replay_buffer(args.buffer_loadpath or args.model_loadpath.replace('.pkl', '_train_buffer.npz'),
+                                       info['N_ENSEMBLE'], info['BERNOULLI_PROBABILITY'])
+    calibration_states = replay_memory.get_minibatch(args.calibration_size)[0].copy()
+    eval_states = replay_memory.get_minibatch(args.eval_size)[0].copy()
+    for static_core in [False, True]:
+        st = time.time()
+        int8_net = quantize_policy_net(policy_net, calibration_states, info['NORM_BY'], static_core=static_core)
+        qt = time.time() - st
+        agreement, fp32_ms, int8_ms = compare_policies(policy_net, int8_net, eval_states,
+                                                       info['N_ENSEMBLE'], n_actions, info['NORM_BY'])
+        print("%-22s quantized in %.2fs  action agreement %.4f  fp32 %.3f ms/step  int8 %.3f ms/step" % (
+              'int8 heads+core' if static_core else 'int8 heads only', qt, agreement, fp32_ms, int8_ms))
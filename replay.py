@@ -1,12 +1,70 @@
 import numpy as np
 import time
+import struct
+import zipfile
+import live_metrics
+
+REPLAY_ADDED = live_metrics.counter('replay_added', 'transitions added to replay')
+REPLAY_SAMPLED = live_metrics.counter('replay_sampled', 'transitions sampled from replay')
+REPLAY_SAMPLE_SECONDS = live_metrics.histogram('replay_sample_seconds', 'get_minibatch time',
+                                               buckets=(.0001, .0005, .001, .005, .01, .05, .1, .5))
+
+MASK64 = (1 << 64) - 1
+
+def bootstrap_masks(seed, transition_ids, num_heads, bernoulli_probability):
+    """
+    Bernoulli(bernoulli_probability) mask of every head for each transition id,
+    from a splitmix64 hash of (seed, transition id, head) - the same ids give
+    the same masks in any process without storing them
+    Returns:
+        (len(transition_ids), num_heads) bool array
+    """
+    if bernoulli_probability >= 1.0:
+        return np.ones((len(transition_ids), num_heads), dtype=bool)
+    z = np.asarray(transition_ids, dtype=np.uint64)[:, None] * np.uint64(num_heads) + np.arange(num_heads, dtype=np.uint64)[None]
+    # the seed picks a different stream, the mixing is done in python ints so it can not overflow
+    z += np.uint64((seed * 0xD1B54A32D192ED03 + 0x9E3779B97F4A7C15) & MASK64)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    z ^= z >> np.uint64(31)
+    # top 53 bits as a uniform draw in [0, 1)
+    return (z >> np.uint64(11)) < np.uint64(int(bernoulli_probability * (1 << 53)))
+
+def mmap_npz(filepath):
+    """
+    Memory map the arrays of an uncompressed .npz as written by np.savez, so
+    a saved buffer can be sampled without reading all of its frames into RAM.
+    Scalars are read normally.
+    """
+    arrays = {}
+    with zipfile.ZipFile(filepath) as zf, open(filepath, 'rb') as f:
+        for zinfo in zf.infolist():
+            if zinfo.compress_type != zipfile.ZIP_STORED:
+                raise ValueError('%s is compressed and can not be memory mapped' % filepath)
+            # the data starts after the local file header and its name and extra fields
+            f.seek(zinfo.header_offset)
+            name_len, extra_len = struct.unpack('<HH', f.read(30)[26:30])
+            f.seek(zinfo.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            name = zinfo.filename[:-len('.npy')]
+            if len(shape):
+                arrays[name] = np.memmap(filepath, dtype=dtype, mode='r', shape=shape, offset=f.tell(),
+                                         order='F' if fortran_order else 'C')
+            else:
+                arrays[name] = np.fromfile(f, dtype=dtype, count=1).reshape(())
+    return arrays
 
 # This function was mostly pulled from
 # https://github.com/fg91/Deep-Q-Learning/blob/master/DQN.ipynb
 class ReplayMemory:
     """Replay Memory that stores the last size=1,000,000 transitions"""
     def __init__(self, size=1000000, frame_height=84, frame_width=84,
-                 agent_history_length=4, batch_size=32, num_heads=1, bernoulli_probability=1.0):
+                 agent_history_length=4, batch_size=32, num_heads=1, bernoulli_probability=1.0,
+                 hashed_masks=False, mask_seed=0):
         """
         Args:
             size: Integer, Number of stored transitions
@@ -16,6 +74,9 @@ class ReplayMemory:
             batch_size: Integer, Number if transitions returned in a minibatch
             num_heads: integer number of heads needed in mask
             bernoulli_probability: bernoulli probability that an experience will go to a particular head
+            hashed_masks: bool, derive each transition's mask from bootstrap_masks
+                when it is sampled instead of storing a (size, num_heads) array
+            mask_seed: Integer, seed of the hashed masks - give replay shards different ones
         """
         self.bernoulli_probability = bernoulli_probability
         assert(self.bernoulli_probability > 0)
@@ -26,12 +87,23 @@ class ReplayMemory:
         self.count = 0
         self.current = 0
         self.num_heads = num_heads
-        # Pre-allocate memory
-        self.actions = np.empty(self.size, dtype=np.int32)
-        self.rewards = np.empty(self.size, dtype=np.float32)
-        self.frames = np.empty((self.size, self.frame_height, self.frame_width), dtype=np.uint8)
-        self.terminal_flags = np.empty(self.size, dtype=bool)
-        self.masks = np.empty((self.size, self.num_heads), dtype=bool)
+        # Pre-allocate memory lazily - np.zeros gets its memory from calloc,
+        # which maps zero pages on demand, so the ~7GB of frames is only
+        # touched as the ring is written instead of all up front
+        self.actions = np.zeros(self.size, dtype=np.int32)
+        self.rewards = np.zeros(self.size, dtype=np.float32)
+        self.frames = self._allocate_frames()
+        self.terminal_flags = np.zeros(self.size, dtype=bool)
+        self.mask_seed = mask_seed
+        # with hashed masks a transition's mask is a function of how many
+        # transitions were added before it, so that count is all that is kept
+        self.masks = None if hashed_masks else np.zeros((self.size, self.num_heads), dtype=bool)
+        self.total_added = 0
+        # set on the last slot before a block that starts a new episode stream
+        # (another actor or env) so states are never stitched across streams
+        self.history_breaks = np.zeros(self.size, dtype=bool)
+        # (start, stop) slots whose transitions are never sampled, eg states held out for evaluation
+        self.holdout = None
 
         # Pre-allocate memory for the states and new_states in a minibatch
         self.states = np.empty((batch_size, self.agent_history_length,
@@ -43,12 +115,18 @@ class ReplayMemory:
         if self.num_heads == 1:
             assert(self.bernoulli_probability == 1.0)
 
+    def _allocate_frames(self):
+        return np.zeros((self.size, self.frame_height, self.frame_width), dtype=np.uint8)
+
     def save_buffer(self, filepath):
         st = time.time()
         print("starting save of buffer to %s"%filepath, st)
         np.savez(filepath,
                  frames=self.frames, actions=self.actions, rewards=self.rewards,
-                 terminal_flags=self.terminal_flags, masks=self.masks,
+                 terminal_flags=self.terminal_flags,
+                 masks=self.masks if self.masks is not None else np.zeros((0, self.num_heads), dtype=bool),
+                 hashed_masks=self.masks is None, mask_seed=self.mask_seed, total_added=self.total_added,
+                 history_breaks=self.history_breaks,
                  count=self.count, current=self.current,
                  agent_history_length=self.agent_history_length,
                  frame_height=self.frame_height, frame_width=self.frame_width,
@@ -56,15 +134,29 @@ class ReplayMemory:
                  )
         print("finished saving buffer", time.time()-st)
 
-    def load_buffer(self, filepath):
+    def load_buffer(self, filepath, mmap=False):
+        """
+        Args:
+            filepath: String, .npz written by save_buffer
+            mmap: bool, memory map the arrays read only instead of reading them -
+                for sampling from saved buffers without adding to them
+        """
         st = time.time()
         print("starting load of buffer from %s"%filepath, st)
-        npfile = np.load(filepath)
+        npfile = mmap_npz(filepath) if mmap else np.load(filepath)
         self.frames = npfile['frames']
         self.actions = npfile['actions']
         self.rewards = npfile['rewards']
         self.terminal_flags = npfile['terminal_flags']
         self.masks = npfile['masks']
+        if 'hashed_masks' in npfile and npfile['hashed_masks']:
+            self.masks = None
+        self.mask_seed = int(npfile['mask_seed']) if 'mask_seed' in npfile else 0
+        if 'history_breaks' in npfile:
+            self.history_breaks = npfile['history_breaks']
+        else:
+            # buffers saved before batched insertion only held one stream
+            self.history_breaks = np.zeros(self.frames.shape[0], dtype=bool)
         self.count = npfile['count']
         self.current = npfile['current']
         self.agent_history_length = npfile['agent_history_length']
@@ -72,6 +164,12 @@ class ReplayMemory:
         self.frame_width = npfile['frame_width']
         self.num_heads = npfile['num_heads']
         self.bernoulli_probability = npfile['bernoulli_probability']
+        self.size = self.frames.shape[0]
+        if 'total_added' in npfile:
+            self.total_added = int(npfile['total_added'])
+        else:
+            # only the position in the ring matters for buffers from before it was kept
+            self.total_added = int(self.count) if int(self.count) < self.size else self.size + int(self.current)
         if self.num_heads == 1:
             assert(self.bernoulli_probability == 1.0)
         print("finished loading buffer", time.time()-st)
@@ -92,11 +190,85 @@ class ReplayMemory:
         self.frames[self.current, ...] = frame
         self.rewards[self.current] = reward
         self.terminal_flags[self.current] = terminal
-        mask = self.random_state.binomial(1, self.bernoulli_probability, self.num_heads)
-        self.masks[self.current] = mask
+        if self.masks is not None:
+            mask = self.random_state.binomial(1, self.bernoulli_probability, self.num_heads)
+            self.masks[self.current] = mask
+        self.history_breaks[self.current] = False
+        self.total_added += 1
+        REPLAY_ADDED.inc()
         self.count = max(self.count, self.current+1)
         self.current = (self.current + 1) % self.size
 
+    def add_experiences(self, actions, frames, rewards, terminals, new_stream=False):
+        """
+        Batched add_experience for vectorized or multi-actor collection
+        Args:
+            actions: (N,) integers, or (S, N) for N steps of S parallel streams
+            frames: (N, 84, 84) or (S, N, 84, 84) uint8 frames
+            rewards: (N,) or (S, N) floats
+            terminals: (N,) or (S, N) bools
+            new_stream: bool, the N transitions do not follow on from the last
+                ones added, eg they come from a different actor. Each of S
+                parallel streams is always written as a new stream
+        """
+        frames = np.asarray(frames)
+        if frames.shape[-2:] != (self.frame_height, self.frame_width):
+            raise ValueError('Dimension of frame is wrong!')
+        n_streams = frames.shape[0] if frames.ndim == 4 else 1
+        n = frames.shape[-3]
+        actions = np.asarray(actions).reshape(n_streams, n)
+        rewards = np.asarray(rewards).reshape(n_streams, n)
+        terminals = np.asarray(terminals).reshape(n_streams, n)
+        frames = frames.reshape(n_streams, n, self.frame_height, self.frame_width)
+        # one draw for every mask - the same numbers add_experience would draw
+        if self.masks is not None:
+            masks = self.random_state.binomial(1, self.bernoulli_probability,
+                                               (n_streams, n, self.num_heads))
+        else:
+            masks = [None] * n_streams
+        for s in range(n_streams):
+            if (new_stream or n_streams > 1) and self.count > 0:
+                self.history_breaks[(self.current - 1) % self.size] = True
+            self._write_block(actions[s], frames[s], rewards[s], terminals[s], masks[s])
+
+    def _write_block(self, actions, frames, rewards, terminals, masks):
+        n = len(actions)
+        if n > self.size:
+            # only the last size transitions would survive anyway
+            self._write_block(actions[:n-self.size], frames[:n-self.size], rewards[:n-self.size],
+                              terminals[:n-self.size], masks[:n-self.size] if masks is not None else None)
+            actions, frames, rewards, terminals = (
+                a[n-self.size:] for a in (actions, frames, rewards, terminals))
+            masks = masks[n-self.size:] if masks is not None else None
+            n = self.size
+        # at most two slices - up to the end of the ring and then from its start
+        first = min(n, self.size - self.current)
+        for start, lo, hi in [(self.current, 0, first), (0, first, n)]:
+            if hi > lo:
+                stop = start + hi - lo
+                self.actions[start:stop] = actions[lo:hi]
+                self.frames[start:stop, ...] = frames[lo:hi]
+                self.rewards[start:stop] = rewards[lo:hi]
+                self.terminal_flags[start:stop] = terminals[lo:hi]
+                if masks is not None:
+                    self.masks[start:stop] = masks[lo:hi]
+                self.history_breaks[start:stop] = False
+        self.count = max(self.count, min(self.size, self.current + n))
+        self.current = (self.current + n) % self.size
+        self.total_added += n
+        REPLAY_ADDED.inc(n)
+
+    def transition_ids(self, indices):
+        """how many transitions were added before the ones in slots indices"""
+        laps = self.total_added // self.size
+        # slots behind the write head were written this lap, the rest the one before
+        return np.where(indices < self.current, laps, laps - 1) * self.size + indices
+
+    def get_masks(self, indices):
+        if self.masks is not None:
+            return self.masks[indices]
+        return bootstrap_masks(self.mask_seed, self.transition_ids(indices), self.num_heads, self.bernoulli_probability)
+
     def _get_state(self, index):
         if self.count is 0:
             raise ValueError("The replay memory is empty!")
@@ -119,6 +291,11 @@ class ReplayMemory:
                 # history_length steps
                 if self.terminal_flags[index - self.agent_history_length:index].any():
                     continue
+                # or if the history would run into another episode stream
+                if self.history_breaks[index - self.agent_history_length:index].any():
+                    continue
+                if self.holdout is not None and self.holdout[0] <= index < self.holdout[1]:
+                    continue
                 break
             self.indices[i] = index
 
@@ -126,6 +303,7 @@ class ReplayMemory:
         """
         Returns a minibatch of batch_size
         """
+        st = time.perf_counter()
         if batch_size != self.states.shape[0]:
             self.states = np.empty((batch_size, self.agent_history_length,
                                     self.frame_height, self.frame_width), dtype=np.uint8)
@@ -140,6 +318,41 @@ class ReplayMemory:
         for i, idx in enumerate(self.indices):
             self.states[i] = self._get_state(idx - 1)
             self.new_states[i] = self._get_state(idx)
-        return self.states, self.actions[self.indices], self.rewards[self.indices], self.new_states, self.terminal_flags[self.indices], self.masks[self.indices]
+        REPLAY_SAMPLED.inc(batch_size)
+        REPLAY_SAMPLE_SECONDS.observe(time.perf_counter() - st)
+        return self.states, self.actions[self.indices], self.rewards[self.indices], self.new_states, self.terminal_flags[self.indices], self.get_masks(self.indices)
 
 
+
+def benchmark_masks(size=200000, num_heads=100, batch_size=32, n_batches=2000):
+    """memory and sampling cost of stored against hashed masks"""
+    random_state = np.random.RandomState(0)
+    frames = random_state.randint(0, 256, (1000, 84, 84)).astype(np.uint8)
+    for hashed in [False, True]:
+        memory = ReplayMemory(size=size, num_heads=num_heads, batch_size=batch_size,
+                              bernoulli_probability=0.5, hashed_masks=hashed)
+        st = time.time()
+        for start in range(0, size, len(frames)):
+            memory.add_experiences(random_state.randint(0, 4, len(frames)), frames,
+                                   np.zeros(len(frames)), random_state.rand(len(frames)) < 0.002)
+        add_time = time.time() - st
+        st = time.time()
+        for _ in range(n_batches):
+            memory.get_masks(memory.random_state.randint(0, size, batch_size))
+        mask_time = time.time() - st
+        st = time.time()
+        for _ in range(n_batches // 10):
+            memory.get_minibatch(batch_size)
+        batch_time = time.time() - st
+        mask_bytes = memory.masks.nbytes if memory.masks is not None else 0
+        print("%s masks: %7.1f MB, adding %8.0f transitions/sec, masks of a batch %6.1f us, get_minibatch %6.1f us" % (
+              'hashed' if hashed else 'stored', mask_bytes / 1e6, size / add_time,
+              1e6 * mask_time / n_batches, 1e6 * batch_time / (n_batches // 10)))
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('--size', default=200000, type=int)
+    parser.add_argument('--num_heads', default=100, type=int)
+    args = parser.parse_args()
+    benchmark_masks(args.size, args.num_heads)
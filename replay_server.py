@@ -0,0 +1,373 @@
+import os
+import json
+import time
+import socket
+import queue
+import struct
+import threading
+import socketserver
+from collections import deque
+import numpy as np
+from replay import ReplayMemory
+
+# Every message is a fixed header followed by payload_len bytes. Frames and the
+# other transition arrays travel as raw little endian buffers in a fixed order,
+# so neither side ever pickles anything. Replies come back in request order,
+# which lets a client keep several requests in flight on one connection.
+#   request header: op (uint8), n (uint32), payload_len (uint64)
+#   reply header:   status (uint8), n (uint32), payload_len (uint64)
+HEADER = struct.Struct('<BIQ')
+OP_ADD_BATCH = 1
+OP_SAMPLE_BATCH = 2
+OP_STATS = 3
+OP_SAVE = 4
+OP_LOAD = 5
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+def parse_address(address):
+    """'unix:/path/to.sock' or 'host:port' -> (socket family, sockaddr)"""
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    host, port = address.rsplit(':', 1)
+    return socket.AF_INET, (host, int(port))
+
+def recv_into(sock, buf):
+    view = memoryview(buf).cast('B')
+    while len(view):
+        nbytes = sock.recv_into(view)
+        if not nbytes:
+            raise ConnectionError('replay socket closed')
+        view = view[nbytes:]
+    return buf
+
+def recv_header(sock):
+    return HEADER.unpack(bytes(recv_into(sock, bytearray(HEADER.size))))
+
+def send_message(sock, code, n, arrays=()):
+    arrays = [np.ascontiguousarray(a) for a in arrays]
+    sock.sendall(HEADER.pack(code, n, sum(a.nbytes for a in arrays)))
+    for a in arrays:
+        sock.sendall(memoryview(a).cast('B'))
+
+def batch_layout(n, history, height, width, num_heads):
+    """dtype and shape of each array in a sample_batch reply, in wire order"""
+    return [(np.uint8, (n, history, height, width)),
+            (np.int32, (n,)),
+            (np.float32, (n,)),
+            (np.uint8, (n, history, height, width)),
+            (np.bool_, (n,)),
+            (np.bool_, (n, num_heads))]
+
+def add_layout(n, height, width):
+    """dtype and shape of each array in an add_batch request, in wire order"""
+    return [(np.int32, (n,)),
+            (np.uint8, (n, height, width)),
+            (np.float32, (n,)),
+            (np.bool_, (n,))]
+
+def recv_arrays(sock, layout):
+    return [recv_into(sock, np.empty(shape, dtype=dtype)) for dtype, shape in layout]
+
+
+class ReplayRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        sock = self.request
+        if sock.family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # replies go out from their own thread so a client that is still
+        # sending an add_batch never waits on us sending it a large sample
+        replies = queue.Queue()
+        writer = threading.Thread(target=self.write_replies, args=(sock, replies), daemon=True)
+        writer.start()
+        try:
+            self.read_requests(sock, replies)
+        finally:
+            replies.put(None)
+            writer.join()
+
+    @staticmethod
+    def write_replies(sock, replies):
+        while True:
+            reply = replies.get()
+            if reply is None:
+                return
+            try:
+                send_message(sock, *reply)
+            except OSError:
+                return
+
+    def read_requests(self, sock, replies):
+        memory = self.server.replay_memory
+        lock = self.server.lock
+        while True:
+            try:
+                op, n, payload_len = recv_header(sock)
+            except (ConnectionError, OSError):
+                return
+            if op == OP_ADD_BATCH:
+                actions, frames, rewards, terminals = recv_arrays(
+                    sock, add_layout(n, memory.frame_height, memory.frame_width))
+                with lock:
+                    # each connection is its own episode stream
+                    memory.add_experiences(actions, frames, rewards, terminals,
+                                           new_stream=self.server.last_writer is not self)
+                    self.server.last_writer = self
+                    count = memory.count
+                replies.put((STATUS_OK, count))
+            elif op == OP_SAMPLE_BATCH:
+                try:
+                    with lock:
+                        states, actions, rewards, new_states, terminals, masks = memory.get_minibatch(n)
+                        # the memory reuses its states buffers between calls
+                        states, new_states = states.copy(), new_states.copy()
+                    replies.put((STATUS_OK, n, [states, actions, rewards, new_states, terminals, masks]))
+                except ValueError as e:
+                    replies.put((STATUS_ERROR, 0, [np.frombuffer(str(e).encode(), np.uint8)]))
+            elif op in (OP_STATS, OP_SAVE, OP_LOAD):
+                payload = bytes(recv_into(sock, bytearray(payload_len)))
+                with lock:
+                    if op == OP_SAVE:
+                        memory.save_buffer(payload.decode())
+                    elif op == OP_LOAD:
+                        memory.load_buffer(payload.decode())
+                    stats = {'count': int(memory.count), 'current': int(memory.current),
+                             'size': int(memory.size), 'num_heads': int(memory.num_heads),
+                             'agent_history_length': int(memory.agent_history_length),
+                             'frame_height': int(memory.frame_height),
+                             'frame_width': int(memory.frame_width)}
+                replies.put((STATUS_OK, 0, [np.frombuffer(json.dumps(stats).encode(), np.uint8)]))
+            else:
+                print("replay server got unknown op %s, closing connection" % op)
+                return
+
+
+class ThreadingUnixReplayServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class ThreadingTCPReplayServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def make_server(address, replay_memory):
+    """Serve replay_memory on address. Call serve_forever() on the result."""
+    family, sockaddr = parse_address(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(sockaddr):
+            os.remove(sockaddr)
+        server = ThreadingUnixReplayServer(sockaddr, ReplayRequestHandler)
+    else:
+        server = ThreadingTCPReplayServer(sockaddr, ReplayRequestHandler)
+    server.replay_memory = replay_memory
+    server.lock = threading.Lock()
+    server.last_writer = None
+    return server
+
+
+class ReplayClient:
+    """Drop-in stand in for ReplayMemory that talks to a replay server"""
+    def __init__(self, address, flush_every=64, prefetch=2, connect_timeout=60):
+        """
+        Args:
+            address: 'unix:/path/to.sock' or 'host:port' of a replay server
+            flush_every: Integer, transitions buffered locally before they are sent as one add_batch
+            prefetch: Integer, number of sample_batch requests kept in flight
+            connect_timeout: Float, seconds to keep retrying while the server comes up
+        """
+        family, sockaddr = parse_address(address)
+        st = time.time()
+        while True:
+            try:
+                self.sock = socket.socket(family, socket.SOCK_STREAM)
+                self.sock.connect(sockaddr)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                self.sock.close()
+                if time.time() - st > connect_timeout:
+                    raise
+                time.sleep(.1)
+        if family == socket.AF_INET:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.flush_every = flush_every
+        self.prefetch = prefetch
+        # (kind, n) of the requests whose replies have not been read yet, in order
+        self.pending = deque()
+        self.local_n = 0
+        stats = self.stats()
+        self.size = stats['size']
+        self.num_heads = stats['num_heads']
+        self.agent_history_length = stats['agent_history_length']
+        self.frame_height = stats['frame_height']
+        self.frame_width = stats['frame_width']
+        self.count = stats['count']
+        self._reset_local()
+
+    def _reset_local(self):
+        self.local_actions = np.empty(self.flush_every, dtype=np.int32)
+        self.local_frames = np.empty((self.flush_every, self.frame_height, self.frame_width), dtype=np.uint8)
+        self.local_rewards = np.empty(self.flush_every, dtype=np.float32)
+        self.local_terminals = np.empty(self.flush_every, dtype=bool)
+        self.local_n = 0
+
+    def _read_reply(self):
+        kind, _ = self.pending.popleft()
+        status, n, payload_len = recv_header(self.sock)
+        if status != STATUS_OK:
+            msg = bytes(recv_into(self.sock, bytearray(payload_len))).decode()
+            raise ValueError(msg)
+        if kind == OP_ADD_BATCH:
+            self.count = n
+            return None
+        elif kind == OP_SAMPLE_BATCH:
+            return recv_arrays(self.sock, batch_layout(n, self.agent_history_length, self.frame_height,
+                                                       self.frame_width, self.num_heads))
+        else:
+            return json.loads(bytes(recv_into(self.sock, bytearray(payload_len))).decode())
+
+    def _request(self, op, n, arrays=()):
+        send_message(self.sock, op, n, arrays)
+        self.pending.append((op, n))
+
+    def _drain(self, kinds=(OP_ADD_BATCH,), keep=0):
+        # read the replies at the head of the queue that nobody waits on
+        while len(self.pending) > keep and self.pending[0][0] in kinds:
+            self._read_reply()
+
+    def _call(self, op, payload=b''):
+        self.flush()
+        self._drain((OP_ADD_BATCH, OP_SAMPLE_BATCH))
+        self._request(op, 0, [np.frombuffer(payload, np.uint8)])
+        return self._read_reply()
+
+    def add_experiences(self, actions, frames, rewards, terminals):
+        """Send N transitions as one add_batch without waiting for the reply"""
+        self._request(OP_ADD_BATCH, len(actions), [np.asarray(actions, dtype=np.int32),
+                                                   np.asarray(frames, dtype=np.uint8),
+                                                   np.asarray(rewards, dtype=np.float32),
+                                                   np.asarray(terminals, dtype=bool)])
+        # let a few acks stay unread so sends are not serialized on round trips
+        self._drain(keep=self.prefetch + 4)
+
+    def add_experience(self, action, frame, reward, terminal):
+        if frame.shape != (self.frame_height, self.frame_width):
+            raise ValueError('Dimension of frame is wrong!')
+        i = self.local_n
+        self.local_actions[i] = action
+        self.local_frames[i] = frame
+        self.local_rewards[i] = reward
+        self.local_terminals[i] = terminal
+        self.local_n += 1
+        if self.local_n == self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self.local_n:
+            n = self.local_n
+            self.add_experiences(self.local_actions[:n], self.local_frames[:n],
+                                 self.local_rewards[:n], self.local_terminals[:n])
+            self.local_n = 0
+
+    def get_minibatch(self, batch_size):
+        """
+        Returns a minibatch of batch_size, same as ReplayMemory.get_minibatch.
+        Keeps self.prefetch requests in flight so sampling overlaps the caller's work
+        """
+        self.flush()
+        # prefetches were sent with the last caller's batch_size - read and drop
+        # the ones of another size, eg the learner's before a calibration batch
+        while self.pending and (self.pending[0][0] == OP_ADD_BATCH or
+                                (self.pending[0][0] == OP_SAMPLE_BATCH and self.pending[0][1] != batch_size)):
+            self._read_reply()
+        in_flight = sum(kind == OP_SAMPLE_BATCH and n == batch_size for kind, n in self.pending)
+        for _ in range(max(1, self.prefetch) - in_flight):
+            self._request(OP_SAMPLE_BATCH, batch_size)
+        batch = self._read_reply()
+        if self.prefetch:
+            self._request(OP_SAMPLE_BATCH, batch_size)
+        return batch
+
+    def stats(self):
+        return self._call(OP_STATS)
+
+    def save_buffer(self, filepath):
+        return self._call(OP_SAVE, filepath.encode())
+
+    def load_buffer(self, filepath):
+        return self._call(OP_LOAD, filepath.encode())
+
+    def close(self):
+        self.flush()
+        self.sock.close()
+
+
+def serve(address, **replay_kwargs):
+    replay_memory = ReplayMemory(**replay_kwargs)
+    server = make_server(address, replay_memory)
+    print("serving replay memory of size %s on %s" % (replay_memory.size, address))
+    server.serve_forever()
+
+def benchmark(address, size, num_heads, n_transitions, batch_size, n_batches):
+    from multiprocessing import Process
+    server = Process(target=serve, args=(address,),
+                     kwargs={'size': size, 'num_heads': num_heads, 'batch_size': batch_size,
+                             'bernoulli_probability': 0.9 if num_heads > 1 else 1.0},
+                     daemon=True)
+    server.start()
+    random_state = np.random.RandomState(0)
+    frames = random_state.randint(0, 255, (1000, 84, 84)).astype(np.uint8)
+    try:
+        for flush_every in [1, 64, 512]:
+            client = ReplayClient(address, flush_every=flush_every)
+            st = time.time()
+            for i in range(n_transitions):
+                client.add_experience(i % 18, frames[i % len(frames)], 0.0, not (i+1) % 500)
+            client.stats()
+            et = time.time() - st
+            print("add_batch flush_every=%4d: %9.0f transitions/sec" % (flush_every, n_transitions/et))
+            client.close()
+        for prefetch in [0, 1, 4]:
+            client = ReplayClient(address, prefetch=prefetch)
+            st = time.time()
+            for i in range(n_batches):
+                client.get_minibatch(batch_size)
+            et = time.time() - st
+            print("sample_batch prefetch=%d: %7.1f batches/sec %9.0f transitions/sec" % (
+                  prefetch, n_batches/et, n_batches*batch_size/et))
+            client.close()
+        # reference: the same memory used in process
+        memory = ReplayMemory(size=size, num_heads=num_heads, batch_size=batch_size,
+                              bernoulli_probability=0.9 if num_heads > 1 else 1.0)
+        for i in range(n_transitions):
+            memory.add_experience(i % 18, frames[i % len(frames)], 0.0, not (i+1) % 500)
+        st = time.time()
+        for i in range(n_batches):
+            memory.get_minibatch(batch_size)
+        et = time.time() - st
+        print("in process get_minibatch: %7.1f batches/sec" % (n_batches/et))
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('-a', '--address', default='unix:/tmp/bootstrap_replay.sock', help='unix:/path or host:port')
+    parser.add_argument('--size', default=1000000, type=int, help='number of transitions stored by the server')
+    parser.add_argument('--num_heads', default=1, type=int)
+    parser.add_argument('--bernoulli_probability', default=1.0, type=float)
+    parser.add_argument('--hashed_masks', action='store_true', default=False, help='derive masks when sampling instead of storing them')
+    parser.add_argument('--mask_seed', default=0, type=int, help='seed of the hashed masks, different for each shard')
+    parser.add_argument('--history_size', default=4, type=int)
+    parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--bench', action='store_true', default=False, help='run the throughput benchmark against a local server')
+    parser.add_argument('--bench_transitions', default=50000, type=int)
+    parser.add_argument('--bench_batches', default=2000, type=int)
+    args = parser.parse_args()
+    if args.bench:
+        benchmark(args.address, min(args.size, 100000), args.num_heads,
+                  args.bench_transitions, args.batch_size, args.bench_batches)
+    else:
+        serve(args.address, size=args.size, num_heads=args.num_heads,
+              bernoulli_probability=args.bernoulli_probability,
+              hashed_masks=args.hashed_masks, mask_seed=args.mask_seed,
+              agent_history_length=args.history_size, batch_size=args.batch_size)
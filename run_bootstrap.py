@@ -1,4 +1,7 @@
 from __future__ import print_function
+import time
+# taken before the heavy imports so time-to-first-step covers all of startup
+PROCESS_START_TIME = time.time()
 import os
 import numpy as np
 from collections import Counter
@@ -7,18 +10,48 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 import datetime
-import time
+import copy
+import contextlib
+import tempfile
+import threading
+import queue
 from dqn_model import EnsembleNet, NetWithPrior
-from dqn_utils import seed_everything, write_info_file, generate_gif, save_checkpoint
+from dqn_utils import seed_everything, write_info_file, generate_gif, save_checkpoint, load_checkpoint
 from env import Environment
 from replay import ReplayMemory
+from replay_server import ReplayClient
+from tiered_replay import TieredReplayMemory
+from action_replay import ActionLogReplayMemory
+from prefill import prefill_replay, env_kwargs_from_info
+from quantize import quantize_policy_net, compare_policies
+from metrics import MetricsStore
+from memory_budget import fit_to_budget, format_plan, available_memory, measure_memory, GB
 import config
+import live_metrics
 # from torch.utils.tensorboard import SummaryWriter
-import mlflow
-import mlflow.pytorch
+# mlflow is imported lazily in get_mlflow() - importing it and logging the
+# models costs several seconds that used to be paid before the first env step
+mlflow = None
+mlflow_lock = threading.Lock()
+# (name, value, step) metrics from the pipelined learner thread - mlflow's
+# active run is per thread, so only the main thread logs them
+pending_metrics = queue.Queue()
 
 torch.set_num_threads(2)
 
+LEARNER_UPDATES = live_metrics.counter('learner_updates', 'ptlearn updates')
+LEARNER_UPDATE_SECONDS = live_metrics.histogram('learner_update_seconds', 'ptlearn time',
+                                                buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1.))
+LEARNER_LOSS = live_metrics.gauge('learner_loss', 'mean head loss of the last update')
+TRAIN_STEP = live_metrics.gauge('train_step', 'env steps taken in training')
+LAST_EVAL_STEP = live_metrics.gauge('last_eval_step', 'train step of the last evaluation')
+EVAL_LAG = live_metrics.gauge('eval_lag_steps', 'train steps since the last evaluation',
+                              function=lambda: TRAIN_STEP.value - LAST_EVAL_STEP.value)
+EVAL_SECONDS = live_metrics.histogram('eval_seconds', 'time training stalled for an evaluation')
+CHECKPOINT_SECONDS = live_metrics.histogram('checkpoint_seconds', 'time training stalled writing a checkpoint')
+ENV_STEPS_PER_SEC = live_metrics.gauge('env_steps_per_sec', 'training env steps/sec over the last episode')
+UPDATES_PER_SEC = live_metrics.gauge('learner_updates_per_sec', 'ptlearn updates/sec over the last episode')
+
 def rolling_average(a, n=5):
     if n == 0:
         return a
@@ -48,17 +81,78 @@ def log_dict_losses(writer, plot_dict, step):
 #     log_dict_losses(writer, {'steps avg reward': {'index': steps, 'val': p['avg_rewards']}}, step)
 #     log_dict_losses(writer, {'eval rewards': {'index': p['eval_steps'], 'val': p['eval_rewards']}}, step)
 
-def mlflow_log_all(p, step):
-    mlflow.log_metric("episode_step", p['episode_step'][-1], step)
-    mlflow.log_metric("episode_head", p['episode_head'][-1], step)
-    mlflow.log_metric("eps_list", p['eps_list'][-1], step)
-    mlflow.log_metric("episode_loss", p['episode_loss'][-1], step)
-    mlflow.log_metric("episode_reward", p['episode_reward'][-1], step)
-    mlflow.log_metric("episode_times", p['episode_times'][-1], step)
-    mlflow.log_metric("episode_relative_times", p['episode_relative_times'][-1], step)
-    mlflow.log_metric("avg_rewards", p['avg_rewards'][-1], step)
-    mlflow.log_metric("eval_rewards", p['eval_rewards'][-1], step)
-    mlflow.log_metric("eval_steps", p['eval_steps'][-1], step)
+def get_mlflow():
+    """Import mlflow and start the run on first use.
+
+    The model snapshots taken at startup are written from a background thread
+    so serializing them does not stall training.
+    """
+    global mlflow, mlflow_model_thread
+    with mlflow_lock:
+        if mlflow is None:
+            st = time.time()
+            import mlflow as _mlflow
+            run_name = f"{info['VOTING_HEADS']}_{info['N_ENSEMBLE']}"
+            _mlflow.start_run(run_name=run_name)
+            _mlflow.log_params(ml_config)
+            if 'TIME_TO_FIRST_STEP' in info:
+                _mlflow.log_metric("time_to_first_step", info['TIME_TO_FIRST_STEP'])
+            run_id = _mlflow.active_run().info.run_id
+            mlflow_model_thread = threading.Thread(target=log_models, args=(run_id, startup_models), daemon=True)
+            mlflow_model_thread.start()
+            # only published once the run is started, so no thread sees a half made run
+            mlflow = _mlflow
+            print("started mlflow run", time.time() - st)
+    return mlflow
+
+def log_models(run_id, models):
+    # the fluent api keeps the active run per thread, so save locally and
+    # upload with the client against an explicit run id
+    import mlflow.pytorch
+    from mlflow.tracking import MlflowClient
+    st = time.time()
+    client = MlflowClient()
+    for name, model in models:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            model_path = os.path.join(tmpdir, name)
+            mlflow.pytorch.save_model(model, model_path)
+            client.log_artifacts(run_id, model_path, "models/%s" % name)
+    print("finished logging models to mlflow", time.time() - st)
+
+def end_mlflow():
+    if mlflow is not None:
+        log_pending_metrics(mlflow)
+        mlflow_model_thread.join()
+        mlflow.end_run()
+
+def log_pending_metrics(mlflow):
+    while True:
+        try:
+            name, value, step = pending_metrics.get_nowait()
+        except queue.Empty:
+            return
+        mlflow.log_metric(name, value, step)
+
+def mlflow_log_all(m, step):
+    mlflow = get_mlflow()
+    log_pending_metrics(mlflow)
+    episodes = m.episodes
+    mlflow.log_metric("episode_step", episodes.last('episode_step'), step)
+    # a metric is a single number - log the first of the voting heads
+    mlflow.log_metric("episode_head", np.atleast_1d(episodes.last('episode_head'))[0], step)
+    mlflow.log_metric("eps_list", episodes.last('eps_list'), step)
+    mlflow.log_metric("episode_loss", episodes.last('episode_loss'), step)
+    mlflow.log_metric("episode_reward", episodes.last('episode_reward'), step)
+    mlflow.log_metric("episode_times", episodes.last('episode_times'), step)
+    mlflow.log_metric("episode_relative_times", episodes.last('episode_relative_times'), step)
+    mlflow.log_metric("avg_rewards", episodes.last('avg_rewards'), step)
+    mlflow.log_metric("steps_per_sec", episodes.last('episode_step') / episodes.last('episode_times'), step)
+    if len(m.evals):
+        mlflow.log_metric("eval_rewards", m.evals.last('eval_rewards'), step)
+        mlflow.log_metric("eval_steps", m.evals.last('eval_steps'), step)
+    if len(m.memory):
+        for col in ['rss', 'replay', 'nets', 'optimizer', 'env_frames', 'other']:
+            mlflow.log_metric("memory_%s_gb" % col, m.memory.last(col) / GB, step)
 
 def handle_checkpoint(last_save, cnt):
     if (cnt - last_save) >= info['CHECKPOINT_EVERY_STEPS']:
@@ -71,7 +165,8 @@ def handle_checkpoint(last_save, cnt):
             'cnt': cnt,
             'policy_net_state_dict': policy_net.state_dict(),
             'target_net_state_dict': target_net.state_dict(),
-            'perf': perf,
+            # the metrics live in their own log - only keep how far it got
+            'perf_offsets': metrics.offsets(),
         }
         filename = os.path.abspath(model_base_filepath + "_%010dq.pkl" % cnt)
         save_checkpoint(state, filename)
@@ -79,6 +174,7 @@ def handle_checkpoint(last_save, cnt):
         buff_filename = os.path.abspath(model_base_filepath + "_%010dq_train_buffer" % cnt)
         replay_memory.save_buffer(buff_filename)
         print("finished checkpoint", time.time() - st)
+        CHECKPOINT_SECONDS.observe(time.time() - st)
         return last_save
     else:
         return last_save
@@ -146,8 +242,8 @@ class ActionGetter:
         if self.random_state.rand() < eps:
             return eps, self.random_state.randint(0, self.n_actions)
         else:
-            state = torch.Tensor(state.astype(float) / info['NORM_BY'])[None, :].to(info['DEVICE'])
-            vals = policy_net(state, None)
+            state = torch.Tensor(state.astype(float) / info['NORM_BY'])[None, :].to(act_device)
+            vals = act_net(state, None)
             # vote on action
             if active_heads is not None:
                 acts = [torch.argmax(vals[h], dim=1).item() for h in active_heads]
@@ -160,7 +256,33 @@ class ActionGetter:
                 action = data.most_common(1)[0][0]
                 return eps, action
 
+def sample_minibatch(batch_size):
+    # the pipelined learner samples while the main thread adds experience
+    with replay_lock:
+        return replay_memory.get_minibatch(batch_size)
+
+def refresh_act_net(step_number):
+    """With INT8_ACTING, rebuild the int8 cpu copy of policy_net used for acting"""
+    global act_net, act_device
+    if not info['INT8_ACTING']:
+        return
+    st = time.time()
+    calibration_states = sample_minibatch(info['INT8_CALIBRATION_SIZE'])[0].copy()
+    act_net = quantize_policy_net(policy_net, calibration_states, info['NORM_BY'])
+    act_device = 'cpu'
+    # agreement is measured on a fresh batch rather than the calibration one
+    check_states = sample_minibatch(info['INT8_CALIBRATION_SIZE'])[0].copy()
+    agreement, fp32_ms, int8_ms = compare_policies(policy_net, act_net, check_states, info['N_ENSEMBLE'],
+                                                   env.num_actions, info['NORM_BY'])
+    print("int8 acting net refreshed in %.2fs: action agreement %.4f, fp32 %.3f ms/step, int8 %.3f ms/step" % (
+          time.time() - st, agreement, fp32_ms, int8_ms))
+    # this can run on the pipelined learner thread - mlflow_log_all logs them from the main thread
+    pending_metrics.put(("int8_action_agreement", agreement, step_number))
+    pending_metrics.put(("int8_ms_per_step", int8_ms, step_number))
+    pending_metrics.put(("fp32_ms_per_step", fp32_ms, step_number))
+
 def ptlearn(states, actions, rewards, next_states, terminal_flags, masks):
+    st = time.perf_counter()
     states = torch.Tensor(states.astype(float) / info['NORM_BY']).to(info['DEVICE'])
     next_states = torch.Tensor(next_states.astype(float) / info['NORM_BY']).to(info['DEVICE'])
     rewards = torch.Tensor(rewards).to(info['DEVICE'])
@@ -204,12 +326,104 @@ def ptlearn(states, actions, rewards, next_states, terminal_flags, masks):
             param.grad.data *= 1.0 / float(info['N_ENSEMBLE'])
     nn.utils.clip_grad_norm_(policy_net.parameters(), info['CLIP_GRAD'])
     opt.step()
+    LEARNER_UPDATES.inc()
+    LEARNER_UPDATE_SECONDS.observe(time.perf_counter() - st)
+    LEARNER_LOSS.set(np.mean(losses))
     return np.mean(losses)
 
+class PipelinedLearner(threading.Thread):
+    """Runs ptlearn on its own thread while the main thread steps the env.
+
+    torch releases the GIL inside its ops, so learning overlaps emulation. The
+    learner is held to one update per LEARN_EVERY_STEPS env steps, as in the
+    serial loop, and the env may only run max_lag updates ahead of it. Acting
+    uses a copy of policy_net refreshed every snapshot_every updates.
+    """
+    def __init__(self, step_number, max_lag=4, snapshot_every=100):
+        super(PipelinedLearner, self).__init__(daemon=True)
+        self.max_lag = max_lag
+        self.snapshot_every = snapshot_every
+        self.env_steps = step_number
+        self.updates = self.allowed_updates(step_number)
+        # held for a whole update - take it to read or save consistent weights
+        self.learn_lock = threading.Lock()
+        self.cond = threading.Condition()
+        self.losses = []
+        self.stopped = False
+        self.error = None
+
+    @staticmethod
+    def allowed_updates(env_steps):
+        # the number of updates the serial loop has made by env_steps
+        return max(0, env_steps // info['LEARN_EVERY_STEPS'] - info['MIN_HISTORY_TO_LEARN'] // info['LEARN_EVERY_STEPS'])
+
+    def run(self):
+        global act_net
+        try:
+            while True:
+                with self.cond:
+                    while not self.stopped and self.updates >= self.allowed_updates(self.env_steps):
+                        self.cond.wait()
+                    if self.stopped:
+                        return
+                with self.learn_lock:
+                    self.losses.append(ptlearn(*sample_minibatch(info['BATCH_SIZE'])))
+                    # the env step the serial loop would have made this update at
+                    learn_step = (self.updates + 1 + info['MIN_HISTORY_TO_LEARN'] // info['LEARN_EVERY_STEPS']) * info['LEARN_EVERY_STEPS']
+                    if learn_step % info['TARGET_UPDATE'] == 0:
+                        print("++++++++++++++++++++++++++++++++++++++++++++++++")
+                        print('updating target network at %s' % learn_step)
+                        target_net.load_state_dict(policy_net.state_dict())
+                        refresh_act_net(learn_step)
+                    if not info['INT8_ACTING'] and not (self.updates + 1) % self.snapshot_every:
+                        # swap in a whole new copy so acting never sees a half written net
+                        act_net = copy.deepcopy(policy_net)
+                with self.cond:
+                    self.updates += 1
+                    self.cond.notify_all()
+        except Exception as e:
+            self.error = e
+            self.stop()
+            raise
+
+    def env_step(self, step_number):
+        """called by the main thread after every env step"""
+        self.env_steps = step_number
+        if step_number % info['LEARN_EVERY_STEPS']:
+            return
+        with self.cond:
+            self.cond.notify_all()
+            while not self.stopped and self.allowed_updates(step_number) - self.updates > self.max_lag:
+                self.cond.wait()
+        if self.error is not None:
+            raise RuntimeError('pipelined learner failed') from self.error
+
+    def take_losses(self):
+        losses, self.losses = self.losses, []
+        return losses
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+def learner_paused():
+    """context that keeps the pipelined learner from updating, if there is one"""
+    return learner.learn_lock if learner is not None else contextlib.nullcontext()
+
 def train(step_number, last_save):
     """Contains the training and evaluation loops"""
-    epoch_num = len(perf['steps'])
-    writer = SummaryWriter(log_dir=model_base_filedir)
+    global learner, act_net
+    epoch_num = len(metrics.episodes)
+    # writer = SummaryWriter(log_dir=model_base_filedir)
+    if info['PIPELINED']:
+        if act_net is policy_net:
+            act_net = copy.deepcopy(policy_net)
+        learner = PipelinedLearner(step_number)
+        learner.start()
+        live_metrics.gauge('learner_lag_updates', 'updates the pipelined learner is behind the env',
+                           function=lambda: learner.allowed_updates(learner.env_steps) - learner.updates)
+        print("learning on a separate thread")
 
     while step_number < info['MAX_STEPS']:
         ########################
@@ -223,6 +437,7 @@ def train(step_number, last_save):
             start_steps = step_number
             st = time.time()
             episode_reward_sum = 0
+            start_updates = LEARNER_UPDATES.value
             random_state.shuffle(heads)
             active_heads = heads[:info['VOTING_HEADS']]  # Use a subset of heads for voting
             epoch_num += 1
@@ -235,59 +450,105 @@ def train(step_number, last_save):
                 else:
                     eps, action = action_getter.pt_get_action(step_number, state=state, active_heads=active_heads)
                 ep_eps_list.append(eps)
+                if info['ACTION_LOG']:
+                    replay_memory.before_step(env)
                 next_state, reward, life_lost, terminal = env.step(action)
+                if 'TIME_TO_FIRST_STEP' not in info:
+                    info['TIME_TO_FIRST_STEP'] = time.time() - PROCESS_START_TIME
+                    print("time to first step: %.2fs" % info['TIME_TO_FIRST_STEP'])
                 # Store transition in the replay memory
-                replay_memory.add_experience(
-                    action=action,
-                    frame=next_state[-1],
-                    reward=np.sign(reward),  # TODO - maybe there should be +1 here
-                    terminal=life_lost
-                )
+                with replay_lock:
+                    replay_memory.add_experience(
+                        action=action,
+                        frame=next_state[-1],
+                        reward=np.sign(reward),  # TODO - maybe there should be +1 here
+                        terminal=life_lost
+                    )
 
                 step_number += 1
+                TRAIN_STEP.set(step_number)
                 epoch_frame += 1
                 episode_reward_sum += reward
                 state = next_state
 
+                if learner is not None:
+                    learner.env_step(step_number)
+                    continue
                 if step_number % info['LEARN_EVERY_STEPS'] == 0 and step_number > info['MIN_HISTORY_TO_LEARN']:
-                    _states, _actions, _rewards, _next_states, _terminal_flags, _masks = replay_memory.get_minibatch(info['BATCH_SIZE'])
+                    _states, _actions, _rewards, _next_states, _terminal_flags, _masks = sample_minibatch(info['BATCH_SIZE'])
                     ptloss = ptlearn(_states, _actions, _rewards, _next_states, _terminal_flags, _masks)
                     ptloss_list.append(ptloss)
                 if step_number % info['TARGET_UPDATE'] == 0 and step_number > info['MIN_HISTORY_TO_LEARN']:
                     print("++++++++++++++++++++++++++++++++++++++++++++++++")
                     print('updating target network at %s' % step_number)
                     target_net.load_state_dict(policy_net.state_dict())
+                    refresh_act_net(step_number)
 
             et = time.time()
             ep_time = et - st
-            perf['steps'].append(step_number)
-            perf['episode_step'].append(step_number - start_steps)
-            perf['episode_head'].append(active_heads)
-            perf['eps_list'].append(np.mean(ep_eps_list))
-            perf['episode_loss'].append(np.mean(ptloss_list))
-            perf['episode_reward'].append(episode_reward_sum)
-            perf['episode_times'].append(ep_time)
-            perf['episode_relative_times'].append(time.time() - info['START_TIME'])
-            perf['avg_rewards'].append(np.mean(perf['episode_reward'][-100:]))
-            last_save = handle_checkpoint(last_save, step_number)
+            ENV_STEPS_PER_SEC.set((step_number - start_steps) / ep_time)
+            UPDATES_PER_SEC.set((LEARNER_UPDATES.value - start_updates) / ep_time)
+            if learner is not None:
+                ptloss_list = learner.take_losses()
+            avg_reward = metrics.add_episode(steps=step_number,
+                                             episode_step=step_number - start_steps,
+                                             episode_head=active_heads,
+                                             eps=np.mean(ep_eps_list),
+                                             loss=np.mean(ptloss_list) if len(ptloss_list) else np.nan,
+                                             reward=episode_reward_sum,
+                                             episode_time=ep_time,
+                                             relative_time=time.time() - info['START_TIME'])
+            with learner_paused():
+                last_save = handle_checkpoint(last_save, step_number)
 
             if not epoch_num % info['PLOT_EVERY_EPISODES'] and step_number > info['MIN_HISTORY_TO_LEARN']:
                 # TODO plot title
-                print('avg reward', perf['avg_rewards'][-1])
-                print('last rewards', perf['episode_reward'][-info['PLOT_EVERY_EPISODES']:])
-
-                mlflow_log_all(perf, step_number)
+                print('avg reward', avg_reward)
+                print('steps/sec %.1f (%s)' % ((step_number - start_steps) / ep_time, 'pipelined' if learner is not None else 'serial'))
+                print('last rewards', metrics.episodes.tail('episode_reward', info['PLOT_EVERY_EPISODES']).tolist())
+                if isinstance(replay_memory, TieredReplayMemory):
+                    with replay_lock:
+                        tiers = replay_memory.tier_report()
+                    print('replay sampling %.0f transitions/sec, frames from ram %d, cache %d, disk %d' % (
+                          tiers['transitions_per_sec'], tiers['ram_frames'], tiers['cache_frames'], tiers['disk_frames']))
+                    get_mlflow().log_metric("replay_transitions_per_sec", tiers['transitions_per_sec'], step_number)
+                if isinstance(replay_memory, ActionLogReplayMemory):
+                    with replay_lock:
+                        decodes = replay_memory.decode_report()
+                    print('replay sampling %.0f transitions/sec, frames cached %d, decoded %d in %d runs' % (
+                          decodes['transitions_per_sec'], decodes['cached_frames'], decodes['decoded_frames'], decodes['decode_runs']))
+                    get_mlflow().log_metric("replay_transitions_per_sec", decodes['transitions_per_sec'], step_number)
+
+                usage = measure_memory(replay_memory, [policy_net, target_net], opt, env)
+                metrics.add_memory(step_number, usage)
+                print('rss %.2f GB: replay %.2f, nets %.2f, optimizer %.2f, env frames %.2f, other %.2f' % tuple(
+                      usage[k] / GB for k in ['rss', 'replay', 'nets', 'optimizer', 'env_frames', 'other']))
+                mlflow_log_all(metrics, step_number)
                 # tensorboard_log_all(perf, writer, step_number)
                 with open('rewards.txt', 'a') as reward_file:
-                    print(len(perf['episode_reward']), step_number, perf['avg_rewards'][-1], file=reward_file)
+                    print(len(metrics.episodes), step_number, avg_reward, file=reward_file)
         
-        avg_eval_reward = evaluate(step_number)
-        perf['eval_rewards'].append(avg_eval_reward)
-        perf['eval_steps'].append(step_number)
-        mlflow_log_all(perf, step_number)
+        eval_st = time.time()
+        with learner_paused():
+            if step_number > info['MIN_HISTORY_TO_LEARN']:
+                # evaluate the current policy rather than the last int8 copy
+                refresh_act_net(step_number)
+                if learner is not None and not info['INT8_ACTING']:
+                    act_net = copy.deepcopy(policy_net)
+            if info['PER_HEAD_EVAL']:
+                avg_eval_reward = evaluate_heads(step_number)
+            else:
+                avg_eval_reward = evaluate(step_number)
+        EVAL_SECONDS.observe(time.time() - eval_st)
+        LAST_EVAL_STEP.set(step_number)
+        metrics.add_eval(step_number, avg_eval_reward)
+        mlflow_log_all(metrics, step_number)
         # tensorboard_log_all(perf, writer, step_number)
 
-    writer.close()
+    # writer.close()
+    if learner is not None:
+        learner.stop()
+        learner.join()
 
 def evaluate(step_number):
     print("""
@@ -334,14 +595,100 @@ def evaluate(step_number):
         print(step_number, np.mean(eval_rewards), file=eval_reward_file)
     return np.mean(eval_rewards)
 
+def make_env(seed):
+    return Environment(rom_file=info['GAME'], frame_skip=info['FRAME_SKIP'],
+                       num_frames=info['HISTORY_SIZE'], no_op_start=info['MAX_NO_OP_FRAMES'], rand_seed=seed,
+                       dead_as_end=info['DEAD_AS_END'], max_episode_steps=info['MAX_EPISODE_STEPS'],
+                       keep_plot_frames=info.get('KEEP_PLOT_FRAMES', True))
+
+def evaluate_heads(step_number):
+    """Evaluate every head and the vote in one run.
+
+    N_ENSEMBLE+1 env copies with the same seed are stepped in lockstep - copy k
+    acts with head k and the last copy with the majority vote, as evaluate
+    does. One batched act_net forward per step serves all copies still playing.
+    Returns the vote's mean reward, per-head means go to eval_head_rewards.txt.
+    """
+    global eval_envs
+    print("""
+         #########################
+         ### Per head evaluation ##
+         #########################
+         """)
+    n_copies = info['N_ENSEMBLE'] + 1
+    if eval_envs is None:
+        eval_envs = [make_env(info['SEED']) for _ in range(n_copies)]
+    eval_random_state = np.random.RandomState(info['SEED'])
+    eval_rewards = np.zeros((info['NUM_EVAL_EPISODES'], n_copies))
+    frames_for_gif = []
+    results_for_eval = []
+    st = time.time()
+    evaluate_step_number = 0
+    for i in range(info['NUM_EVAL_EPISODES']):
+        states = [e.reset() for e in eval_envs]
+        life_lost = np.ones(n_copies, dtype=bool)
+        terminal = np.zeros(n_copies, dtype=bool)
+        while not terminal.all():
+            playing = np.flatnonzero(~terminal)
+            batch = torch.Tensor(np.stack([states[c] for c in playing]).astype(float) / info['NORM_BY']).to(act_device)
+            with torch.no_grad():
+                # (n_ensemble, len(playing)) greedy action of every head for every copy
+                head_acts = torch.stack(act_net(batch, None)).argmax(2).cpu().numpy()
+            for j, c in enumerate(playing):
+                if life_lost[c]:
+                    action = 1
+                elif eval_random_state.rand() < info['EPS_EVAL']:
+                    action = eval_random_state.randint(0, env.num_actions)
+                elif c < info['N_ENSEMBLE']:
+                    action = head_acts[c, j]
+                else:
+                    action = Counter(head_acts[:, j].tolist()).most_common(1)[0][0]
+                states[c], reward, life_lost[c], terminal[c] = eval_envs[c].step(action)
+                eval_rewards[i, c] += reward
+                if not i and c == n_copies - 1:
+                    # gif of the vote's first episode, as in evaluate
+                    frames_for_gif.append(eval_envs[c].ale.getScreenRGB())
+                    results_for_eval.append(f"{action}, {reward}, {life_lost[c]}, {terminal[c]}")
+            evaluate_step_number += 1
+            if not evaluate_step_number % 100:
+                print('eval', evaluate_step_number, eval_rewards[i].tolist())
+
+    head_rewards = eval_rewards[:, :-1].mean(0)
+    vote_reward = eval_rewards[:, -1].mean()
+    print("Evaluation score (vote):\n", vote_reward)
+    print("Evaluation score per head:\n", head_rewards.tolist())
+    print("per head evaluation took %.1fs" % (time.time() - st))
+    generate_gif(model_base_filedir, step_number, frames_for_gif, eval_rewards[0, -1], name='test', results=results_for_eval)
+
+    with open(os.path.join(model_base_filedir, 'eval_rewards.txt'), 'a') as eval_reward_file:
+        print(step_number, vote_reward, file=eval_reward_file)
+    with open(os.path.join(model_base_filedir, 'eval_head_rewards.txt'), 'a') as head_reward_file:
+        print(step_number, *head_rewards.tolist(), file=head_reward_file)
+    mlflow = get_mlflow()
+    for k, head_reward in enumerate(head_rewards):
+        mlflow.log_metric("eval_head_%d_rewards" % k, head_reward, step_number)
+    return vote_reward
+
 if __name__ == '__main__':
     from argparse import ArgumentParser
     parser = ArgumentParser()
     # parser.add_argument('-c', '--cuda', action='store_true', default=False)
     parser.add_argument('-c', '--cuda', default=0, help='cuda device number')
-    parser.add_argument('-v', '--voting_nr', default=1)
+    parser.add_argument('-v', '--voting_nr', default=1, type=int)
     parser.add_argument('-l', '--model_loadpath', default='', help='.pkl model file full path')
     parser.add_argument('-b', '--buffer_loadpath', default='', help='.npz replay buffer file full path')
+    parser.add_argument('-q', '--int8_acting', action='store_true', default=False, help='act and evaluate with an int8 quantized copy of the policy on cpu')
+    parser.add_argument('-p', '--pipelined', action='store_true', default=False, help='learn on a separate thread while the main thread steps the env')
+    parser.add_argument('-e', '--per_head_eval', action='store_true', default=False, help='evaluate every head and the vote together in lockstep env copies')
+    parser.add_argument('-d', '--replay_dir', default='', help='keep older replay segments in files under this directory instead of RAM')
+    parser.add_argument('-m', '--memory_budget', default=0., type=float, help='GB the run may use, MemAvailable when 0')
+    parser.add_argument('-a', '--auto_size', action='store_true', default=False, help='shrink BUFFER_SIZE to fit the memory budget instead of refusing to start')
+    parser.add_argument('-g', '--action_log', action='store_true', default=False, help='store ALE states and actions instead of frames, re-simulating frames when they are sampled')
+    parser.add_argument('-k', '--hashed_masks', action='store_true', default=False, help='hash bootstrap masks from transition ids when sampling instead of storing them')
+    parser.add_argument('--prefill_workers', default=0, type=int, help='play the random warm up in this many processes before training, 0 to play it in the training loop')
+    parser.add_argument('--prefill_cache', default='', help='directory to cache prefilled warm up transitions in, keyed by rom, seed and size')
+    parser.add_argument('--metrics_port', default=0, type=int, help='serve live prometheus metrics on this local port')
+    parser.add_argument('-r', '--replay_address', default='', help='use the replay server at unix:/path or host:port instead of a local buffer')
     args = parser.parse_args()
 
     # device = 'cuda:1' if args.cuda else 'cpu'
@@ -395,6 +742,21 @@ if __name__ == '__main__':
         "FRAME_SKIP": 4,  # deterministic frame skips to match DeepMind
         "MAX_NO_OP_FRAMES": 30,  # random number of noops applied to beginning of each episode
         "DEAD_AS_END": True,  # do you send finished=true to agent while training when it loses a life
+        "INT8_ACTING": args.int8_acting,  # act with an int8 copy of policy_net refreshed at every target update
+        "INT8_CALIBRATION_SIZE": 256,  # replay states used to calibrate the int8 convs
+        "PIPELINED": args.pipelined,  # learn on a separate thread, acting with a slightly stale policy
+        "REPLAY_SEGMENT_SIZE": 32768,  # frames per replay segment with --replay_dir
+        "REPLAY_RAM_SEGMENTS": 8,  # most recent segments kept in RAM with --replay_dir, the rest are on disk
+        "REPLAY_CACHE_SEGMENTS": 0,  # cold segments kept whole in an LRU cache with --replay_dir
+        "ACTION_LOG": args.action_log,  # replay keeps ALE states and actions, frames are re-simulated when sampled
+        "ACTION_LOG_CHECKPOINT_EVERY": 100,  # most transitions between two stored ALE states with --action_log
+        "ACTION_LOG_WORKERS": 4,  # frame decoding processes with --action_log
+        "ACTION_LOG_CACHE_FRAMES": 200000,  # decoded and recently added frames kept with --action_log
+        "PREFILL_WORKERS": args.prefill_workers,  # processes playing the MIN_HISTORY_TO_LEARN random warm up steps up front
+        "PREFILL_CACHE_DIR": args.prefill_cache,  # later runs of the same rom, seed and size load their warm up from here
+        "HASHED_MASKS": args.hashed_masks,  # masks from a hash of (seed, transition id, head) instead of a stored array
+        "KEEP_PLOT_FRAMES": False,  # Environment keeps every screen of an episode, nothing reads them here
+        "PER_HEAD_EVAL": args.per_head_eval,  # evaluate each head as well as the vote, with one batched forward per step
     }
 
     info['FAKE_ACTS'] = [info['RANDOM_HEAD'] for _ in range(info['N_ENSEMBLE'])]
@@ -405,16 +767,65 @@ if __name__ == '__main__':
     # Create environment
     env = Environment(rom_file=info['GAME'], frame_skip=info['FRAME_SKIP'],
                       num_frames=info['HISTORY_SIZE'], no_op_start=info['MAX_NO_OP_FRAMES'], rand_seed=info['SEED'],
-                      dead_as_end=info['DEAD_AS_END'], max_episode_steps=info['MAX_EPISODE_STEPS'])
+                      dead_as_end=info['DEAD_AS_END'], max_episode_steps=info['MAX_EPISODE_STEPS'],
+                      keep_plot_frames=info['KEEP_PLOT_FRAMES'])
+
+    # check the run fits before the replay and nets are allocated
+    transitions_in_ram = info['BUFFER_SIZE']
+    if args.replay_address:
+        frames_in_ram = transitions_in_ram = 0
+    elif args.replay_dir:
+        frames_in_ram = min(info['BUFFER_SIZE'], info['REPLAY_SEGMENT_SIZE'] * (info['REPLAY_RAM_SEGMENTS'] + info['REPLAY_CACHE_SEGMENTS']))
+    elif args.action_log:
+        frames_in_ram = min(info['BUFFER_SIZE'], info['ACTION_LOG_CACHE_FRAMES'])
+    else:
+        frames_in_ram = info['BUFFER_SIZE']
+    memory_budget = args.memory_budget * GB if args.memory_budget else available_memory()
+    if memory_budget:
+        memory_plan = fit_to_budget(info, env.num_actions, memory_budget, args.auto_size, frames_in_ram, transitions_in_ram)
+        print("projected peak memory, budget %.2f GB:\n%s" % (memory_budget / GB, format_plan(memory_plan)))
 
     # Create replay buffer
-    replay_memory = ReplayMemory(size=info['BUFFER_SIZE'],
-                                 frame_height=info['NETWORK_INPUT_SIZE'][0],
-                                 frame_width=info['NETWORK_INPUT_SIZE'][1],
-                                 agent_history_length=info['HISTORY_SIZE'],
-                                 batch_size=info['BATCH_SIZE'],
-                                 num_heads=info['N_ENSEMBLE'],
-                                 bernoulli_probability=info['BERNOULLI_PROBABILITY'])
+    if args.replay_address:
+        # the server owns the buffer - start it with matching sizes with
+        # python replay_server.py --address ... --num_heads ...
+        replay_memory = ReplayClient(args.replay_address)
+        assert replay_memory.num_heads == info['N_ENSEMBLE']
+    elif args.replay_dir:
+        replay_memory = TieredReplayMemory(args.replay_dir,
+                                           segment_size=info['REPLAY_SEGMENT_SIZE'],
+                                           ram_segments=info['REPLAY_RAM_SEGMENTS'],
+                                           cache_segments=info['REPLAY_CACHE_SEGMENTS'],
+                                           size=info['BUFFER_SIZE'],
+                                           frame_height=info['NETWORK_INPUT_SIZE'][0],
+                                           frame_width=info['NETWORK_INPUT_SIZE'][1],
+                                           agent_history_length=info['HISTORY_SIZE'],
+                                           batch_size=info['BATCH_SIZE'],
+                                           num_heads=info['N_ENSEMBLE'],
+                                           bernoulli_probability=info['BERNOULLI_PROBABILITY'],
+                                           hashed_masks=info['HASHED_MASKS'])
+    elif args.action_log:
+        replay_memory = ActionLogReplayMemory(info['GAME'], frame_skip=info['FRAME_SKIP'],
+                                              checkpoint_every=info['ACTION_LOG_CHECKPOINT_EVERY'],
+                                              n_workers=info['ACTION_LOG_WORKERS'],
+                                              cache_frames=info['ACTION_LOG_CACHE_FRAMES'],
+                                              size=info['BUFFER_SIZE'],
+                                              frame_height=info['NETWORK_INPUT_SIZE'][0],
+                                              frame_width=info['NETWORK_INPUT_SIZE'][1],
+                                              agent_history_length=info['HISTORY_SIZE'],
+                                              batch_size=info['BATCH_SIZE'],
+                                              num_heads=info['N_ENSEMBLE'],
+                                              bernoulli_probability=info['BERNOULLI_PROBABILITY'],
+                                              hashed_masks=info['HASHED_MASKS'])
+    else:
+        replay_memory = ReplayMemory(size=info['BUFFER_SIZE'],
+                                     frame_height=info['NETWORK_INPUT_SIZE'][0],
+                                     frame_width=info['NETWORK_INPUT_SIZE'][1],
+                                     agent_history_length=info['HISTORY_SIZE'],
+                                     batch_size=info['BATCH_SIZE'],
+                                     num_heads=info['N_ENSEMBLE'],
+                                     bernoulli_probability=info['BERNOULLI_PROBABILITY'],
+                                     hashed_masks=info['HASHED_MASKS'])
 
     random_state = np.random.RandomState(info["SEED"])
     action_getter = ActionGetter(n_actions=env.num_actions,
@@ -430,30 +841,29 @@ if __name__ == '__main__':
         # Load data from loadpath - save model load for later. We need some of
         # these parameters to setup other things
         print(f'loading model from: {args.model_loadpath}')
-        model_dict = torch.load(args.model_loadpath)
+        model_dict = load_checkpoint(args.model_loadpath)
         info = model_dict['info']
         info['DEVICE'] = device
+        info['INT8_ACTING'] = args.int8_acting
+        info['PIPELINED'] = args.pipelined
+        info['PER_HEAD_EVAL'] = args.per_head_eval
+        # the replay was made from the command line, before info was replaced
+        info['ACTION_LOG'] = args.action_log
+        info.setdefault('INT8_CALIBRATION_SIZE', 256)
         # Set a new random seed
         info["SEED"] = model_dict['cnt']
         model_base_filedir = os.path.split(args.model_loadpath)[0]
         start_step_number = start_last_save = model_dict['cnt']
         info['loaded_from'] = args.model_loadpath
-        perf = model_dict['perf']
-        start_step_number = perf['steps'][-1]
+        metrics_dir = os.path.join(model_base_filedir, 'metrics')
+        if 'perf_offsets' in model_dict:
+            metrics = MetricsStore(metrics_dir, offsets=model_dict['perf_offsets'])
+        else:
+            # checkpoint from before the metrics log - start one from its perf
+            metrics = MetricsStore(metrics_dir, len(model_dict['perf']['episode_head'][0]), offsets={'episodes': 0, 'evals': 0})
+            metrics.load_perf(model_dict['perf'])
+        start_step_number = int(metrics.episodes.last('steps'))
     else:
-        # Create new project
-        perf = {'steps': [],
-                'avg_rewards': [],
-                'episode_step': [],
-                'episode_head': [],
-                'eps_list': [],
-                'episode_loss': [],
-                'episode_reward': [],
-                'episode_times': [],
-                'episode_relative_times': [],
-                'eval_rewards': [],
-                'eval_steps': []}
-
         start_step_number = 0
         start_last_save = 0
         # Make new directory for this run in the case that there is already a
@@ -466,6 +876,7 @@ if __name__ == '__main__':
         os.makedirs(model_base_filedir)
         print("----------------------------------------------")
         print(f"starting NEW project: {model_base_filedir}")
+        metrics = MetricsStore(os.path.join(model_base_filedir, 'metrics'), min(info['VOTING_HEADS'], info['N_ENSEMBLE']))
 
     model_base_filepath = os.path.join(model_base_filedir, info['NAME'])
     write_info_file(info, model_base_filepath, start_step_number)
@@ -499,6 +910,13 @@ if __name__ == '__main__':
     #                    centered=info["RMS_CENTERED"],
     #                    alpha=info["RMS_DECAY"])
     opt = optim.Adam(policy_net.parameters(), lr=info['ADAM_LEARNING_RATE'])
+    # the net pt_get_action uses - replaced by an int8 copy with INT8_ACTING
+    act_net = policy_net
+    act_device = info['DEVICE']
+    replay_lock = threading.Lock()
+    learner = None
+    # env copies for evaluate_heads, made on its first call
+    eval_envs = None
 
     if args.model_loadpath:
         # what about random states - they will be wrong now???
@@ -544,19 +962,37 @@ if __name__ == '__main__':
         'DOUBLE_DQN': info['DOUBLE_DQN'],
         'PRIOR': info['PRIOR'],
         'PRIOR_SCALE': info['PRIOR_SCALE'],
-        'GAME': info['GAME']
+        'GAME': info['GAME'],
+        'INT8_ACTING': info['INT8_ACTING'],
+        'PIPELINED': info['PIPELINED'],
+        'PER_HEAD_EVAL': info['PER_HEAD_EVAL'],
     }
 
-    # Log hyperparameters with MLflow
-    run_name = f"{info['VOTING_HEADS']}_{info['N_ENSEMBLE']}"
-    mlflow.start_run(run_name=run_name)
-    mlflow.log_params(ml_config)
-
-    mlflow.pytorch.log_model(policy_net, "models")
-    mlflow.pytorch.log_model(target_net, "models")
+    # The MLflow run is started on the first log - snapshot the starting
+    # models now so the run still records the nets as they were at startup
+    info.pop('TIME_TO_FIRST_STEP', None)
+    startup_models = [('policy_net', copy.deepcopy(policy_net).cpu()),
+                      ('target_net', copy.deepcopy(target_net).cpu())]
+
+    # read at scrape time, so they cost the training loop nothing
+    live_metrics.gauge('replay_count', 'transitions in replay', function=lambda: int(getattr(replay_memory, 'count', 0)))
+    live_metrics.gauge('replay_current', 'replay write position', function=lambda: int(getattr(replay_memory, 'current', 0)))
+    live_metrics.gauge('replay_fill_ratio', 'replay count / size',
+                       function=lambda: float(getattr(replay_memory, 'count', 0)) / max(1, int(getattr(replay_memory, 'size', 1))))
+    if not args.model_loadpath and info['PREFILL_WORKERS']:
+        if args.replay_address or args.action_log:
+            print("prefill needs a local frame replay, playing the warm up in the training loop")
+        else:
+            # the warm up is all random actions, so the run picks up where it would have after it
+            start_step_number = prefill_replay(replay_memory, info['GAME'], info['MIN_HISTORY_TO_LEARN'], info['SEED'],
+                                               info['PREFILL_WORKERS'], env_kwargs_from_info(info), info['PREFILL_CACHE_DIR'])
+    TRAIN_STEP.set(start_step_number)
+    LAST_EVAL_STEP.set(start_step_number)
+    if args.metrics_port:
+        live_metrics.serve(args.metrics_port)
 
     train(start_step_number, start_last_save)
 
-    
-    mlflow.end_run()
+    metrics.flush()
+    end_mlflow()
 
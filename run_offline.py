@@ -0,0 +1,239 @@
+from __future__ import print_function
+import os
+import time
+import datetime
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.optim as optim
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, IterableDataset
+from dqn_utils import seed_everything, write_info_file, save_checkpoint, load_checkpoint, build_policy_net, evaluate_policy
+from action_replay import load_replay_buffer
+from env import Environment
+import config
+
+# Trains the ensemble from saved replay buffers with no emulator in the loop.
+# Buffers are memory mapped and sampled by DataLoader workers, the learner
+# only does the ptlearn update, and evaluation runs in a separate process on
+# the checkpoints it writes.
+
+class BufferSampler(IterableDataset):
+    """Endless minibatches drawn from one or more saved buffers"""
+    def __init__(self, buffer_paths, batch_size, num_heads, seed=0):
+        self.buffer_paths = buffer_paths
+        self.batch_size = batch_size
+        self.num_heads = num_heads
+        self.seed = seed
+        self.memories = None
+
+    def _open(self, worker_id):
+        # each worker maps the buffers itself and needs its own random stream,
+        # otherwise every worker would return the same batches
+        self.memories = []
+        for path in self.buffer_paths:
+            # action log buffers decode in this worker, frame buffers are mapped
+            memory = load_replay_buffer(path, num_heads=self.num_heads, mmap=True)
+            memory.random_state = np.random.RandomState(self.seed + 1000*worker_id + len(self.memories))
+            self.memories.append(memory)
+        counts = np.array([m.count for m in self.memories], dtype=np.float64)
+        self.probs = counts / counts.sum()
+        self.random_state = np.random.RandomState(self.seed + 1000*worker_id)
+
+    def __iter__(self):
+        worker = torch.utils.data.get_worker_info()
+        self._open(worker.id if worker is not None else 0)
+        while True:
+            if len(self.memories) == 1:
+                yield tuple(np.array(a) for a in self.memories[0].get_minibatch(self.batch_size))
+                continue
+            # transitions are split between buffers by how full each one is
+            sizes = self.random_state.multinomial(self.batch_size, self.probs)
+            parts = [m.get_minibatch(n) for m, n in zip(self.memories, sizes) if n]
+            yield tuple(np.concatenate([p[i] for p in parts]) for i in range(6))
+
+def offline_learn(states, actions, rewards, next_states, terminal_flags, masks):
+    """The ptlearn update on torch tensors straight from the loader"""
+    states = states.to(info['DEVICE'], non_blocking=True).float() / info['NORM_BY']
+    next_states = next_states.to(info['DEVICE'], non_blocking=True).float() / info['NORM_BY']
+    rewards = rewards.to(info['DEVICE']).float()
+    actions = actions.to(info['DEVICE']).long()
+    terminal_flags = terminal_flags.to(info['DEVICE']).float()
+    masks = masks.to(info['DEVICE']).float()
+
+    opt.zero_grad()
+    q_policy_vals = torch.stack(policy_net(states, None))
+    with torch.no_grad():
+        next_q_target_vals = torch.stack(target_net(next_states, None))
+        if info['DOUBLE_DQN']:
+            next_actions = torch.stack(policy_net(next_states, None)).max(2, True)[1]
+            next_qs = next_q_target_vals.gather(2, next_actions).squeeze(2)
+        else:
+            next_qs = next_q_target_vals.max(2)[0]
+    # (n_ensemble, batch) for every head at once
+    preds = q_policy_vals.gather(2, actions[None, :, None].expand(info['N_ENSEMBLE'], -1, 1)).squeeze(2)
+    targets = rewards[None] + info['GAMMA'] * next_qs * (1 - terminal_flags[None])
+    head_losses = F.smooth_l1_loss(preds, targets, reduction='none').mean(1)
+    # as in ptlearn, the masks choose which heads learn from this batch
+    used = (masks.sum(0) > 0).float()
+    loss = (head_losses * used).sum() / info['N_ENSEMBLE']
+    loss.backward()
+    for param in policy_net.core_net.parameters():
+        if param.grad is not None:
+            # Divide grads in core
+            param.grad.data *= 1.0 / float(info['N_ENSEMBLE'])
+    nn.utils.clip_grad_norm_(policy_net.parameters(), info['CLIP_GRAD'])
+    opt.step()
+    return (head_losses * used).sum().item() / max(1., used.sum().item())
+
+def evaluate_checkpoint(checkpoint_path, eval_file, num_episodes):
+    """runs in a side process on a checkpoint written by the learner"""
+    from export_policy import voting_policy_from_checkpoint
+    torch.set_num_threads(1)
+    model_dict = load_checkpoint(checkpoint_path, map_location='cpu')
+    info = model_dict['info']
+    policy = voting_policy_from_checkpoint(model_dict)
+    env = Environment(rom_file=info['GAME'], frame_skip=info['FRAME_SKIP'],
+                      num_frames=info['HISTORY_SIZE'], no_op_start=info['MAX_NO_OP_FRAMES'], rand_seed=info['SEED'],
+                      dead_as_end=info['DEAD_AS_END'], max_episode_steps=info['MAX_EPISODE_STEPS'])
+    def get_action(state):
+        with torch.no_grad():
+            return policy(torch.from_numpy(state[None])).item()
+    rewards = evaluate_policy(env, get_action, num_episodes, info['EPS_EVAL'], np.random.RandomState(info['SEED']))
+    print("Evaluation score at update %s:\n" % model_dict['cnt'], np.mean(rewards))
+    with open(eval_file, 'a') as f:
+        print(model_dict['cnt'], np.mean(rewards), file=f)
+
+def train_offline():
+    worker_kwargs = {'prefetch_factor': 4, 'persistent_workers': True} if info['NUM_WORKERS'] else {}
+    loader = DataLoader(BufferSampler(info['BUFFER_PATHS'], info['BATCH_SIZE'], info['N_ENSEMBLE'], info['SEED']),
+                        batch_size=None, num_workers=info['NUM_WORKERS'],
+                        pin_memory=info['DEVICE'].startswith('cuda'), **worker_kwargs)
+    eval_process = None
+    losses = []
+    st = time.time()
+    for update, batch in enumerate(loader, start=1):
+        losses.append(offline_learn(*batch))
+        if not update % info['TARGET_UPDATE']:
+            target_net.load_state_dict(policy_net.state_dict())
+        if not update % info['PRINT_EVERY']:
+            et = time.time()
+            print("update %d loss %.5f  %.1f updates/sec" % (update, np.mean(losses), info['PRINT_EVERY'] / (et - st)))
+            with open(os.path.join(model_base_filedir, 'train_losses.txt'), 'a') as f:
+                print(update, np.mean(losses), file=f)
+            losses = []
+            st = et
+        if not update % info['EVAL_EVERY'] or update == info['MAX_UPDATES']:
+            filename = os.path.abspath(model_base_filepath + "_%010dq.pkl" % update)
+            save_checkpoint({'info': info,
+                             'optimizer': opt.state_dict(),
+                             'cnt': update,
+                             'policy_net_state_dict': policy_net.state_dict(),
+                             'target_net_state_dict': target_net.state_dict()}, filename)
+            if eval_process is not None and eval_process.is_alive():
+                print("previous evaluation still running, skipping evaluation of %s" % filename)
+            else:
+                eval_process = mp.get_context('spawn').Process(
+                    target=evaluate_checkpoint,
+                    args=(filename, os.path.join(model_base_filedir, 'eval_rewards.txt'), info['NUM_EVAL_EPISODES']))
+                eval_process.start()
+        if update >= info['MAX_UPDATES']:
+            break
+    if eval_process is not None:
+        eval_process.join()
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('buffers', nargs='+', help='_train_buffer.npz files to learn from')
+    parser.add_argument('-c', '--cuda', default='', help='cuda device number, cpu when not given')
+    parser.add_argument('-l', '--model_loadpath', default='', help='.pkl checkpoint to start from and take settings from')
+    parser.add_argument('-n', '--name', default='offline', help='start files with name')
+    parser.add_argument('--game', default='roms/pong.bin', help='rom the buffers were collected on')
+    parser.add_argument('--workers', default=4, type=int, help='sampling processes')
+    parser.add_argument('--max_updates', default=int(1e6), type=int)
+    parser.add_argument('--eval_every', default=50000, type=int, help='updates between side process evaluations')
+    parser.add_argument('--lr', default=6.25e-5, type=float)
+    parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--gamma', default=.99, type=float)
+    parser.add_argument('--target_update', default=2500, type=int, help='updates between target net syncs, 10000 env steps online')
+    parser.add_argument('--prior_scale', default=10., type=float, help='0 for no prior')
+    parser.add_argument('--seed', default=101, type=int)
+    parser.add_argument('--threads', default=0, type=int, help='torch threads for the learner, 0 for torch default')
+    args = parser.parse_args()
+
+    device = f'cuda:{args.cuda}' if args.cuda != '' else 'cpu'
+    print(f"running on {device}")
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    # header of the first buffer, the rest must match it
+    first = np.load(args.buffers[0])
+    info = {
+        "GAME": args.game,
+        "DEVICE": device,
+        "NAME": args.name,
+        "DUELING": True,
+        "DOUBLE_DQN": True,
+        "PRIOR": args.prior_scale > 0,
+        "PRIOR_SCALE": args.prior_scale,
+        "N_ENSEMBLE": int(first['num_heads']),
+        "BERNOULLI_PROBABILITY": float(first['bernoulli_probability']),
+        "TARGET_UPDATE": args.target_update,
+        "NORM_BY": 255.,
+        "EPS_EVAL": 0.0,
+        "NUM_EVAL_EPISODES": 1,
+        "EVAL_EVERY": args.eval_every,
+        "PRINT_EVERY": 1000,
+        "ADAM_LEARNING_RATE": args.lr,
+        "HISTORY_SIZE": int(first['agent_history_length']),
+        "BATCH_SIZE": args.batch_size,
+        "GAMMA": args.gamma,
+        "CLIP_GRAD": 5,
+        "SEED": args.seed,
+        "NETWORK_INPUT_SIZE": (int(first['frame_height']), int(first['frame_width'])),
+        "MAX_UPDATES": args.max_updates,
+        "MAX_EPISODE_STEPS": 27000,
+        "FRAME_SKIP": 4,
+        "MAX_NO_OP_FRAMES": 30,
+        "DEAD_AS_END": True,
+        "NUM_WORKERS": args.workers,
+    }
+    if args.model_loadpath:
+        model_dict = load_checkpoint(args.model_loadpath, map_location='cpu')
+        # the net shape and game come from the checkpoint, the learner settings from args
+        for key in ['GAME', 'DUELING', 'DOUBLE_DQN', 'PRIOR', 'PRIOR_SCALE', 'N_ENSEMBLE', 'NORM_BY',
+                    'HISTORY_SIZE', 'NETWORK_INPUT_SIZE', 'MAX_EPISODE_STEPS', 'FRAME_SKIP',
+                    'MAX_NO_OP_FRAMES', 'DEAD_AS_END', 'EPS_EVAL']:
+            info[key] = model_dict['info'][key]
+        info['loaded_from'] = args.model_loadpath
+    info['BUFFER_PATHS'] = [os.path.abspath(b) for b in args.buffers]
+    info['args'] = args
+    info['load_time'] = datetime.date.today().ctime()
+
+    # the env is only needed for its action set here - it is not stepped
+    n_actions = Environment(rom_file=info['GAME']).num_actions
+
+    run_num = 0
+    model_base_filedir = os.path.join(config.model_savedir, info['NAME'] + '%02d' % run_num)
+    while os.path.exists(model_base_filedir):
+        run_num += 1
+        model_base_filedir = os.path.join(config.model_savedir, info['NAME'] + '%02d' % run_num)
+    os.makedirs(model_base_filedir)
+    print(f"starting NEW offline project: {model_base_filedir}")
+    model_base_filepath = os.path.join(model_base_filedir, info['NAME'])
+    write_info_file(info, model_base_filepath, 0)
+    seed_everything(info['SEED'])
+
+    policy_net = build_policy_net(info, n_actions, info['DEVICE'])
+    target_net = build_policy_net(info, n_actions, info['DEVICE'])
+    if info['PRIOR']:
+        # policy and target share one prior, as in run_bootstrap
+        target_net.prior = policy_net.prior
+    if args.model_loadpath:
+        policy_net.load_state_dict(model_dict['policy_net_state_dict'])
+    target_net.load_state_dict(policy_net.state_dict())
+    opt = optim.Adam(policy_net.parameters(), lr=info['ADAM_LEARNING_RATE'])
+
+    train_offline()
@@ -0,0 +1,297 @@
+import os
+import time
+import zipfile
+from collections import OrderedDict
+import numpy as np
+from replay import ReplayMemory, REPLAY_SAMPLED, REPLAY_SAMPLE_SECONDS
+
+# Replay whose frames do not have to fit in RAM. The frame ring is cut into
+# fixed size segments - the ones written most recently stay in RAM and older
+# ones are spilled to one raw file per segment. Everything but the frames is
+# small (~10 bytes a transition) and stays in RAM as in ReplayMemory.
+
+class SegmentedFrames:
+    """
+    Stands in for ReplayMemory.frames. Supports the indexing ReplayMemory
+    does - frames[i], frames[start:stop], frames[index_array] - plus take(),
+    which reads a batch of frames grouped by segment.
+    """
+    def __init__(self, size, frame_height, frame_width, dirpath, segment_size=32768,
+                 ram_segments=4, cache_segments=0, readahead=64):
+        """
+        Args:
+            size: Integer, frames in the ring
+            dirpath: String, directory the cold segment files are kept in
+            segment_size: Integer, frames per segment
+            ram_segments: Integer, most recently written segments kept in RAM
+            cache_segments: Integer, cold segments kept whole in an LRU cache.
+                A miss reads the whole segment in one sequential read, which
+                only pays off when samples come back to the same segments.
+                With 0, cold frames are read with one pread per run instead
+            readahead: Integer, cold frames this close together are read in
+                the same pread rather than two
+        """
+        self.shape = (size, frame_height, frame_width)
+        self.dtype = np.dtype(np.uint8)
+        self.frame_bytes = frame_height * frame_width
+        self.segment_size = segment_size
+        self.n_segments = (size + segment_size - 1) // segment_size
+        self.ram_segments = max(1, ram_segments)
+        self.cache_segments = cache_segments
+        self.readahead = readahead
+        self.dirpath = dirpath
+        if not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+        # segment -> array, in the order they were last written
+        self.ram = OrderedDict()
+        # segment -> array, in the order they were last read
+        self.cache = OrderedDict()
+        self.fds = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {'ram_frames': 0, 'cache_frames': 0, 'disk_frames': 0, 'disk_reads': 0, 'disk_bytes': 0, 'spills': 0}
+
+    def _segment_len(self, s):
+        return min(self.segment_size, self.shape[0] - s*self.segment_size)
+
+    def _fd(self, s):
+        if s not in self.fds:
+            # stale files from an earlier run are overwritten before they are read
+            self.fds[s] = os.open(os.path.join(self.dirpath, 'segment_%05d.bin' % s), os.O_RDWR | os.O_CREAT)
+        return self.fds[s]
+
+    def _pread(self, s, start, n):
+        nbytes = n * self.frame_bytes
+        data = os.pread(self._fd(s), nbytes, start * self.frame_bytes)
+        self.stats['disk_reads'] += 1
+        self.stats['disk_bytes'] += nbytes
+        if len(data) < nbytes:
+            # never spilled - only reachable before the ring has been written
+            data = data + bytes(nbytes - len(data))
+        return np.frombuffer(data, dtype=np.uint8).reshape(n, self.shape[1], self.shape[2])
+
+    def _spill(self, s, data):
+        os.pwrite(self._fd(s), data.tobytes(), 0)
+        self.stats['spills'] += 1
+
+    def _hot(self, s):
+        """the RAM copy of segment s, for writing"""
+        if s in self.ram:
+            self.ram.move_to_end(s)
+            return self.ram[s]
+        data = self.cache.pop(s, None)
+        if data is None:
+            # its unwritten tail still holds live transitions once the ring wraps
+            data = self._pread(s, 0, self._segment_len(s)).copy()
+        self.ram[s] = data
+        while len(self.ram) > self.ram_segments:
+            self._spill(*self.ram.popitem(last=False))
+        return data
+
+    def segment(self, s):
+        """all of segment s, without caching it"""
+        if s in self.ram:
+            return self.ram[s]
+        if s in self.cache:
+            return self.cache[s]
+        return self._pread(s, 0, self._segment_len(s))
+
+    def __setitem__(self, key, value):
+        key = key[0] if isinstance(key, tuple) else key
+        if isinstance(key, slice):
+            start, stop, _ = key.indices(self.shape[0])
+        else:
+            start, stop = key, key + 1
+            value = np.asarray(value)[None]
+        # ReplayMemory writes are contiguous but may cross segments
+        done = 0
+        while start < stop:
+            s = start // self.segment_size
+            lo = start - s*self.segment_size
+            n = min(stop - start, self.segment_size - lo)
+            self._hot(s)[lo:lo+n] = value[done:done+n]
+            start += n
+            done += n
+
+    def __getitem__(self, key):
+        key = key[0] if isinstance(key, tuple) else key
+        if isinstance(key, slice):
+            return self.take(np.arange(*key.indices(self.shape[0])))
+        if np.ndim(key):
+            return self.take(np.asarray(key))
+        return self.take(np.array([key]))[0]
+
+    def take(self, indices):
+        """frames at indices, reading each segment they fall in once"""
+        indices = np.asarray(indices, dtype=np.int64)
+        out = np.empty((len(indices),) + self.shape[1:], dtype=np.uint8)
+        order = np.argsort(indices, kind='stable')
+        segments = indices[order] // self.segment_size
+        bounds = np.flatnonzero(np.diff(segments)) + 1
+        for sel in np.split(order, bounds):
+            s = int(indices[sel[0]] // self.segment_size)
+            local = indices[sel] - s*self.segment_size
+            if s in self.ram:
+                out[sel] = self.ram[s][local]
+                self.stats['ram_frames'] += len(sel)
+            elif s in self.cache or self.cache_segments:
+                if s in self.cache:
+                    self.cache.move_to_end(s)
+                else:
+                    self.cache[s] = self._pread(s, 0, self._segment_len(s))
+                    while len(self.cache) > self.cache_segments:
+                        self.cache.popitem(last=False)
+                out[sel] = self.cache[s][local]
+                self.stats['cache_frames'] += len(sel)
+            else:
+                out[sel] = self._read_runs(s, local)
+                self.stats['disk_frames'] += len(sel)
+        return out
+
+    def _read_runs(self, s, local):
+        """local is sorted - frames within readahead of each other share a pread"""
+        out = np.empty((len(local),) + self.shape[1:], dtype=np.uint8)
+        breaks = np.flatnonzero(np.diff(local) > self.readahead) + 1
+        for run in np.split(np.arange(len(local)), breaks):
+            start = local[run[0]]
+            data = self._pread(s, start, local[run[-1]] - start + 1)
+            out[run] = data[local[run] - start]
+        return out
+
+    def close(self):
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = {}
+
+class TieredReplayMemory(ReplayMemory):
+    """ReplayMemory with its frames in SegmentedFrames, for buffers larger than RAM"""
+    def __init__(self, dirpath, segment_size=32768, ram_segments=4, cache_segments=0, readahead=64, **kwargs):
+        """
+        Args:
+            dirpath: String, directory for the cold segment files
+            segment_size, ram_segments, cache_segments, readahead: see SegmentedFrames
+            kwargs: passed to ReplayMemory
+        """
+        self.tier_config = {'dirpath': dirpath, 'segment_size': segment_size, 'ram_segments': ram_segments,
+                            'cache_segments': cache_segments, 'readahead': readahead}
+        super(TieredReplayMemory, self).__init__(**kwargs)
+        self.sample_time = 0.
+        self.sampled = 0
+
+    def _allocate_frames(self):
+        return SegmentedFrames(self.size, self.frame_height, self.frame_width, **self.tier_config)
+
+    def get_minibatch(self, batch_size):
+        """
+        Returns a minibatch of batch_size, fetching the frames of every state
+        in it with one grouped take
+        """
+        st = time.time()
+        if self.count < self.agent_history_length:
+            raise ValueError('Not enough memories to get a minibatch')
+        self._get_valid_indices(batch_size)
+        history = self.agent_history_length
+        # frames idx-history .. idx hold both the state and the next state
+        frame_indices = self.indices[:, None] + np.arange(-history, 1)[None, :]
+        frames = self.frames.take(frame_indices.ravel()).reshape(batch_size, history + 1, self.frame_height, self.frame_width)
+        self.states = frames[:, :history]
+        self.new_states = frames[:, 1:]
+        self.sample_time += time.time() - st
+        self.sampled += batch_size
+        REPLAY_SAMPLED.inc(batch_size)
+        REPLAY_SAMPLE_SECONDS.observe(time.time() - st)
+        return self.states, self.actions[self.indices], self.rewards[self.indices], self.new_states, self.terminal_flags[self.indices], self.get_masks(self.indices)
+
+    def tier_report(self):
+        """sampling throughput and where the sampled frames came from since the last report"""
+        stats = dict(self.frames.stats)
+        stats['transitions_per_sec'] = self.sampled / self.sample_time if self.sample_time else 0.
+        self.frames.reset_stats()
+        self.sample_time = 0.
+        self.sampled = 0
+        return stats
+
+    def save_buffer(self, filepath):
+        """
+        Writes the same uncompressed .npz as ReplayMemory.save_buffer, a
+        segment at a time, so the frames never have to be in memory at once
+        """
+        st = time.time()
+        print("starting save of tiered buffer to %s"%filepath, st)
+        if not filepath.endswith('.npz'):
+            filepath += '.npz'
+        arrays = {'actions': self.actions, 'rewards': self.rewards,
+                  'terminal_flags': self.terminal_flags,
+                  'masks': self.masks if self.masks is not None else np.zeros((0, self.num_heads), dtype=bool),
+                  'hashed_masks': self.masks is None, 'mask_seed': self.mask_seed, 'total_added': self.total_added,
+                  'history_breaks': self.history_breaks,
+                  'count': self.count, 'current': self.current,
+                  'agent_history_length': self.agent_history_length,
+                  'frame_height': self.frame_height, 'frame_width': self.frame_width,
+                  'num_heads': self.num_heads, 'bernoulli_probability': self.bernoulli_probability}
+        with zipfile.ZipFile(filepath, 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+            with zf.open('frames.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(self.frames.dtype),
+                                                         'fortran_order': False, 'shape': self.frames.shape})
+                for s in range(self.frames.n_segments):
+                    f.write(self.frames.segment(s).tobytes())
+            for name, array in arrays.items():
+                with zf.open(name + '.npy', 'w', force_zip64=True) as f:
+                    np.lib.format.write_array(f, np.asanyarray(array))
+        print("finished saving buffer", time.time()-st)
+
+    def load_buffer(self, filepath, mmap=True):
+        """loads a buffer from ReplayMemory.save_buffer, streaming its frames into the segments"""
+        self.frames.close()
+        super(TieredReplayMemory, self).load_buffer(filepath, mmap=True)
+        source = self.frames
+        for name in ['actions', 'rewards', 'terminal_flags', 'masks', 'history_breaks']:
+            if getattr(self, name) is not None:
+                setattr(self, name, np.array(getattr(self, name)))
+        self.frames = self._allocate_frames()
+        for start in range(0, self.size, self.frames.segment_size):
+            self.frames[start:start + self.frames.segment_size] = source[start:start + self.frames.segment_size]
+        # the write head's segment is the one that should be hot
+        self.frames._hot(int(self.current) // self.frames.segment_size)
+
+def benchmark_tiers(dirpath, configs, size=200000, batch_size=32, n_batches=200, segment_size=16384):
+    """
+    Fill a buffer of random frames under each (ram_segments, cache_segments)
+    config and report its sampling throughput
+    """
+    random_state = np.random.RandomState(0)
+    block = random_state.randint(0, 256, (segment_size, 84, 84)).astype(np.uint8)
+    results = []
+    for ram_segments, cache_segments in configs:
+        memory = TieredReplayMemory(os.path.join(dirpath, 'ram%d_cache%d' % (ram_segments, cache_segments)),
+                                    segment_size=segment_size, ram_segments=ram_segments,
+                                    cache_segments=cache_segments, size=size, batch_size=batch_size)
+        for start in range(0, size, segment_size):
+            n = min(segment_size, size - start)
+            memory.add_experiences(random_state.randint(0, 4, n), block[:n], np.zeros(n), random_state.rand(n) < 0.001)
+        memory.get_minibatch(batch_size)
+        memory.tier_report()
+        for _ in range(n_batches):
+            memory.get_minibatch(batch_size)
+        report = memory.tier_report()
+        print("ram segments %d, cache segments %d (%d segments): %.0f transitions/sec, "
+              "frames from ram %d, cache %d, disk %d in %d reads" % (
+              ram_segments, cache_segments, memory.frames.n_segments, report['transitions_per_sec'],
+              report['ram_frames'], report['cache_frames'], report['disk_frames'], report['disk_reads']))
+        results.append(report)
+        memory.frames.close()
+    return results
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('dirpath', help='directory for the segment files')
+    parser.add_argument('--size', default=200000, type=int)
+    parser.add_argument('--segment_size', default=16384, type=int)
+    parser.add_argument('--n_batches', default=200, type=int)
+    args = parser.parse_args()
+    n_segments = (args.size + args.segment_size - 1) // args.segment_size
+    # all in RAM, then less and less of it, with and without the segment cache
+    configs = [(n_segments, 0), (n_segments // 2, 0), (n_segments // 2, 2), (1, 0), (1, 4)]
+    benchmark_tiers(args.dirpath, configs, size=args.size, n_batches=args.n_batches, segment_size=args.segment_size)